@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides importing modules on first use, so the command
+line tools only import what the called subcommand needs.
+"""
+
+import importlib
+
+
+class LazyModule(object):
+    """Proxy for the module with the given name that imports it when
+    an attribute is accessed for the first time.
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self._name)
+
+
+def lazymodules(package, *names):
+    """Return a list of LazyModule objects for the modules with the
+    given names in the given package.
+    """
+    return [LazyModule('{}.{}'.format(package, n)) for n in names]
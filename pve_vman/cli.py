@@ -31,10 +31,27 @@ import time
 import signal
 import logging
 
-from pve_vman import pvestats, pvecluster, pvevmiostats
+from pve_vman._lazy import LazyModule, lazymodules
 from pve_vman.exceptions import Error, MigrationError
 from pve_vman._version import __version__
 
+# Modules are imported on first use, so every subcommand only imports
+# what it needs and starting vman or vmiostat stays fast.
+threading = LazyModule('threading')
+subprocess = LazyModule('subprocess')
+socket = LazyModule('socket')
+pvestats, pvecluster, pvevmiostats, pveexporter, pverefresh, pvebalancer, \
+    pveservice, pveresources, pvepacking, pveoptimize, pvecost, \
+    pvestrategies, pveschedule, pvereplan, pverolling, pvecapacity, \
+    pveconstraints, pveplan, pveprofile, pvehistory, pverrd, \
+    pvestorage, pvememory, pvefiles, pvebwlimit = lazymodules(
+        'pve_vman', 'pvestats', 'pvecluster', 'pvevmiostats', 'pveexporter',
+        'pverefresh', 'pvebalancer', 'pveservice', 'pveresources',
+        'pvepacking', 'pveoptimize', 'pvecost', 'pvestrategies',
+        'pveschedule', 'pvereplan', 'pverolling', 'pvecapacity',
+        'pveconstraints', 'pveplan', 'pveprofile', 'pvehistory', 'pverrd',
+        'pvestorage', 'pvememory', 'pvefiles', 'pvebwlimit')
+
 logging.basicConfig(format='%(message)s')
 
 
@@ -61,13 +78,232 @@ def __int_fmt(num, base=1000):
         num /= base
     return num
 
-def print_state(cluster):
-    """Format and print the given cluster object."""
+def __time_fmt(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "%ds" % seconds
+    if seconds < 3600:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+
+def _costmodelarguments(parser):
+    """Add the options of the migration cost model (see _costmodel)."""
+    parser.add_argument(
+        '--bandwidth',
+        type=int,
+        default=pvecost.BANDWIDTH // 1024 ** 2,
+        help='migration bandwidth in MiB/s for estimating durations '
+             '(default %(default)s)')
+
+def _costmodel(args):
+    return pvecost.MigrationCostModel(args.bandwidth * 1024 ** 2)
+
+def _strategies(command):
+    def parse(value):
+        try:
+            return pvestrategies.parsestrategies(command, value)
+        except Error as exc:
+            raise argparse.ArgumentTypeError(str(exc))
+    return parse
+
+def _weights(value):
+    try:
+        return pveresources.parseweights(value)
+    except Error as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+def _statistic(value):
+    try:
+        pvehistory.statistic(value)
+    except Error as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+    return value
+
+def _listen(value):
+    try:
+        return pveexporter.parselisten(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+def _agents(value):
+    agents = []
+    for agent in value.split(','):
+        host, _, port = agent.partition(':')
+        if not host:
+            continue
+        try:
+            agents.append((host, int(port or pvevmiostats.AGENTPORT)))
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "invalid agent address '{}'".format(agent))
+    return agents
+
+def _windowarguments(parser):
+    """Add the options of the usage aggregation (see _smoothed)."""
+    parser.add_argument(
+        '--window',
+        type=int,
+        help='plan with the usage aggregated over the last seconds of '
+             'the history instead of the current usage')
+    parser.add_argument(
+        '--stat',
+        type=_statistic,
+        default='mean',
+        help='aggregation of the usage over the window: mean, min, max '
+             'or pNN for a percentile (default %(default)s)')
+    parser.add_argument(
+        '--history',
+        default=pvehistory.HISTORYFILE,
+        help='history file recorded by vman service or vman history '
+             '--record (default %(default)s)')
+    parser.add_argument(
+        '--source',
+        choices=('history', 'rrd'),
+        default='history',
+        help='read the usage over the window from the history file or '
+             'the PVE RRD files, which only keep averages '
+             '(default %(default)s)')
+
+def _rated(args, cluster):
+    """Return the cluster with the IO and network rates of the VMs
+    between the snapshots of the history recorded within the last
+    RATEWINDOW seconds. VMs without such snapshots keep the average
+    rates since their start.
+    """
+    history = pvehistory.History(
+        getattr(args, 'history', pvehistory.HISTORYFILE))
+
+    try:
+        stats = history.statistics(pvehistory.RATEWINDOW)
+    except Error as exc:
+        logging.getLogger(__name__).debug(
+            'no rates from the history: %s', exc)
+        return cluster
+
+    return pvehistory.setrates(cluster, stats)
+
+def _smoothed(args, cluster):
+    """Return the cluster with the usage aggregated over the window of
+    the history or averaged over it by the PVE RRD files if a window is
+    given, else the cluster with the recent rates (see _rated).
+    """
+    if not args.window:
+        return _rated(args, cluster)
+
+    if args.source == 'rrd':
+        stats = pverrd.annotate(cluster, args.window)
+    else:
+        history = pvehistory.History(args.history)
+        stats = history.statistics(args.window, args.stat)
+
+    if not stats:
+        logging.getLogger(__name__).warning(
+            'no history within the last %d seconds, using the current '
+            'usage', args.window)
+        return _rated(args, cluster)
+
+    return pvehistory.smooth(cluster, stats)
+
+def _memmodelarguments(parser):
+    """Add the options of the memory model (see _effective)."""
+    parser.add_argument(
+        '--memmodel',
+        choices=pvememory.MODELS,
+        default='used',
+        help='memory of the VMs to plan with: the used memory, at least '
+             'the balloon size, the used memory plus the share of the '
+             'KSM savings of the node or both; balloon sizes and KSM '
+             'savings are only known for the local node '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--ksmloss',
+        type=int,
+        default=pvememory.KSMLOSS,
+        help='percentage of its share of the KSM savings a VM is assumed '
+             'to lose by a migration (default %(default)s)')
+
+def _effective(args, cluster):
+    """Return the cluster with the memory of the VMs replaced by the one
+    of the memory model if another one than the used memory is given,
+    else the cluster itself.
+    """
+    if args.memmodel == 'used':
+        return cluster
+
+    pvememory.annotate(cluster)
+
+    return pvememory.effective(cluster, args.memmodel, args.ksmloss)
+
+def _constraintarguments(parser):
+    """Add the options of the placement constraints (see _constraints)."""
+    parser.add_argument(
+        '--rules',
+        default=pveconstraints.RULESFILE,
+        help='file with placement rules for VMs (default %(default)s)')
+    parser.add_argument(
+        '--noconstraints',
+        action='store_true',
+        help='ignore the HA groups and the placement rules')
+
+def _constraints(args, cluster):
+    """Return the constraint index of the cluster unless disabled."""
+    if args.noconstraints:
+        return None
+
+    return pveconstraints.buildindex(cluster, args.rules)
+
+def _storagearguments(parser):
+    """Add the options of migrating local disks (see _storage)."""
+    parser.add_argument(
+        '--localdisks',
+        action='store_true',
+        help='also migrate VMs with disks on local storages together with '
+             'their disks, to nodes with enough space on the same storages')
+    parser.add_argument(
+        '--storagelimit',
+        type=int,
+        default=pvestorage.STORAGELIMIT,
+        help='percentage of a local storage that may be used with '
+             '--localdisks (default %(default)s)')
+
+def _storage(args, cluster):
+    """Return the storage index of the cluster if VMs with local disks
+    are migrated.
+    """
+    if not args.localdisks:
+        return None
+
+    return pvestorage.StorageIndex(cluster, args.storagelimit)
+
+def _delta(node, previous):
+    """Return the change of the VM memory usage and the VM count of the
+    node since the previous cluster object as text.
+    """
+    if node.id not in previous:
+        return ' new'
+
+    old = previous[node.id]
+    mem = int(round(node.memvmnodeused_perc - old.memvmnodeused_perc))
+    count = len(node.children) - len(old.children)
+
+    if not mem and not count:
+        return ''
+
+    return ' {:+d}% {:+d} VMs'.format(mem, count)
+
+def print_state(cluster, previous=None, highlight=()):
+    """Format and print the given cluster object. If a previous cluster
+    object is given, the changes of the nodes since then are appended.
+    The lines of the nodes with an id in highlight are printed bold.
+    """
     lines = []
+    suffixes = []
     migrateable = lambda c: c.migrateable
     havms = lambda c: c.ha
 
     for node in cluster:
+        suffixes.append((_delta(node, previous) if previous else '',
+                         node.id in highlight))
         lines.append((
             'Node {}'.format(node.node),
             __int_fmt(node.memtotal, base=1024),
@@ -100,48 +336,355 @@ def print_state(cluster):
     print(fmt_h1.format('', 'Node Mem', 'VM Mem Sums', 'VM Counts'))
     print(fmt_h2.format('', 'Total', 'Used', 'Used', 'Prov', 'Tot.', 'Migr',
                         'HA'))
+    for line, (suffix, bold) in zip(lines, suffixes + [('', False)]):
+        text = fmt_d.format(*line) + suffix
+        print('\033[1m{}\033[0m'.format(text) if bold else text)
+
+def print_capacity(scenarios):
+    """Format and print the given failure scenarios (see pvecapacity)."""
+    lines = []
+
+    for scenario in scenarios:
+        tightest = scenario.tightest
+        lines.append((
+            ','.join(scenario.failed),
+            len(scenario.items),
+            __int_fmt(scenario.needed, base=1024),
+            __int_fmt(scenario.missing, base=1024),
+            __int_fmt(scenario.headroom, base=1024),
+            tightest[0] if tightest else '-',
+            __int_fmt(tightest[1], base=1024) if tightest else '-',
+            'OK' if scenario.ok else
+            'FAIL ({} VMs, overflow {})'.format(
+                len(scenario.unplaced), scenario.overflow)))
+
+    fmt_first = '{{:{:d}s}}'.format(max([len(l[0]) for l in lines] + [6]))
+    fmt_h = fmt_first
+    fmt_h += ' | {:>4s} | {:>6s} | {:>7s} | {:>8s} | {:^15s} | {}'
+    fmt_d = fmt_first
+    fmt_d += ' | {:4d} | {:>6s} | {:>7s} | {:>8s} | {:>9s} {:>5s} | {}'
+
+    print(fmt_h.format('Failed', 'VMs', 'Needed', 'Missing', 'Headroom',
+                       'Tightest node', 'Result'))
     for line in lines:
         print(fmt_d.format(*line))
 
-def exec_migrate(cluster, newcluster, args):
+def watch_state(interval):
+    """Redraw the cluster state every interval seconds until SIGINT is
+    received. The cluster is rebuilt reading only the VM configs that
+    changed. The changes since watching started are shown per node and
+    the nodes that changed since the last refresh are highlighted, as
+    well as the VMs locked for migration.
+    """
+    cache = {}
+    first = previous = None
+    tty = sys.stdout.isatty()
+
+    while True:
+        start = time.time()
+        cluster = pvestats.buildcluster(vmconfcache=cache)
+        cluster.freeze()
+        duration = time.time() - start
+
+        changed = []
+        if previous is not None:
+            changed = [n.id for n in cluster if _delta(n, previous)]
+        migrating = cluster.vms(lambda v: v.attrs.get('lock') == 'migrate')
+
+        if tty:
+            sys.stdout.write('\033[H\033[J')
+        print('{} - refreshed in {:.0f}ms every {}s'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S'), duration * 1000, interval))
+        print_state(cluster, first, changed if tty else ())
+
+        if migrating:
+            print('Migrating: {}'.format(', '.join(
+                '{} from {}'.format(v, v.node) for v in migrating)))
+
+        sys.stdout.flush()
+        if first is None:
+            first = cluster
+        previous = cluster
+        time.sleep(max(interval - (time.time() - start), 0))
+
+def _getcluster(args):
+    """Return the frozen cluster object, from the vman service if it is
+    running and not disabled by the direct flag. Commands that run
+    migrations always build it from the PVE files, a snapshot of the
+    service may be outdated.
+    """
+    if args.direct or not getattr(args, 'noexec', True):
+        cluster = pvestats.buildcluster()
+        cluster.freeze()
+        return cluster
+
+    return pveservice.getcluster()
+
+def _serviceplan(command, args, options):
+    """Return (cluster, newcluster) tuple planned by the vman service
+    for a dry run of the --mode planner with the given options, or None
+    if the service is not running or the options can't be sent to it.
+    """
+    if args.direct or not args.noexec or args.planout or args.strategies \
+            or args.window or args.memmodel != 'used' or args.localdisks \
+            or 'costmodel' in options or args.mode not in ('mem', 'lowest'):
+        return None
+
+    options = dict((k, v) for k, v in options.items()
+                   if k not in ('constraints', 'storage'))
+
+    try:
+        return pveservice.plan(
+            command, getattr(args, 'nodes', None),
+            None if args.noconstraints else args.rules, **options)
+    except (socket.error, ValueError, Error) as exc:
+        logging.getLogger(__name__).debug(
+            'planning by the service failed: %s', exc)
+        return None
+
+def _run_migration(migration, args, limiter=None):
+    """Run the migration and return an error message if it failed. If a
+    limiter is given, the bandwidth of the migration is limited by it,
+    unless the VM is HA managed (see pvebwlimit).
+    """
+    _logger = logging.getLogger(__name__)
+
+    if migration.pvevm.ha:
+        limiter = None
+
+    if limiter is not None:
+        migration.setbwlimit(limiter.acquire(migration))
+
+    _logger.debug(' '.join(migration.cmd))
+
+    try:
+        if args.noexec:
+            _logger.info("dry run -- skipping '%s'", migration)
+            return None
+
+        out = migration.run()
+    finally:
+        if limiter is not None:
+            limiter.release(migration)
+
+    _logger.info(out.stderr)
+    _logger.debug(out.stdout)
+
+    if out.returncode != 0:
+        return '{}: migration returncode not 0: {}'.format(
+            migration, out.returncode)
+
+    return None
+
+def _wavearguments(parser):
+    """Add the options of the migration waves (see pveschedule)."""
+    parser.add_argument(
+        '-p', '--parallel',
+        action='store_true',
+        help='run the migrations of a wave at the same time')
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=pveschedule.CONCURRENCY,
+        help='maximum migrations per node in a wave (default %(default)s)')
+    parser.add_argument(
+        '--maxnodemem',
+        type=int,
+        default=pveschedule.MAXNODEMEM,
+        help='percentage of node memory never to exceed during the '
+             'migrations (default %(default)s)')
+
+def _bwlimitarguments(parser):
+    """Add the options of the adaptive bandwidth limits (see _bwlimiter)."""
+    parser.add_argument(
+        '--bwlimit',
+        action='store_true',
+        help='limit the bandwidth of every migration to what the network '
+             'load and IO wait of its nodes leave, evaluated before every '
+             'migration')
+    parser.add_argument(
+        '--netcapacity',
+        type=int,
+        default=pvebwlimit.CAPACITY // 1024 ** 2,
+        help='network capacity of the nodes in MiB/s for --bwlimit '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--minbwlimit',
+        type=int,
+        default=pvebwlimit.MINIMUM // 1024 ** 2,
+        help='lowest bandwidth limit in MiB/s for --bwlimit '
+             '(default %(default)s)')
+
+def _bwlimiter(args):
+    """Return a bandwidth limiter if adaptive bandwidth limits are
+    enabled, else None.
+    """
+    if not getattr(args, 'bwlimit', False):
+        return None
+
+    return pvebwlimit.BandwidthLimiter(
+        capacity=args.netcapacity * 1024 ** 2,
+        minimum=args.minbwlimit * 1024 ** 2)
+
+def exec_migrate(cluster, newcluster, args, costmodel=None):
     """Run the necessary VM migrations in order to achive the state
-    defined by the newcluster object.
+    defined by the newcluster object. The migrations are run in waves
+    that never exceed the memory of a target node, either one after
+    another or, with the parallel flag, all migrations of a wave at the
+    same time. The estimated durations are calculated with the given or
+    the default cost model. Return the list of failed migrations, which
+    is only not empty with the nofail flag.
     """
     _logger = logging.getLogger(__name__)
     migrations = newcluster.migrations()
+    parallel = getattr(args, 'parallel', False)
+
+    if costmodel is None:
+        costmodel = pvecost.MigrationCostModel()
+
+    waves = pveschedule.schedule(
+        cluster, migrations, costmodel,
+        concurrency=getattr(args, 'concurrency', pveschedule.CONCURRENCY),
+        maxnodemem=getattr(args, 'maxnodemem', pveschedule.MAXNODEMEM))
+
+    if parallel:
+        duration = sum([w.duration for w in waves])
+    else:
+        duration = costmodel.total(migrations)
 
     print('===== Current state =====')
     print_state(cluster)
     print('======= New state =======')
     print_state(newcluster)
+    print('Estimated duration of {} migrations in {} waves: {}'.format(
+        len(migrations), len(waves), __time_fmt(duration)))
 
     _logger.info('Running %d migrations', len(migrations))
+    limiter = _bwlimiter(args)
+    failed = []
 
-    for migration in migrations:
-        _logger.info("Running '%s'", migration)
-        _logger.debug(' '.join(migration.cmd))
+    for number, wave in enumerate(waves, 1):
+        _logger.info('Wave %d: %d migrations (estimated %s)', number,
+                     len(wave), __time_fmt(wave.duration if parallel else
+                                           costmodel.total(wave)))
 
-        if args.noexec:
-            _logger.info('dry run -- skipping migration')
-            continue
+        failed += _run_wave(wave, args, costmodel, limiter)
 
-        out = migration.run()
-        _logger.info(out.stderr)
-        _logger.debug(out.stdout)
+    return failed
 
-        if out.returncode != 0:
-            msg = 'migration returncode not 0: {}'.format(out.returncode)
+def _run_wave(wave, args, costmodel, limiter=None):
+    """Run the migrations of the wave, at the same time if the parallel
+    flag is set, with the bandwidth limits of the limiter if one is
+    given. Return the list of failed migrations. Raise MigrationError on
+    the first failure unless the nofail flag is set.
+    """
+    _logger = logging.getLogger(__name__)
 
-            if args.nofail:
-                _logger.warn(msg)
-            else:
-                raise MigrationError(msg)
+    for migration in wave:
+        _logger.info("Running '%s' (estimated %s)", migration,
+                     __time_fmt(costmodel.estimate(migration.pvevm)))
+
+    if getattr(args, 'parallel', False) and not args.noexec:
+        errors = [None] * len(wave)
+
+        if limiter is not None:
+            limiter.expect([m for m in wave if not m.pvevm.ha])
+
+        def run(index, migration):
+            errors[index] = _run_migration(migration, args, limiter)
+
+        threads = [threading.Thread(target=run, args=(i, m))
+                   for i, m in enumerate(wave)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        errors = [_run_migration(m, args, limiter) for m in wave]
+
+    for msg in [e for e in errors if e is not None]:
+        if args.nofail:
+            _logger.warn(msg)
+        else:
+            raise MigrationError(msg)
+
+    return [m for m, e in zip(wave, errors) if e is not None]
+
+def exec_replan(cluster, newcluster, args, replan, costmodel=None):
+    """Run the necessary VM migrations like exec_migrate, but only the
+    first wave of the plan at a time. After every wave, the cluster is
+    rebuilt, the rest of the plan is reconciled with it and replanned by
+    calling replan with the reconciled cluster, the ids of VMs that
+    already have been migrated or whose migration failed, which are not
+    moved again, and the number of migrations executed or still planned.
+    replan has to return the new target cluster. Requested migrations of
+    HA managed VMs that are not done yet stay in the reconciled cluster
+    and are not requested again.
+    """
+    _logger = logging.getLogger(__name__)
+
+    if args.noexec:
+        exec_migrate(cluster, newcluster, args, costmodel)
+        return
 
-def print_vmiostat(interval=1, count=0, limit=0, totals=False, ssum=False):
+    if costmodel is None:
+        costmodel = pvecost.MigrationCostModel()
+
+    schedule = lambda c, m: pveschedule.schedule(
+        c, m, costmodel,
+        concurrency=getattr(args, 'concurrency', pveschedule.CONCURRENCY),
+        maxnodemem=getattr(args, 'maxnodemem', pveschedule.MAXNODEMEM))
+
+    migrations = newcluster.migrations()
+    limiter = _bwlimiter(args)
+    failed = set()
+    moved = {}
+    executed = 0
+
+    print('===== Current state =====')
+    print_state(cluster)
+    print('===== Planned state =====')
+    print_state(newcluster)
+    print('Estimated duration of {} migrations: {}'.format(
+        len(migrations), __time_fmt(costmodel.total(migrations))))
+
+    while migrations:
+        wave = schedule(cluster, migrations)[0]
+        _logger.info('Wave: %d of %d remaining migrations', len(wave),
+                     len(migrations))
+
+        failed.update([m.pvevm.id for m
+                       in _run_wave(wave, args, costmodel, limiter)])
+        moved.update(pvereplan.planned(
+            [m for m in wave if m.pvevm.id not in failed]))
+        executed += len(wave)
+
+        remaining = pvereplan.planned(
+            [m for m in migrations if m not in wave])
+        pending = len(remaining)
+        remaining.update(moved)
+        cluster = pvestats.buildcluster()
+        cluster.freeze()
+        partial, done, dropped = pvereplan.reconcile(
+            cluster, remaining, failed)
+        pending -= len([v for v in done + dropped if v not in moved])
+        newcluster = replan(partial, list(failed.union(moved)),
+                            executed + pending)
+        migrations = [m for m in newcluster.migrations()
+                      if m.pvevm.id not in moved]
+
+    print('======= New state =======')
+    print_state(cluster)
+
+def print_vmiostat(interval=1, count=0, limit=0, totals=False, ssum=False,
+                   agents=None, sort='vmid'):
     """Print the throughput per VM. Default is to print a line per VM
     and an additional line for the totals. I fno count is given, it runs
     indefinitely until SIGINT is received else it runs count times and then
-    terminates.
+    terminates. If agents are given, the throughput of the VMs of all
+    nodes is read from the vmiostat agents at these (host, port) tuples
+    and printed with the node of the VMs. The VMs are sorted by their ID
+    or descending by the given key.
     """
     def signal_handler(*_):
         print()
@@ -152,10 +695,22 @@ def print_vmiostat(interval=1, count=0, limit=0, totals=False, ssum=False):
     if not totals and count > 0:
         count += 1
 
-    fmt = '{:10} {:>15} {:>15} {:>15} {:>15}'
     keys = pvevmiostats.VMIOStats.keys
     int_fmt = lambda l: [__int_fmt(l[k]) for k in keys]
-    vmstats = pvevmiostats.VMIOStats(interval)
+
+    if agents:
+        fmt = '{:10} {:10} {:>15} {:>15} {:>15} {:>15}'
+        header = ('Node', 'VM-ID')
+        vmstats = pvevmiostats.ClusterIOStats(interval, agents)
+    else:
+        fmt = '{:10} {:>15} {:>15} {:>15} {:>15}'
+        header = ('VM-ID',)
+        vmstats = pvevmiostats.VMIOStats(interval)
+
+    if sort == 'vmid':
+        sortkey = lambda i: (i[0][-1], i[0])
+    else:
+        sortkey = lambda i: (-i[1][sort], i[0])
 
     i = 0
     while count == 0 or i < count:
@@ -163,14 +718,24 @@ def print_vmiostat(interval=1, count=0, limit=0, totals=False, ssum=False):
         (vmdiffs, vmsums) = vmstats.fetch()
 
         if i > 1 or totals:
-            print(fmt.format('VM-ID', *keys))
+            print(fmt.format(*(header + keys)))
 
             if not ssum:
-                for vmid, diffs in sorted(vmdiffs.items()):
-                    if limit == 0 or limit == int(vmid):
-                        print(fmt.format(vmid, *int_fmt(diffs)))
-
-            print(fmt.format('total', *int_fmt(vmsums)))
+                # the local VMs are identified by their ID, the ones of
+                # the cluster by node and ID
+                rows = [(k if agents else (k,), d)
+                        for k, d in vmdiffs.items()]
+                for ident, diffs in sorted(rows, key=sortkey):
+                    if limit == 0 or limit == int(ident[-1]):
+                        print(fmt.format(*(list(ident) + int_fmt(diffs))))
+
+            print(fmt.format(*(('',) * (len(header) - 1) + ('total',)
+                               + tuple(int_fmt(vmsums)))))
+
+            if agents:
+                for (host, port), exc in sorted(vmstats.missing().items()):
+                    print('no recent sample from {}:{}{}'.format(
+                        host, port, '' if exc is None else ': {}'.format(exc)))
 
         time.sleep(interval)
         print("")
@@ -198,11 +763,80 @@ def command_balance(parser, input_args):
         '-f', '--nofail',
         action='store_true',
         help="do not fail if a migration's exit code is not 0")
+    parser.add_argument(
+        '--plan-out',
+        dest='planout',
+        help='write the plan to the given file for vman apply instead of '
+             'migrating')
+    parser.add_argument(
+        '-r', '--replan',
+        action='store_true',
+        help='rebuild the cluster and replan the remaining migrations '
+             'after every wave')
+    _wavearguments(parser)
+    _bwlimitarguments(parser)
+    _constraintarguments(parser)
+    _storagearguments(parser)
+    parser.add_argument(
+        '-d', '--direct',
+        action='store_true',
+        help="read the PVE files even if the vman service is running")
+    parser.add_argument(
+        '-m', '--mode',
+        choices=('mem', 'multi', 'optimize'),
+        default='mem',
+        help='balance memory only, memory, CPU, disk IO and network or '
+             'memory with as few migrations as possible '
+             '(default %(default)s)')
+    parser.add_argument(
+        '-w', '--weights',
+        type=_weights,
+        help='weights of the resources for multi mode, e.g. '
+             'mem=1,cpu=1,io=0.5,net=0.5 (default)')
+    parser.add_argument(
+        '-t', '--timebudget',
+        type=float,
+        default=pveoptimize.TIMEBUDGET,
+        help='seconds to search for a plan in optimize mode '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--objective',
+        choices=pveoptimize.OBJECTIVES,
+        default='count',
+        help='minimize the number of migrations or the migrated memory '
+             'in optimize mode (default %(default)s)')
+    _costmodelarguments(parser)
+    parser.add_argument(
+        '--mincost',
+        action='store_true',
+        help='prefer VMs with a low estimated migration time')
+    parser.add_argument(
+        '-S', '--strategies',
+        type=_strategies('balance'),
+        help='comma separated list of strategies to run in parallel, '
+             'the best plan is used instead of --mode: all or some of '
+             'greedy, mincost, multi, optimize, optimize-time')
+    parser.add_argument(
+        '--seeds',
+        type=int,
+        default=1,
+        help='number of random seeds per randomized strategy '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='number of worker processes (default number of CPUs)')
+    _windowarguments(parser)
+    _memmodelarguments(parser)
 
     args = parser.parse_args(input_args)
 
-    cluster = pvestats.buildcluster()
-    cluster.freeze()
+    if args.localdisks and args.mode != 'mem' and not args.strategies:
+        parser.error('--localdisks is only supported in mem mode')
+
+    cluster = _getcluster(args)
+
+    cluster = _effective(args, _smoothed(args, cluster))
 
     options = {}
     if 'count' in args and args.count:
@@ -210,9 +844,65 @@ def command_balance(parser, input_args):
     if 'ignore' in args and args.ignore:
         options['ignorenodenames'] = args.ignore
 
+    planner = pvecluster.planbalance
+    if args.mode == 'multi':
+        planner = pvecluster.planmultibalance
+        options['weights'] = args.weights
+    elif args.mode == 'optimize':
+        planner = pvecluster.planoptimizedbalance
+        options['timebudget'] = args.timebudget
+        options['objective'] = args.objective
+
+    costmodel = _costmodel(args)
+    if args.mode == 'mem' and (args.mincost or args.localdisks) \
+            or args.mode == 'optimize' and args.objective == 'time':
+        options['costmodel'] = costmodel
+    options['constraints'] = _constraints(args, cluster)
+    if args.mode == 'mem':
+        options['storage'] = _storage(args, cluster)
+
+    # the strategies add options the --mode planner used for replanning
+    # does not accept
+    planoptions = dict(options)
+
     try:
-        newcluster = pvecluster.planbalance(cluster.clone(), **options)
-        exec_migrate(cluster, newcluster, args)
+        if args.strategies:
+            options.update(
+                weights=args.weights,
+                timebudget=args.timebudget,
+                objective=args.objective)
+            options.pop('costmodel', None)
+            options['storage'] = _storage(args, cluster)
+            newcluster, _ = pvestrategies.plan(
+                'balance', cluster, args.strategies, options=options,
+                seeds=args.seeds, workers=args.workers,
+                bandwidth=costmodel.bandwidth)
+        else:
+            planned = _serviceplan('balance', args, options)
+            if planned is None:
+                newcluster = planner(cluster.clone(), **options)
+            else:
+                cluster, newcluster = planned
+
+        if args.planout:
+            pveplan.save(args.planout, 'balance', newcluster)
+            args.noexec = True
+
+        if args.replan:
+            def replan(partial, ignorevmids, planned):
+                iterations = planoptions.get(
+                    'iterations', pvecluster.MAXMIGRATIONS)
+                planoptions['constraints'] = _constraints(args, partial)
+                if 'storage' in planoptions:
+                    planoptions['storage'] = _storage(args, partial)
+                return planner(partial, **dict(
+                    planoptions,
+                    iterations=max(0, iterations - planned),
+                    ignorevmids=ignorevmids))
+
+            exec_replan(cluster, newcluster, args, replan, costmodel)
+        else:
+            exec_migrate(cluster, newcluster, args, costmodel)
     except Error as exc:
         print('{}: {} - Aborting'.format(exc.__class__.__name__, exc.message))
 
@@ -242,6 +932,71 @@ def command_flush(parser, input_args):
         '-f', '--nofail',
         action='store_true',
         help="do not fail if a migration's exit code is not 0")
+    parser.add_argument(
+        '--plan-out',
+        dest='planout',
+        help='write the plan to the given file for vman apply instead of '
+             'migrating')
+    parser.add_argument(
+        '-r', '--replan',
+        action='store_true',
+        help='rebuild the cluster and replan the remaining migrations '
+             'after every wave')
+    _wavearguments(parser)
+    _bwlimitarguments(parser)
+    _constraintarguments(parser)
+    _storagearguments(parser)
+    parser.add_argument(
+        '-d', '--direct',
+        action='store_true',
+        help="read the PVE files even if the vman service is running")
+    parser.add_argument(
+        '-m', '--mode',
+        choices=('lowest', 'binpack'),
+        default='lowest',
+        help='move each VM to the node with the lowest memory usage or '
+             'pack the VMs, biggest first, within the limits '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--fit',
+        choices=pvepacking.FITS,
+        default='best',
+        help='node choice for binpack mode (default %(default)s)')
+    parser.add_argument(
+        '--memlimit',
+        type=int,
+        default=pvepacking.MEMLIMIT,
+        help='percentage of node memory usable by VMs in binpack mode '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--cpulimit',
+        type=int,
+        default=pvepacking.CPULIMIT,
+        help='percentage of node CPUs usable by VMs in binpack mode '
+             '(default %(default)s)')
+    _costmodelarguments(parser)
+    parser.add_argument(
+        '--mincost',
+        action='store_true',
+        help='prefer VMs with a low estimated migration time')
+    parser.add_argument(
+        '-S', '--strategies',
+        type=_strategies('flush'),
+        help='comma separated list of strategies to run in parallel, '
+             'the best plan is used instead of --mode: all or some of '
+             'lowest, mincost, binpack-best, binpack-first, binpack-worst')
+    parser.add_argument(
+        '--seeds',
+        type=int,
+        default=1,
+        help='number of random seeds per randomized strategy '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='number of worker processes (default number of CPUs)')
+    _windowarguments(parser)
+    _memmodelarguments(parser)
     parser.add_argument(
         'nodes',
         nargs='+',
@@ -249,8 +1004,12 @@ def command_flush(parser, input_args):
 
     args = parser.parse_args(input_args)
 
-    cluster = pvestats.buildcluster()
-    cluster.freeze()
+    if args.localdisks and args.mode != 'lowest' and not args.strategies:
+        parser.error('--localdisks is only supported in lowest mode')
+
+    cluster = _getcluster(args)
+
+    cluster = _effective(args, _smoothed(args, cluster))
 
     options = {'onlyha': args.onlyha}
     if 'count' in args and args.count:
@@ -258,20 +1017,546 @@ def command_flush(parser, input_args):
     if 'ignore' in args and args.ignore:
         options['ignorenodenames'] = args.ignore
 
+    planner = pvecluster.planflush
+    if args.mode == 'binpack':
+        planner = pvecluster.planflushpacked
+        options['memlimit'] = args.memlimit
+        options['cpulimit'] = args.cpulimit
+        options['fit'] = args.fit
+
+    costmodel = _costmodel(args)
+    if (args.mincost or args.localdisks) and args.mode == 'lowest':
+        options['costmodel'] = costmodel
+    options['constraints'] = _constraints(args, cluster)
+    if args.mode == 'lowest':
+        options['storage'] = _storage(args, cluster)
+
+    # the strategies add options the --mode planner used for replanning
+    # does not accept
+    planoptions = dict(options)
+
     try:
-        newcluster = pvecluster.planflush(args.nodes, cluster.clone(), **options)
-        exec_migrate(cluster, newcluster, args)
+        if args.strategies:
+            options.update(memlimit=args.memlimit, cpulimit=args.cpulimit)
+            options.pop('costmodel', None)
+            options['storage'] = _storage(args, cluster)
+            newcluster, _ = pvestrategies.plan(
+                'flush', cluster, args.strategies, nodes=args.nodes,
+                options=options, seeds=args.seeds, workers=args.workers,
+                bandwidth=costmodel.bandwidth)
+        else:
+            planned = _serviceplan('flush', args, options)
+            if planned is None:
+                newcluster = planner(args.nodes, cluster.clone(), **options)
+            else:
+                cluster, newcluster = planned
+
+        if args.planout:
+            pveplan.save(args.planout, 'flush', newcluster)
+            args.noexec = True
+
+        if args.replan:
+            def replan(partial, ignorevmids, planned):
+                maxmigrations = planoptions.get(
+                    'maxmigrations', pvecluster.MAXMIGRATIONS)
+                planoptions['constraints'] = _constraints(args, partial)
+                if 'storage' in planoptions:
+                    planoptions['storage'] = _storage(args, partial)
+                return planner(args.nodes, partial, **dict(
+                    planoptions,
+                    maxmigrations=max(0, maxmigrations - planned),
+                    ignorevmids=ignorevmids))
+
+            exec_replan(cluster, newcluster, args, replan, costmodel)
+        else:
+            exec_migrate(cluster, newcluster, args, costmodel)
+    except Error as exc:
+        print('{}: {} - Aborting'.format(exc.__class__.__name__, exc.message))
+
+def command_apply(parser, input_args):
+    """Run the migrations of a plan written with --plan-out."""
+    parser.add_argument(
+        '-v', '--verbose',
+        action=_VerbosityAction,
+        help='increase verbosity level, can be used multiple times')
+    parser.add_argument(
+        '-n', '--noexec',
+        action='store_true',
+        help='only show, don\'t migrate')
+    parser.add_argument(
+        '-f', '--nofail',
+        action='store_true',
+        help="do not fail if a migration's exit code is not 0")
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='apply the plan even if the VM placement changed since it '
+             'was computed, as long as its VMs are still on their source '
+             'nodes')
+    _wavearguments(parser)
+    _bwlimitarguments(parser)
+    parser.add_argument(
+        '-d', '--direct',
+        action='store_true',
+        help="read the PVE files even if the vman service is running")
+    _costmodelarguments(parser)
+    _memmodelarguments(parser)
+    parser.add_argument(
+        'plan',
+        help='plan file written by balance or flush with --plan-out')
+
+    args = parser.parse_args(input_args)
+
+    try:
+        plan = pveplan.load(args.plan)
+        cluster = _effective(args, _rated(args, _getcluster(args)))
+
+        if not pveplan.validate(plan, cluster, args.force):
+            print('VM placement changed since the plan was computed, '
+                  'applying it anyway')
+
+        newcluster = pveplan.apply(cluster, plan)
+        exec_migrate(cluster, newcluster, args, _costmodel(args))
     except Error as exc:
         print('{}: {} - Aborting'.format(exc.__class__.__name__, exc.message))
 
+def command_rolling(parser, input_args):
+    """Empty the given nodes one after another for maintenance."""
+    parser.add_argument(
+        '-v', '--verbose',
+        action=_VerbosityAction,
+        help='increase verbosity level, can be used multiple times')
+    parser.add_argument(
+        '-n', '--noexec',
+        action='store_true',
+        help='only show the plan for all nodes, don\'t migrate')
+    parser.add_argument(
+        '-o', '--onlyha',
+        action='store_true',
+        help='only migrate HA managed VMs')
+    parser.add_argument(
+        '-i', '--ignore',
+        type=lambda x: x.split(','),
+        help='comma separated list of nodes to ignore as migration targets')
+    parser.add_argument(
+        '-f', '--nofail',
+        action='store_true',
+        help="do not fail if a migration's exit code is not 0")
+    _wavearguments(parser)
+    _bwlimitarguments(parser)
+    _constraintarguments(parser)
+    _storagearguments(parser)
+    parser.add_argument(
+        '-d', '--direct',
+        action='store_true',
+        help="read the PVE files even if the vman service is running")
+    parser.add_argument(
+        '--memlimit',
+        type=int,
+        default=pvepacking.MEMLIMIT,
+        help='percentage of node memory usable by VMs on the target nodes '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--rebalance',
+        type=int,
+        default=0,
+        help='maximum migrations for balancing the cluster after the '
+             'last node (default %(default)s)')
+    _costmodelarguments(parser)
+    parser.add_argument(
+        '--hook',
+        help='command run after a node is empty, e.g. to reboot it and '
+             'wait until it is back; {node} is replaced by the node name. '
+             'Without it, vman stops after every node')
+    parser.add_argument(
+        '--state',
+        default=pverolling.STATEFILE,
+        help='file keeping the progress (default %(default)s)')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='continue the rolling maintenance from the state file, the '
+             'node emptied last is considered done unless VMs are left '
+             'on it')
+    _memmodelarguments(parser)
+    parser.add_argument(
+        'nodes',
+        nargs='?',
+        type=lambda x: x.split(','),
+        help='comma separated list of nodes in maintenance order')
+
+    args = parser.parse_args(input_args)
+
+    state = pverolling.RollingState(args.state)
+
+    if args.resume:
+        if not state.load():
+            parser.error("no rolling maintenance to resume in '{}'".format(
+                args.state))
+    elif not args.nodes:
+        parser.error('nodes are required unless --resume is given')
+    elif not args.noexec and state.load():
+        parser.error("rolling maintenance of {} in progress, continue it "
+                     "with --resume or remove '{}'".format(
+                         ','.join(state.nodes), args.state))
+    else:
+        state.nodes = args.nodes
+
+    options = {
+        'onlyha': args.onlyha,
+        'ignorenodenames': args.ignore,
+        'memlimit': args.memlimit,
+    }
+    costmodel = _costmodel(args)
+
+    try:
+        cluster = _effective(args, _rated(args, _getcluster(args)))
+
+        # the node emptied last is only done if no VM is left on it, e.g.
+        # because a migration failed
+        remaining = []
+        if state.current is not None:
+            remaining = pverolling.remaining(
+                cluster, state.current, args.onlyha, args.localdisks)
+
+        if args.noexec:
+            done = state.done + (
+                [state.current] if state.current and not remaining else [])
+            steps = pverolling.planrolling(
+                cluster, state.nodes, done, rebalance=args.rebalance,
+                constraints=_constraints(args, cluster),
+                storage=_storage(args, cluster), **options)
+
+            for name, step in steps:
+                print('##### {} #####'.format(
+                    'Rebalance' if name is None else name))
+                exec_migrate(cluster, step, args, costmodel)
+                cluster = pverolling.settle(step)
+
+            print('{} migrations in total, {} VMs migrated more '
+                  'than once'.format(*pverolling.moves(steps)))
+            return
+
+        if remaining:
+            print('Node {} still has {} VMs, emptying it again'.format(
+                state.current, len(remaining)))
+        elif args.resume:
+            state.finish()
+
+        while state.pending:
+            name = state.pending[0]
+            steps = pverolling.planrolling(
+                cluster, state.nodes, state.done,
+                constraints=_constraints(args, cluster),
+                storage=_storage(args, cluster), **options)
+
+            print('##### {} #####'.format(name))
+            state.start(name)
+            failed = exec_migrate(cluster, steps[0][1], args, costmodel)
+
+            if failed:
+                print("{} migrations from node {} failed. Fix them and "
+                      "continue with 'vman rolling --resume'".format(
+                          len(failed), name))
+                return
+
+            if args.hook is None:
+                print("Node {} is empty. Do the maintenance and continue "
+                      "with 'vman rolling --resume'".format(name))
+                return
+
+            returncode = subprocess.call(
+                args.hook.format(node=name), shell=True)
+
+            if returncode != 0:
+                print("Hook for node {} failed with exit code {}. Fix it "
+                      "and continue with 'vman rolling --resume'".format(
+                          name, returncode))
+                return
+
+            state.finish()
+            cluster = _rated(args, pvestats.buildcluster())
+            cluster.freeze()
+            cluster = _effective(args, cluster)
+
+        if args.rebalance:
+            print('##### Rebalance #####')
+            exec_migrate(cluster, pvecluster.planbalance(
+                cluster.clone(), iterations=args.rebalance,
+                ignorenodenames=args.ignore,
+                constraints=_constraints(args, cluster),
+                storage=_storage(args, cluster)), args, costmodel)
+
+        state.remove()
+    except Error as exc:
+        print('{}: {} - Aborting'.format(exc.__class__.__name__, exc.message))
+
+def command_daemon(parser, input_args):
+    """Balance VMs continuously once the imbalance persists."""
+    parser.add_argument(
+        '-v', '--verbose',
+        action=_VerbosityAction,
+        help='increase verbosity level, can be used multiple times')
+    parser.add_argument(
+        '-n', '--noexec',
+        action='store_true',
+        help='only show, don\'t migrate')
+    parser.add_argument(
+        '-i', '--ignore',
+        type=lambda x: x.split(','),
+        default=[],
+        help='comma separated list of nodes to ignore as migration targets')
+    parser.add_argument(
+        '-f', '--nofail',
+        action='store_true',
+        help="do not fail if a migration's exit code is not 0")
+    parser.add_argument(
+        '--interval',
+        type=int,
+        default=pvebalancer.INTERVAL,
+        help='seconds between evaluations (default %(default)s)')
+    parser.add_argument(
+        '--threshold',
+        type=int,
+        default=pvebalancer.THRESHOLD,
+        help='memory difference in percent that triggers balancing '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--diffperc',
+        type=int,
+        default=pvecluster.BALDIFFPERC,
+        help='memory difference in percent to balance down to '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--window',
+        type=int,
+        default=pvebalancer.WINDOW,
+        help='seconds the imbalance has to persist (default %(default)s)')
+    parser.add_argument(
+        '-c', '--count',
+        type=int,
+        default=pvebalancer.MAXMIGRATIONS,
+        help='maximum migrations per round (default %(default)s)')
+    parser.add_argument(
+        '--ratelimit',
+        type=int,
+        default=pvebalancer.RATELIMIT,
+        help='maximum migrations per hour (default %(default)s)')
+    parser.add_argument(
+        '--vmcooldown',
+        type=int,
+        default=pvebalancer.VMCOOLDOWN,
+        help='seconds a migrated VM is not moved again '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--nodecooldown',
+        type=int,
+        default=pvebalancer.NODECOOLDOWN,
+        help='seconds a node is not used for migrations after one '
+             '(default %(default)s)')
+    _constraintarguments(parser)
+    _memmodelarguments(parser)
+
+    args = parser.parse_args(input_args)
+
+    if args.diffperc >= args.threshold:
+        parser.error('--diffperc needs to be lower than --threshold')
+
+    vmconfcache = {}
+    daemon = pvebalancer.BalanceDaemon(
+        lambda cluster, newcluster: exec_migrate(cluster, newcluster, args),
+        interval=args.interval,
+        threshold=args.threshold,
+        window=args.window,
+        diffperc=args.diffperc,
+        maxmigrations=args.count,
+        ratelimit=args.ratelimit,
+        vmcooldown=args.vmcooldown,
+        nodecooldown=args.nodecooldown,
+        ignorenodenames=args.ignore,
+        builder=lambda: _effective(
+            args, pvestats.buildcluster(vmconfcache)),
+        rules=None if args.noconstraints else args.rules)
+    daemon.run()
+
 def command_status(parser, input_args):
     """Print current cluster status."""
-    parser.parse_args(input_args)
+    parser.add_argument(
+        '-d', '--direct',
+        action='store_true',
+        help="read the PVE files even if the vman service is running")
+    parser.add_argument(
+        '-w', '--watch',
+        action='store_true',
+        help='redraw the status until interrupted, reading only the '
+             'changed files')
+    parser.add_argument(
+        '-i', '--interval',
+        type=float,
+        default=1,
+        help='seconds between redraws in watch mode (default %(default)s)')
+
+    args = parser.parse_args(input_args)
 
-    cluster = pvestats.buildcluster()
-    cluster.freeze()
+    if args.watch:
+        watch_state(args.interval)
+        return
+
+    cluster = _getcluster(args)
     print_state(cluster)
 
+def command_capacity(parser, input_args):
+    """Check if the cluster can absorb the failure of any node."""
+    parser.add_argument(
+        '-d', '--direct',
+        action='store_true',
+        help="read the PVE files even if the vman service is running")
+    parser.add_argument(
+        '-a', '--all',
+        action='store_true',
+        help='restart all running VMs of a failed node, not only the '
+             'HA VMs')
+    parser.add_argument(
+        '--pairs',
+        action='store_true',
+        help='also check the failure of every pair of nodes')
+    parser.add_argument(
+        '--memlimit',
+        type=int,
+        default=pvepacking.MEMLIMIT,
+        help='percentage of node memory usable by VMs '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--cpulimit',
+        type=int,
+        help='percentage of node CPUs usable by VMs (default unlimited)')
+    parser.add_argument(
+        '--fit',
+        choices=pvepacking.FITS,
+        default=pvecapacity.FIT,
+        help='node choice for placing the VMs (default %(default)s)')
+    _constraintarguments(parser)
+    parser.add_argument(
+        '--failed',
+        action='store_true',
+        help='only show the failure scenarios the cluster cannot absorb')
+    _memmodelarguments(parser)
+
+    args = parser.parse_args(input_args)
+
+    cluster = _effective(args, _getcluster(args))
+    constraints = _constraints(args, cluster)
+    scenarios = []
+
+    for size in (1, 2) if args.pairs else (1,):
+        scenarios += pvecapacity.analyze(
+            cluster, size, onlyha=not args.all, memlimit=args.memlimit,
+            cpulimit=args.cpulimit, fit=args.fit, constraints=constraints)
+
+    failed = [s for s in scenarios if not s.ok]
+    shown = failed if args.failed else scenarios
+
+    if shown:
+        print_capacity(shown)
+
+    print('{} of {} failure scenarios can not be absorbed'.format(
+        len(failed), len(scenarios)))
+
+    if failed:
+        sys.exit(1)
+
+def command_service(parser, input_args):
+    """Answer status and plan queries on a unix socket."""
+    parser.add_argument(
+        '-v', '--verbose',
+        action=_VerbosityAction,
+        help='increase verbosity level, can be used multiple times')
+    parser.add_argument(
+        '-s', '--socket',
+        default=pveservice.SOCKETPATH,
+        help='path of the unix socket (default %(default)s)')
+    parser.add_argument(
+        '-i', '--interval',
+        type=int,
+        default=pveservice.REFRESHINTERVAL,
+        help='seconds between cluster refreshes (default %(default)s)')
+    parser.add_argument(
+        '--history',
+        help='record cluster snapshots in the given history file, e.g. '
+             '{}'.format(pvehistory.HISTORYFILE))
+    parser.add_argument(
+        '--history-interval',
+        dest='historyinterval',
+        type=int,
+        default=pvehistory.INTERVAL,
+        help='minimum seconds between recorded snapshots '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--history-keep',
+        dest='historykeep',
+        type=int,
+        default=pvehistory.KEEP,
+        help='seconds recorded snapshots are kept (default %(default)s)')
+
+    args = parser.parse_args(input_args)
+
+    history = None
+    if args.history:
+        history = pvehistory.History(
+            args.history, args.historyinterval, args.historykeep)
+
+    pveservice.serve(args.socket, args.interval, history)
+
+def command_history(parser, input_args):
+    """Record cluster snapshots and show the aggregated usage."""
+    parser.add_argument(
+        '-v', '--verbose',
+        action=_VerbosityAction,
+        help='increase verbosity level, can be used multiple times')
+    parser.add_argument(
+        '-f', '--file',
+        dest='history',
+        default=pvehistory.HISTORYFILE,
+        help='history file (default %(default)s)')
+    parser.add_argument(
+        '-r', '--record',
+        action='store_true',
+        help='record a snapshot of the current cluster, e.g. from cron')
+    parser.add_argument(
+        '-w', '--window',
+        type=int,
+        default=pvehistory.WINDOW,
+        help='seconds the usage is aggregated over (default %(default)s)')
+    parser.add_argument(
+        '-s', '--stat',
+        type=_statistic,
+        default='mean',
+        help='aggregation of the usage over the window: mean, min, max '
+             'or pNN for a percentile (default %(default)s)')
+    parser.add_argument(
+        '--source',
+        choices=('history', 'rrd'),
+        default='history',
+        help='read the usage from the history file or the PVE RRD files, '
+             'which only keep averages (default %(default)s)')
+    parser.add_argument(
+        '-d', '--direct',
+        action='store_true',
+        help="read the PVE files even if the vman service is running")
+
+    args = parser.parse_args(input_args)
+
+    try:
+        cluster = _getcluster(args)
+
+        if args.record:
+            pvehistory.History(args.history, interval=0).append(cluster)
+            return
+
+        print_state(_smoothed(args, cluster))
+    except Error as exc:
+        print('{}: {} - Aborting'.format(exc.__class__.__name__, exc.message))
+
 def command_vmiostat(parser, input_args):
     """Print IO stats per VM and sum."""
     def over_zero(value):
@@ -304,10 +1589,73 @@ def command_vmiostat(parser, input_args):
         dest='ssum',
         action='store_true',
         help='show summary only')
+    parser.add_argument(
+        '--sort',
+        choices=('vmid',) + pvevmiostats.VMIOStats.keys,
+        default='vmid',
+        help='sort the VMs by ID or descending by the given rate '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--cluster',
+        action='store_true',
+        help='show the VMs of all nodes, read from the vmiostat agents '
+             'running on them')
+    parser.add_argument(
+        '--agents',
+        type=_agents,
+        help='comma separated host[:port] list of the agents to read with '
+             '--cluster (default all cluster nodes at port {})'.format(
+                 pvevmiostats.AGENTPORT))
+    parser.add_argument(
+        '--agent',
+        action='store_true',
+        help='run as agent streaming the stats of the local VMs every '
+             'interval to the vmiostat --cluster front ends')
+    parser.add_argument(
+        '--listen',
+        type=_listen,
+        help='[address]:port the agent listens on, :port for all '
+             'addresses (default the address of the node name, port '
+             '{})'.format(pvevmiostats.AGENTPORT))
 
     args = parser.parse_args(input_args)
 
-    print_vmiostat(**dict(args._get_kwargs()))
+    if args.agent:
+        pvevmiostats.serve(args.listen, args.interval)
+        return
+
+    agents = None
+    if args.cluster or args.agents:
+        agents = args.agents or [(n, pvevmiostats.AGENTPORT)
+                                 for n in pvefiles.nodes()]
+
+    print_vmiostat(args.interval, args.count, args.limit, args.totals,
+                   args.ssum, agents, args.sort)
+
+def command_exporter(parser, input_args):
+    """Serve cluster, node and VM metrics for Prometheus."""
+    parser.add_argument(
+        '-v', '--verbose',
+        action=_VerbosityAction,
+        help='increase verbosity level, can be used multiple times')
+    parser.add_argument(
+        '-l', '--listen',
+        type=_listen,
+        default=pveexporter.LISTEN,
+        help='[address]:port to listen on (default :9118)')
+    parser.add_argument(
+        '-i', '--interval',
+        type=int,
+        default=pverefresh.REFRESHINTERVAL,
+        help='seconds between cluster refreshes (default 30)')
+    parser.add_argument(
+        '--noiostats',
+        action='store_true',
+        help="don't export block device counters of local VMs")
+
+    args = parser.parse_args(input_args)
+
+    pveexporter.serve(args.listen, args.interval, not args.noiostats)
 
 def command_version(*_):
     """Print version information of vman."""
@@ -317,6 +1665,14 @@ def command_version(*_):
 def vman():
     """CLI main function for vman utility."""
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='print the time spent per phase to stderr')
+    parser.add_argument(
+        '--profile-out',
+        dest='profileout',
+        help='also write cProfile statistics to the given file')
 
     subparsers = parser.add_subparsers(
         dest='command',
@@ -330,10 +1686,38 @@ def vman():
         'flush',
         add_help=False,
         help='migrate VMs from the given node')
+    subparsers.add_parser(
+        'apply',
+        add_help=False,
+        help='migrate VMs according to a plan written with --plan-out')
+    subparsers.add_parser(
+        'rolling',
+        add_help=False,
+        help='empty nodes one after another for maintenance')
+    subparsers.add_parser(
+        'daemon',
+        add_help=False,
+        help='balance VMs continuously when the imbalance persists')
+    subparsers.add_parser(
+        'exporter',
+        add_help=False,
+        help='serve cluster metrics for Prometheus')
+    subparsers.add_parser(
+        'service',
+        add_help=False,
+        help='answer status and plan queries on a unix socket')
     subparsers.add_parser(
         'status',
         add_help=False,
         help='show the current cluster status')
+    subparsers.add_parser(
+        'history',
+        add_help=False,
+        help='record cluster snapshots and show the aggregated usage')
+    subparsers.add_parser(
+        'capacity',
+        add_help=False,
+        help='check if the cluster can absorb the failure of any node')
     subparsers.add_parser(
         'version',
         add_help=False,
@@ -357,7 +1741,21 @@ def vman():
 
     signal.signal(signal.SIGINT, signal_handler)
 
-    func(cmd_parser, exceding_args)
+    if not args.profile and args.profileout is None:
+        func(cmd_parser, exceding_args)
+        return
+
+    profiler = pveprofile.Profiler()
+    profiler.enable(cprofile=args.profileout is not None)
+
+    try:
+        func(cmd_parser, exceding_args)
+    finally:
+        profiler.disable()
+        sys.stderr.write(profiler.report() + '\n')
+
+        if args.profileout is not None:
+            profiler.dump(args.profileout)
 
 
 def vmiostat():
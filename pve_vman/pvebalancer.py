@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides a balancing loop that watches the memory
+distribution of the cluster and plans a limited number of migrations
+once the imbalance stays above a threshold for a given time. VMs and
+nodes involved in a migration are put on a cooldown to prevent them
+from being moved back and forth.
+"""
+
+import collections
+import logging
+import time
+
+from pve_vman import pvecluster, pveconstraints, pvestats
+from pve_vman.exceptions import Error
+
+
+INTERVAL = 60
+"""Default number of seconds between two evaluations."""
+
+THRESHOLD = 10
+"""Default memory percentage difference that triggers balancing."""
+
+WINDOW = 300
+"""Default number of seconds the imbalance has to persist."""
+
+MAXMIGRATIONS = 3
+"""Default maximum number of migrations per balancing round."""
+
+RATELIMIT = 10
+"""Default maximum number of migrations per hour."""
+
+VMCOOLDOWN = 3600
+"""Default number of seconds a migrated VM is not moved again."""
+
+NODECOOLDOWN = 600
+"""Default number of seconds a node involved in a migration is
+neither source nor target of another one."""
+
+
+def imbalance(cluster, attr='memvmnodeused_perc', ignorenodenames=None):
+    """Return the difference of the given attribute between the highest
+    and the lowest online node.
+    """
+    if ignorenodenames is None:
+        ignorenodenames = []
+
+    nodefilter = lambda n: n.isonline and n.id not in ignorenodenames
+    highestnode = cluster.highestnode(attr, nodefilter)
+    lowestnode = cluster.lowestnode(attr, nodefilter)
+
+    if highestnode is None or lowestnode is None:
+        return 0
+
+    return getattr(highestnode, attr) - getattr(lowestnode, attr)
+
+
+class BalanceDaemon(object):
+    """Keeps the hysteresis, cooldown and rate limit state between
+    balancing rounds. The execute callable is called with the current
+    and the planned cluster object and is expected to run the
+    migrations. By default the cluster is rebuilt every round with the
+    VM configs cached in between, so only changed configs are parsed
+    again. Unless rules is None, the HA groups and the placement rules
+    read from the rules file are honoured (see pveconstraints).
+    """
+    def __init__(self, execute, interval=INTERVAL, threshold=THRESHOLD,
+                 window=WINDOW, diffperc=pvecluster.BALDIFFPERC,
+                 maxmigrations=MAXMIGRATIONS, ratelimit=RATELIMIT,
+                 vmcooldown=VMCOOLDOWN, nodecooldown=NODECOOLDOWN,
+                 ignorenodenames=None, builder=None, clock=None,
+                 rules=pveconstraints.RULESFILE):
+        if ignorenodenames is None:
+            ignorenodenames = []
+
+        self.execute = execute
+        self.interval = interval
+        self.threshold = threshold
+        self.window = window
+        self.diffperc = diffperc
+        self.maxmigrations = maxmigrations
+        self.ratelimit = ratelimit
+        self.vmcooldown = vmcooldown
+        self.nodecooldown = nodecooldown
+        self.ignorenodenames = ignorenodenames
+        self.clock = clock or time.time
+        self.rules = rules
+
+        self.cluster = None
+        self.vmconfcache = {}
+        self.builder = builder or (
+            lambda: pvestats.buildcluster(self.vmconfcache))
+        self.abovesince = None
+        self.vmcooldowns = {}
+        self.nodecooldowns = {}
+        self.history = collections.deque()
+
+    def _cooling(self, cooldowns, now):
+        """Drop expired entries and return the ids still cooling."""
+        for key, until in list(cooldowns.items()):
+            if until <= now:
+                del cooldowns[key]
+
+        return list(cooldowns.keys())
+
+    def budget(self, now):
+        """Return the number of migrations allowed in this round with
+        regard to the per round maximum and the hourly rate limit.
+        """
+        while self.history and self.history[0] <= now - 3600:
+            self.history.popleft()
+
+        return max(0, min(self.maxmigrations,
+                          self.ratelimit - len(self.history)))
+
+    def record(self, migrations, now):
+        """Put VMs and nodes of the given migrations on cooldown and
+        count them for the rate limit.
+        """
+        for migration in migrations:
+            self.vmcooldowns[migration.pvevm.id] = now + self.vmcooldown
+            self.nodecooldowns[migration.source] = now + self.nodecooldown
+            self.nodecooldowns[migration.target] = now + self.nodecooldown
+            self.history.append(now)
+
+    def step(self):
+        """Refresh the cluster and run a balancing round if the
+        imbalance was above the threshold for the whole window. Return
+        the number of planned migrations. If the cluster can't be built,
+        e.g. while the PVE files are rewritten, the round is skipped.
+        """
+        _logger = logging.getLogger(__name__)
+        now = self.clock()
+
+        try:
+            cluster = self.builder()
+            cluster.freeze()
+        except (Error, EnvironmentError, ValueError, KeyError) as exc:
+            _logger.warning('cluster refresh failed, skipping round: %s',
+                            exc)
+            return 0
+
+        self.cluster = cluster
+
+        current = imbalance(
+            self.cluster, ignorenodenames=self.ignorenodenames)
+
+        if current < self.threshold:
+            if self.abovesince is not None:
+                _logger.info('imbalance %d%% below threshold again', current)
+            self.abovesince = None
+            return 0
+
+        if self.abovesince is None:
+            _logger.info('imbalance %d%% above threshold', current)
+            self.abovesince = now
+
+        if now - self.abovesince < self.window:
+            _logger.debug('imbalance %d%% above threshold for %ds',
+                          current, now - self.abovesince)
+            return 0
+
+        budget = self.budget(now)
+
+        if budget < 1:
+            _logger.info('rate limit reached, postponing balancing')
+            return 0
+
+        ignorenodes = set(self.ignorenodenames)
+        ignorenodes.update(self._cooling(self.nodecooldowns, now))
+        ignorevms = self._cooling(self.vmcooldowns, now)
+
+        try:
+            constraints = None
+            if self.rules is not None:
+                constraints = pveconstraints.buildindex(
+                    self.cluster, self.rules)
+            newcluster = pvecluster.planbalance(
+                self.cluster.clone(),
+                iterations=budget,
+                diffperc=self.diffperc,
+                ignorenodenames=[n for n in ignorenodes
+                                 if n in self.cluster.keys()],
+                ignorevmids=ignorevms,
+                constraints=constraints)
+        except Error as exc:
+            _logger.warning('%s: %s', exc.__class__.__name__, exc)
+            return 0
+
+        # Migrations that failed are put on cooldown as well, so a
+        # broken VM doesn't block the balancing of the other ones.
+        migrations = newcluster.migrations()
+        self.record(migrations, now)
+        self.abovesince = None
+
+        try:
+            self.execute(self.cluster, newcluster)
+        except Error as exc:
+            _logger.warning('%s: %s', exc.__class__.__name__, exc)
+
+        return len(migrations)
+
+    def run(self, rounds=0):
+        """Run balancing rounds every interval seconds. If rounds is
+        given, stop after that many rounds.
+        """
+        i = 0
+
+        while rounds == 0 or i < rounds:
+            i += 1
+            start = self.clock()
+            self.step()
+            time.sleep(max(0, self.interval - (self.clock() - start)))
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides a benchmark of parsing the PVE files, building
+and cloning the cluster, planning and printing on synthetic clusters
+(see pvesynth) of different sizes. The results are appended to a JSON
+lines file so runs can be compared. Run it with:
+
+    python -m pve_vman.pvebench --sizes 10x100,50x5000 --compare
+
+With --startup, it checks that starting the command line tools stays
+within a time budget instead.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pve_vman import cli, pvefiles, pvestats, pvecluster, pvesynth
+from pve_vman._version import __version__
+
+
+SIZES = '10x100,50x1000,200x10000'
+"""Default cluster sizes as nodes x guests."""
+
+REPEAT = 3
+"""Default number of runs per phase, the fastest one counts."""
+
+RESULTS = 'pvebench.jsonl'
+"""Default file the results are appended to."""
+
+PHASES = ('parse', 'build', 'clone', 'balance', 'flush', 'print')
+"""Names of the timed phases in order."""
+
+STARTUPBUDGET = 50
+"""Default milliseconds importing the cli module may take on top of
+starting the interpreter.
+"""
+
+EAGERMODULES = ('pve_vman', 'pve_vman._lazy', 'pve_vman._version',
+                'pve_vman.cli', 'pve_vman.exceptions')
+"""The only modules of the package importing the cli module may import,
+all others are imported on first use.
+"""
+
+
+def parsesizes(value):
+    """Return list of (nodes, guests) tuples of the comma separated
+    NODESxGUESTS value. Raise ValueError if it is malformed.
+    """
+    sizes = []
+
+    for size in value.split(','):
+        nodes, _, guests = size.strip().partition('x')
+        sizes.append((int(nodes), int(guests)))
+
+    return sizes
+
+def _timeit(func, repeat):
+    best = None
+
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+
+    return best
+
+def _printstate(cluster):
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            cli.print_state(cluster)
+        finally:
+            sys.stdout = stdout
+
+def phases(cluster, nodenames):
+    """Return dictionary of the functions of the phases to time on the
+    cluster built from the current pvefiles.BASEPATH by name.
+    """
+    def parse():
+        pvefiles.vmconf()
+        pvefiles.storageconf()
+        pvefiles.stats()
+        pvefiles.haconf()
+
+    def build():
+        pvestats.buildcluster().freeze()
+
+    return {
+        'parse': parse,
+        'build': build,
+        'clone': cluster.clone,
+        'balance': lambda: pvecluster.planbalance(cluster.clone()),
+        'flush': lambda: pvecluster.planflush(
+            nodenames[:1], cluster.clone(),
+            maxmigrations=len(cluster.vms())),
+        'print': lambda: _printstate(cluster),
+    }
+
+def run(nodes, guests, repeat=REPEAT, seed=1, keep=None):
+    """Generate a cluster of the given size, time all phases and return
+    the result as dictionary. The tree is generated in a temporary
+    directory that is removed afterwards unless keep, a path to
+    generate it in, is given.
+    """
+    basepath = keep or tempfile.mkdtemp(prefix='pvebench-')
+    oldbasepath = pvefiles.BASEPATH
+
+    try:
+        nodenames = pvesynth.generate(basepath, nodes, guests, seed)
+        pvefiles.BASEPATH = basepath
+        cluster = pvestats.buildcluster()
+        cluster.freeze()
+        funcs = phases(cluster, nodenames)
+        timings = dict((n, _timeit(funcs[n], repeat)) for n in PHASES)
+    finally:
+        pvefiles.BASEPATH = oldbasepath
+        if keep is None:
+            shutil.rmtree(basepath)
+
+    return {
+        'created': int(time.time()),
+        'version': __version__,
+        'python': platform.python_version(),
+        'size': '{}x{}'.format(nodes, guests),
+        'seed': seed,
+        'timings': timings,
+    }
+
+def _python(code):
+    """Return the command and the environment running the given code in
+    a new interpreter that imports this package.
+    """
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    return ([sys.executable, '-c', code], env)
+
+def startup(repeat=10):
+    """Return a tuple of the milliseconds importing the cli module takes
+    on top of starting the interpreter and the list of the modules of
+    the package it imports.
+    """
+    def runtime(code):
+        command, env = _python(code)
+        return _timeit(lambda: subprocess.check_call(command, env=env),
+                       repeat)
+
+    overhead = runtime('import pve_vman.cli') - runtime('pass')
+    command, env = _python(
+        'import sys, pve_vman.cli; sys.stdout.write(" ".join(m for m in '
+        'sys.modules if m.startswith("pve_vman") and sys.modules[m]))')
+    output = subprocess.check_output(command, env=env)
+
+    return (overhead * 1000, sorted(output.decode().split()))
+
+def loadresults(path):
+    """Return the list of results stored in the given file."""
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as resultsfile:
+        return [json.loads(line) for line in resultsfile if line.strip()]
+
+def saveresult(path, result):
+    """Append the result to the given file."""
+    with open(path, 'a') as resultsfile:
+        resultsfile.write(json.dumps(result, sort_keys=True) + '\n')
+
+def report(result, previous=None):
+    """Return the result formatted as text, with the change in percent
+    to the previous result of the same size if given.
+    """
+    lines = ['{} guests on {} nodes'.format(
+        *reversed(result['size'].split('x')))]
+
+    for name in PHASES:
+        duration = result['timings'][name]
+        line = '  {:8s} {:9.1f}ms'.format(name, duration * 1000)
+
+        if previous is not None and previous['timings'].get(name):
+            change = (duration / previous['timings'][name] - 1) * 100
+            line += ' {:+7.1f}%'.format(change)
+
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+def main(argv=None):
+    """Run the benchmark as command line program."""
+    parser = argparse.ArgumentParser(prog='python -m pve_vman.pvebench')
+    parser.add_argument(
+        '-s', '--sizes',
+        type=parsesizes,
+        default=parsesizes(SIZES),
+        help='comma separated cluster sizes as NODESxGUESTS '
+             '(default %s)' % SIZES)
+    parser.add_argument(
+        '-r', '--repeat',
+        type=int,
+        default=REPEAT,
+        help='runs per phase, the fastest counts (default %(default)s)')
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=1,
+        help='seed of the generated clusters (default %(default)s)')
+    parser.add_argument(
+        '-o', '--results',
+        default=RESULTS,
+        help='file the results are appended to (default %(default)s)')
+    parser.add_argument(
+        '-c', '--compare',
+        action='store_true',
+        help='show the change to the last stored run of the same size')
+    parser.add_argument(
+        '--keep',
+        help='generate the clusters below this directory and keep them')
+    parser.add_argument(
+        '--startup',
+        action='store_true',
+        help='only check the startup time of the command line tools, '
+             'fail if it exceeds the budget or imports more modules '
+             'than necessary')
+    parser.add_argument(
+        '--budget',
+        type=float,
+        default=STARTUPBUDGET,
+        help='startup time budget in milliseconds (default %(default)s)')
+
+    args = parser.parse_args(argv)
+    previous = {}
+
+    if args.startup:
+        overhead, modules = startup(args.repeat)
+        extra = [m for m in modules if m not in EAGERMODULES]
+        print('startup {:.1f}ms (budget {:.1f}ms)'.format(
+            overhead, args.budget))
+        saveresult(args.results, {
+            'created': int(time.time()),
+            'version': __version__,
+            'python': platform.python_version(),
+            'size': 'startup',
+            'timings': {'startup': overhead / 1000},
+        })
+
+        if extra:
+            print('modules imported on startup: {}'.format(', '.join(extra)))
+        if extra or overhead > args.budget:
+            sys.exit(1)
+        return
+
+    if args.compare:
+        for result in loadresults(args.results):
+            previous[result['size']] = result
+
+    for nodes, guests in args.sizes:
+        keep = None
+        if args.keep:
+            keep = os.path.join(args.keep, '{}x{}'.format(nodes, guests))
+
+        result = run(nodes, guests, args.repeat, args.seed, keep)
+        print(report(result, previous.get(result['size'])))
+        saveresult(args.results, result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides adaptive bandwidth limits for migrations. Before
+every migration, the network load of its source and target node is
+evaluated and the migration gets the bandwidth that is left on the
+busier of both, reduced by the IO wait of the nodes and shared evenly
+with the other migrations running or about to start on them. The load
+is derived from the network counters of the node status between two
+evaluations, without the traffic of the migrations that finished in
+between, or from the averages of the PVE RRD files before the first
+one.
+
+Migrations of HA managed VMs are not limited: PVE hands them to the HA
+manager, which ignores the bwlimit option, and the request returns
+before the migration is done.
+"""
+
+from __future__ import division
+
+import threading
+
+from pve_vman import pvefiles, pverrd
+
+
+CAPACITY = 1250 * 1000 ** 2
+"""Default network capacity of the nodes in bytes per second (10GbE)."""
+
+MINIMUM = 50 * 1024 ** 2
+"""Default lowest bandwidth limit in bytes per second."""
+
+IOWAITLIMIT = 0.3
+"""IO wait ratio of a node at which only the lowest bandwidth limit is
+left for migrations.
+"""
+
+LOADWINDOW = 300
+"""Seconds of the PVE RRD files averaged for the initial node load."""
+
+
+class BandwidthLimiter(object):
+    """Hands out bandwidth limits in KiB/s for migrations, the unit of
+    the bwlimit option of the PVE API. acquire has to be called before
+    and release after every migration. Migrations started at the same
+    time are announced with expect first, so they get equal shares. It
+    can be used from several threads.
+
+    Example:
+        limiter = BandwidthLimiter()
+        limiter.expect(wave)
+        migration.setbwlimit(limiter.acquire(migration))
+        migration.run()
+        limiter.release(migration)
+    """
+    def __init__(self, capacity=CAPACITY, minimum=MINIMUM,
+                 iowaitlimit=IOWAITLIMIT, rrddir=pverrd.RRDDIR):
+        self.capacity = capacity
+        self.minimum = minimum
+        self.iowaitlimit = iowaitlimit
+        self.rrddir = rrddir
+
+        self.counters = {}
+        self.rates = {}
+        self.iowait = {}
+        self.running = {}
+        self.expected = {}
+        self.moved = {}
+        self.lock = threading.Lock()
+
+    def initialrate(self, nodename):
+        """Return the network rate of the node averaged over the last
+        LOADWINDOW seconds by its RRD file, 0 if it is unknown.
+        """
+        try:
+            averages = pverrd.nodeaverages(
+                nodename, LOADWINDOW, rrddir=self.rrddir)
+        except Exception:
+            return 0
+
+        if not averages:
+            return 0
+
+        return sum([averages.get(a) or 0 for a in ('netin', 'netout')])
+
+    def update(self):
+        """Read the node status and update the network rates and IO wait
+        ratios of the nodes whose status changed since the last update.
+        """
+        for node in pvefiles.stats().get('node', []):
+            name = node['node']
+            counters = (node['timestamp'], node['netin'] + node['netout'])
+            last = self.counters.get(name)
+            self.iowait[name] = node['iowait']
+
+            if last is None:
+                self.counters[name] = counters
+                self.rates[name] = self.initialrate(name)
+            elif counters[0] > last[0]:
+                transferred = counters[1] - last[1] - self.moved.pop(name, 0)
+                self.counters[name] = counters
+                self.rates[name] = max(0, transferred) / (
+                    counters[0] - last[0])
+
+    def available(self, nodename):
+        """Return the bandwidth in bytes per second the node has left for
+        migrations.
+        """
+        free = self.capacity - self.rates.get(nodename, 0)
+        iowait = min(self.iowait.get(nodename, 0) / self.iowaitlimit, 1)
+
+        return max(free * (1 - iowait), 0)
+
+    def expect(self, migrations):
+        """Count the given migrations as about to start, so acquire
+        splits the bandwidth of their nodes evenly among all of them
+        instead of giving the first one the most.
+        """
+        with self.lock:
+            for migration in migrations:
+                for node in (migration.source, migration.target):
+                    self.expected[node] = self.expected.get(node, 0) + 1
+
+    def acquire(self, migration):
+        """Return the bandwidth limit in KiB/s for the migration and
+        count it as running on its source and target node. The bandwidth
+        a node has left is split among its running and its expected
+        migrations.
+        """
+        nodes = (migration.source, migration.target)
+
+        with self.lock:
+            self.update()
+            shares = dict(
+                (n, self.running.get(n, 0) + max(self.expected.get(n, 0), 1))
+                for n in nodes)
+            limit = min([self.available(n) / shares[n] for n in nodes])
+
+            for node in nodes:
+                self.running[node] = self.running.get(node, 0) + 1
+                if self.expected.get(node):
+                    self.expected[node] -= 1
+
+        return int(max(limit, self.minimum) // 1024)
+
+    def release(self, migration):
+        """Count the migration as finished. The memory and local disks of
+        its VM are subtracted from the traffic of its nodes at their next
+        update.
+        """
+        pvevm = migration.pvevm
+        transferred = pvevm.attrs.get('mem') or 0
+        if pvevm.attrs.get('localmigrateable'):
+            transferred += pvevm.attrs.get('localdisksize') or 0
+
+        with self.lock:
+            for node in (migration.source, migration.target):
+                self.running[node] -= 1
+                self.moved[node] = self.moved.get(node, 0) + transferred
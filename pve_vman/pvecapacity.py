@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides the N-1 (and N-2) failover capacity analysis of
+a cluster: for the failure of every node, or pair of nodes, the VMs
+that would be restarted elsewhere are placed onto the remaining nodes
+with the bin packing of pvepacking. The items and bins are built once
+per cluster and reused for all failure scenarios.
+"""
+
+from __future__ import division
+
+import itertools
+
+from pve_vman import pveconstraints, pvepacking
+
+
+FIT = 'worst'
+"""Default fit for placing the VMs, worst fit spreads them across the
+nodes like the HA manager does.
+"""
+
+
+class Scenario(object):
+    """Result of the failure of one or more nodes: the failed node ids,
+    the VMs to place, the unplaced ones and the remaining bins.
+    """
+    def __init__(self, failed, items, unplaced, remaining):
+        self.failed = failed
+        self.items = items
+        self.unplaced = unplaced
+        self.remaining = remaining
+
+    @property
+    def ok(self):
+        """Return if all VMs could be placed."""
+        return not self.unplaced
+
+    @property
+    def needed(self):
+        """Return the memory of all VMs to place."""
+        return sum([i[1] for i in self.items])
+
+    @property
+    def missing(self):
+        """Return the memory of the VMs that could not be placed."""
+        return sum([i[1] for i in self.unplaced])
+
+    @property
+    def headroom(self):
+        """Return the free memory of the remaining nodes after placing
+        the VMs.
+        """
+        return sum([max(b[1], 0) for b in self.remaining])
+
+    @property
+    def tightest(self):
+        """Return the remaining bin with the least free memory."""
+        if not self.remaining:
+            return None
+        return min(self.remaining, key=lambda b: (b[1], b[0]))
+
+    @property
+    def overflow(self):
+        """Return the id of the node that would overflow first, i.e. the
+        one with the most free memory left when the first VM does not
+        fit anymore, or None if all VMs fit.
+        """
+        if self.ok or not self.remaining:
+            return None
+        return max(self.remaining, key=lambda b: (b[1], b[0]))[0]
+
+
+def failures(nodeids, size=1):
+    """Return all combinations of size node ids to fail."""
+    return list(itertools.combinations(sorted(nodeids), size))
+
+def analyze(cluster, size=1, onlyha=True, memlimit=pvepacking.MEMLIMIT,
+            cpulimit=None, fit=FIT, constraints=None):
+    """Return a list of Scenario objects, one for the failure of every
+    combination of size online nodes. With onlyha, only the running HA
+    VMs are restarted on other nodes, else all running VMs. Without a
+    cpulimit, the CPUs of the nodes are not limited. With constraints
+    (see pveconstraints), the VMs are only placed on the nodes their HA
+    group and the placement rules allow with the failed nodes offline.
+    """
+    nodes = cluster.nodes(lambda n: n.isonline)
+    items = {}
+    bins = {}
+
+    for node in nodes:
+        items[node.id] = [
+            pvepacking.vmitem(v) for v in node.vms()
+            if v.isonline and (v.ha or not onlyha)]
+        nodeid, memfree, cpufree = pvepacking.nodebin(
+            node, memlimit, cpulimit or 0)
+        bins[node.id] = (
+            nodeid, memfree, cpufree if cpulimit else float('inf'))
+
+    order = sorted(bins.keys())
+    scenarios = []
+
+    for failed in failures(order, size):
+        faileditems = [i for f in failed for i in items[f]]
+        index = None
+
+        if constraints is not None:
+            index = pveconstraints.ConstraintIndex(
+                cluster, constraints.groups, constraints.rules, failed)
+            index.evacuate(failed)
+
+        _, unplaced, remaining = pvepacking.pack(
+            faileditems, [bins[n] for n in order if n not in failed], fit,
+            index)
+        scenarios.append(Scenario(failed, faileditems, unplaced, remaining))
+
+    return scenarios
@@ -28,23 +28,71 @@ or balancing VMs across all nodes.
 
 import logging
 
+from pve_vman import pveoptimize, pvepacking, pveresources
 from pve_vman.exceptions import InputError, PlanningError
 
 
 MAXMIGRATIONS = 150
 BALDIFFPERC = 5
+MINIMPROVE = 0.0001
 
 
+def _bycost(vms, costmodel, source, target):
+    """Return the VMs ordered by decreasing estimated migration time per
+    memory that helps evening the memory usage of the source and the
+    target node. Memory above the amount that evens both nodes doesn't
+    help and is not counted.
+    """
+    ideal = ((source.memvmused * target.memtotal
+              - target.memvmused * source.memtotal)
+             / float(source.memtotal + target.memtotal))
+
+    def costperbyte(pvevm):
+        useful = max(min(pvevm.mem, ideal), 1)
+        return costmodel.estimate(pvevm) / useful
+
+    return sorted(vms, key=lambda vm: (costperbyte(vm), vm.id), reverse=True)
+
+def _candidates(source, target, ignorevmids, constraints, storage=None):
+    """Return the VMs of the source node that may be moved to the target
+    node, the ones that already have been moved if there are any.
+    """
+    def movable(pvevm):
+        if pvevm.id in ignorevmids:
+            return False
+        if storage is not None and not storage.allows(pvevm, target):
+            return False
+        return constraints is None or constraints.allows(pvevm, target)
+
+    vms = [vm for vm in source.moved_vms() if movable(vm)]
+
+    if not vms:
+        vms = [vm for vm in source.migrateable_vms(storage is not None)
+               if movable(vm)]
+
+    return vms
+
 def planbalance(cluster, iterations=MAXMIGRATIONS, diffperc=BALDIFFPERC,
-                ignorenodenames=None):
+                ignorenodenames=None, ignorevmids=None, costmodel=None,
+                constraints=None, storage=None):
     """Migrate VMs in order to even the memory usage percentage on the
-    nodes. The given cluster is changed.
+    nodes. VMs with an id in ignorevmids are not moved. If a costmodel
+    (see pvecost) is given, the VM with the lowest estimated migration
+    time per usefully moved memory is chosen in every step. With
+    constraints (see pveconstraints), VMs are only moved to nodes the
+    index allows, if none of the VMs may go to the lowest node, the next
+    lowest one is tried. With a storage index (see pvestorage), VMs with
+    local disks are moved too, to nodes with enough space left on their
+    storages. The given cluster is changed.
     """
     _logger = logging.getLogger(__name__)
 
     if ignorenodenames is None:
         ignorenodenames = []
 
+    if ignorevmids is None:
+        ignorevmids = []
+
     def nodediff(diffattr, node1, node2):
         diff = getattr(node1, diffattr) - getattr(node2, diffattr)
         return abs(diff)
@@ -79,10 +127,27 @@ def planbalance(cluster, iterations=MAXMIGRATIONS, diffperc=BALDIFFPERC,
         if diffperc > nodediff(attr, highestnode, lowestnode):
             break
 
-        vms = highestnode.moved_vms()
+        vms = _candidates(
+            highestnode, lowestnode, ignorevmids, constraints, storage)
+
+        if not vms and (constraints is not None or storage is not None):
+            targets = sorted(
+                cluster.nodes(lambda n: nodefilter(n) and diffperc
+                              <= nodediff(attr, highestnode, n)),
+                key=lambda n: (getattr(n, attr), n.id))
+
+            for lowestnode in targets:
+                vms = _candidates(highestnode, lowestnode, ignorevmids,
+                                  constraints, storage)
+
+                if vms:
+                    break
 
         if not vms:
-            vms = highestnode.migrateable_vms()
+            raise PlanningError('no VM found to migrate')
+
+        if costmodel is not None:
+            vms = _bycost(vms, costmodel, highestnode, lowestnode)
 
         curvm = vms.pop()
         _logger.debug(str(curvm))
@@ -90,12 +155,168 @@ def planbalance(cluster, iterations=MAXMIGRATIONS, diffperc=BALDIFFPERC,
         highestnode.remove(curvm)
         lowestnode.add(curvm)
 
+        if constraints is not None:
+            constraints.move(curvm, lowestnode)
+
+        if storage is not None:
+            storage.move(curvm, lowestnode)
+
+    return cluster
+
+def planmultibalance(cluster, weights=None, iterations=MAXMIGRATIONS,
+                     diffperc=BALDIFFPERC, ignorenodenames=None,
+                     ignorevmids=None, constraints=None):
+    """Migrate VMs in order to even the usage of memory, CPU, disk IO
+    and network on the nodes. The dimensions are weighted by the given
+    weights dictionary (see pveresources). With constraints (see
+    pveconstraints), VMs are only moved to nodes the index allows. The
+    given cluster is changed.
+    """
+    _logger = logging.getLogger(__name__)
+
+    if ignorenodenames is None:
+        ignorenodenames = []
+
+    if ignorevmids is None:
+        ignorevmids = []
+
+    ignorenodes = []
+
+    for node in ignorenodenames:
+        if node not in cluster.keys():
+            raise InputError("node '{}' doesn't exist".format(node))
+
+        ignorenodes.append(cluster[node])
+
+    nodes = cluster.nodes(lambda n: n.isonline and n not in ignorenodes)
+
+    if len(nodes) < 2:
+        raise PlanningError('no node found to migrate to')
+
+    model = pveresources.ResourceModel(nodes, weights)
+    _logger.info('resource score before balancing: %.4f', model.score)
+
+    # In every iteration, find the move with the best score improvement
+    # off the most overloaded node. Only if that node has no move that
+    # improves the score, the other nodes are considered as source.
+
+    for _ in range(iterations):
+        if model.deviation() < diffperc:
+            break
+
+        best = None
+        sources = sorted(nodes, key=lambda n: model.overload(n.id),
+                         reverse=True)
+
+        for source in sources:
+            for pvevm in source.migrateable_vms():
+                if pvevm.id in ignorevmids:
+                    continue
+
+                for target in nodes:
+                    if target is source or constraints is not None \
+                            and not constraints.allows(pvevm, target):
+                        continue
+
+                    delta = model.delta(pvevm.id, source.id, target.id)
+
+                    if best is None or delta < best[0]:
+                        best = (delta, pvevm, source, target)
+
+            if best is not None and best[0] < -MINIMPROVE:
+                break
+
+        if best is None or best[0] >= -MINIMPROVE:
+            break
+
+        _, pvevm, source, target = best
+        _logger.debug(str(pvevm))
+
+        model.move(pvevm.id, source.id, target.id)
+        source.remove(pvevm)
+        target.add(pvevm)
+
+        if constraints is not None:
+            constraints.move(pvevm, target)
+
+    _logger.info('resource score after balancing: %.4f', model.score)
+
+    return cluster
+
+def planoptimizedbalance(cluster, timebudget=pveoptimize.TIMEBUDGET,
+                         objective='count', iterations=MAXMIGRATIONS,
+                         diffperc=BALDIFFPERC, ignorenodenames=None,
+                         ignorevmids=None, seed=None, costmodel=None,
+                         constraints=None):
+    """Migrate VMs in order to even the memory usage percentage on the
+    nodes like planbalance, but search for the plan with the fewest
+    migrations (objective 'count'), the least migrated memory (objective
+    'memory') or the lowest estimated migration time (objective 'time',
+    needs a costmodel, see pvecost) for timebudget seconds. The search
+    does not know placement constraints, so PlanningError is raised if
+    the given constraints (see pveconstraints) restrict any VM. The
+    given cluster is changed.
+    """
+    _logger = logging.getLogger(__name__)
+
+    if ignorenodenames is None:
+        ignorenodenames = []
+
+    if ignorevmids is None:
+        ignorevmids = []
+
+    ignorenodes = []
+
+    for node in ignorenodenames:
+        if node not in cluster.keys():
+            raise InputError("node '{}' doesn't exist".format(node))
+
+        ignorenodes.append(cluster[node])
+
+    nodes = cluster.nodes(lambda n: n.isonline and n not in ignorenodes)
+
+    if len(nodes) < 2:
+        raise PlanningError('no node found to migrate to')
+
+    if objective == 'time' and costmodel is None:
+        raise InputError("objective 'time' needs a cost model")
+
+    if constraints is not None and constraints.constrained:
+        raise PlanningError(
+            'the optimizing planner does not support HA groups and '
+            'placement rules, use another planner or --noconstraints')
+
+    problem = pveoptimize.BalanceProblem(
+        nodes, lambda vm: vm.id not in ignorevmids, costmodel)
+    search = pveoptimize.BalanceSearch(
+        problem, diffperc, iterations, objective, seed)
+    assign = search.run(timebudget)
+
+    _logger.info('searched %d plans', search.constructions)
+
+    if assign is None:
+        raise PlanningError(
+            'no plan found reaching {}% difference'.format(diffperc))
+
+    for vm, node in enumerate(assign):
+        if node != problem.origin[vm]:
+            pvevm = nodes[problem.origin[vm]].remove(problem.vmids[vm])
+            nodes[node].add(pvevm)
+
     return cluster
 
 def planflush(nodes, cluster, onlyha=False, maxmigrations=MAXMIGRATIONS,
-              ignorenodenames=None):
+              ignorenodenames=None, costmodel=None, ignorevmids=None,
+              constraints=None, storage=None):
     """Migrate all migratable VMs off the given nodes in order to empty
-    it, e.g. for maintenance. The given cluster is changed.
+    it, e.g. for maintenance. If a costmodel (see pvecost) is given, the
+    VMs with the lowest estimated migration time are moved first, so
+    limiting the number of migrations frees the nodes as fast as
+    possible. VMs with an id in ignorevmids are not moved. With
+    constraints (see pveconstraints), VMs are only moved to nodes the
+    index allows. With a storage index (see pvestorage), VMs with local
+    disks are moved too, to nodes with enough space left on their
+    storages. The given cluster is changed.
     """
     emptynodes = []
     ignorenodes = []
@@ -104,6 +325,9 @@ def planflush(nodes, cluster, onlyha=False, maxmigrations=MAXMIGRATIONS,
     if ignorenodenames is None:
         ignorenodenames = []
 
+    if ignorevmids is None:
+        ignorevmids = []
+
     for node in nodes:
         if node not in cluster.keys():
             raise InputError("node '{}' doesn't exist".format(node))
@@ -116,9 +340,17 @@ def planflush(nodes, cluster, onlyha=False, maxmigrations=MAXMIGRATIONS,
 
         ignorenodes.append(cluster[node])
 
+    if constraints is not None:
+        constraints.evacuate(nodes)
+
     for emptynode in emptynodes:
-        for pvevm in emptynode.migrateable_vms():
-            if onlyha and not pvevm.ha:
+        pvevms = emptynode.migrateable_vms(storage is not None)
+
+        if costmodel is not None:
+            pvevms.sort(key=lambda vm: (costmodel.estimate(vm), vm.id))
+
+        for pvevm in pvevms:
+            if onlyha and not pvevm.ha or pvevm.id in ignorevmids:
                 continue
 
             if iterations >= maxmigrations:
@@ -129,11 +361,80 @@ def planflush(nodes, cluster, onlyha=False, maxmigrations=MAXMIGRATIONS,
             emptynode.remove(pvevm)
             lowestnode = cluster.lowestnode(
                 'memvmnodeused_perc',
-                lambda n: n.isonline and n not in emptynodes + ignorenodes)
+                lambda n: n.isonline and n not in emptynodes + ignorenodes
+                and (constraints is None or constraints.allows(pvevm, n))
+                and (storage is None or storage.allows(pvevm, n)))
 
             if lowestnode is None:
-                raise PlanningError('no target node found')
+                raise PlanningError('no target node found for {}'.format(
+                    pvevm))
 
             lowestnode.add(pvevm)
 
+            if constraints is not None:
+                constraints.move(pvevm, lowestnode)
+
+            if storage is not None:
+                storage.move(pvevm, lowestnode)
+
+    return cluster
+
+def planflushpacked(nodes, cluster, onlyha=False, maxmigrations=MAXMIGRATIONS,
+                    ignorenodenames=None, memlimit=pvepacking.MEMLIMIT,
+                    cpulimit=pvepacking.CPULIMIT, fit='best',
+                    ignorevmids=None, constraints=None):
+    """Migrate all migratable VMs off the given nodes by packing them
+    onto the other nodes, biggest VMs first, without exceeding the given
+    memory and CPU limits in percent of the target nodes. Only the
+    maxmigrations biggest VMs are moved and VMs with an id in
+    ignorevmids are not. With constraints (see pveconstraints),
+    VMs are only packed onto nodes the index allows. Raise PlanningError
+    with a report if not all VMs fit. The given cluster is changed.
+    """
+    emptynodes = []
+    ignorenodes = []
+
+    if ignorenodenames is None:
+        ignorenodenames = []
+
+    if ignorevmids is None:
+        ignorevmids = []
+
+    for node in nodes:
+        if node not in cluster.keys():
+            raise InputError("node '{}' doesn't exist".format(node))
+
+        emptynodes.append(cluster[node])
+
+    for node in ignorenodenames:
+        if node not in cluster.keys():
+            raise InputError("node '{}' doesn't exist".format(node))
+
+        ignorenodes.append(cluster[node])
+
+    pvevms = [(n, v) for n in emptynodes for v in n.migrateable_vms()
+              if (v.ha or not onlyha) and v.id not in ignorevmids]
+    pvevms.sort(key=lambda p: pvepacking.itemkey(pvepacking.vmitem(p[1])))
+    pvevms = pvevms[:maxmigrations]
+    targets = cluster.nodes(
+        lambda n: n.isonline and n not in emptynodes + ignorenodes)
+
+    if not targets:
+        raise PlanningError('no target node found')
+
+    if constraints is not None:
+        constraints.evacuate(nodes)
+
+    placements, unplaced, remaining = pvepacking.pack(
+        [pvepacking.vmitem(v) for _, v in pvevms],
+        [pvepacking.nodebin(n, memlimit, cpulimit) for n in targets],
+        fit, constraints)
+
+    if unplaced:
+        raise PlanningError(pvepacking.report(unplaced, remaining))
+
+    for node, pvevm in pvevms:
+        node.remove(pvevm)
+        cluster[placements[pvevm.id]].add(pvevm)
+
     return cluster
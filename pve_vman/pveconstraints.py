@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides the placement constraints of VMs, from the HA
+groups of the HA managed VMs and from user defined rules, as an index
+that answers if a VM may be moved to a node without scanning the
+cluster, so the placement loops of the planners stay fast.
+
+The rules file uses the PVE section config format:
+
+    node-affinity: licensed
+        vms 301,302
+        nodes node01,node02
+
+    affinity: webshop
+        vms 101,102
+
+    anti-affinity: dns
+        vms 201,202
+
+VMs of a node-affinity rule may only run on the given nodes, VMs of an
+affinity rule are kept on the same node and VMs of an anti-affinity
+rule on different nodes.
+"""
+
+from pve_vman import pvefiles
+from pve_vman.exceptions import InputError
+
+
+RULESFILE = '/etc/pve_vman/rules.cfg'
+"""Default path of the file holding the user defined placement rules."""
+
+RULETYPES = ('node-affinity', 'affinity', 'anti-affinity')
+"""Known types of placement rules."""
+
+
+def _split(value):
+    return [v.strip() for v in (value or '').split(',') if v.strip()]
+
+def groupnodes(group, onlinenodes):
+    """Return the set of node ids a VM of the given HA group (see
+    pvefiles.hagroupconf) may be moved to without the HA manager moving
+    it back, or None if it may go anywhere. Unless nofailback is set,
+    these are the online nodes with the highest priority.
+    """
+    priorities = {}
+
+    for entry in _split(group.get('nodes')):
+        node, _, priority = entry.partition(':')
+        priorities[node] = int(priority or 0)
+
+    online = dict((n, p) for n, p in priorities.items() if n in onlinenodes)
+    restricted = group.get('restricted', '0') == '1'
+    nofailback = group.get('nofailback', '0') == '1'
+
+    if not online:
+        return frozenset() if restricted else None
+
+    if nofailback:
+        return frozenset(online) if restricted else None
+
+    top = max(online.values())
+
+    return frozenset([n for n, p in online.items() if p == top])
+
+
+class ConstraintIndex(object):
+    """Index of the placement constraints of the VMs of a cluster. The
+    planners ask allows before and report move after every move, so
+    the (anti-)affinity state follows the planned placement. The VMs
+    may be given as objects or ids. Nodes in offline are treated as
+    offline for the HA groups, e.g. for failure scenarios.
+    """
+    def __init__(self, cluster, groups=None, rules=None, offline=()):
+        self.allowed = {}
+        self.together = {}
+        self.apart = {}
+        self.members = {}
+        self.placement = {}
+        self.counts = {}
+        self.evacuated = set()
+        self.groups = groups or {}
+        self.rules = rules or {}
+
+        self.onlinenodes = frozenset([
+            n.id for n in cluster.nodes(lambda n: n.isonline)
+            if n.id not in offline])
+
+        for node in cluster.nodes():
+            for pvevm in node.vms():
+                self.placement[pvevm.id] = node.id
+
+                if pvevm.ha and pvevm.hagroup in self.groups:
+                    allowed = groupnodes(
+                        self.groups[pvevm.hagroup], self.onlinenodes)
+                    if allowed is not None:
+                        self.allowed[pvevm.id] = allowed
+
+        for name, rule in sorted(self.rules.items()):
+            self.addrule(name, rule)
+
+    @property
+    def constrained(self):
+        """Return if the index restricts the placement of any VM to
+        less than all online nodes.
+        """
+        return bool(self.together or self.apart) or any(
+            not self.onlinenodes <= a for a in self.allowed.values())
+
+    def addrule(self, name, rule):
+        """Add a rule (see pvefiles.rulesconf) to the index. Raise
+        InputError for unknown rule types.
+        """
+        ruletype = rule.get('type')
+        vmids = [v for v in _split(rule.get('vms')) if v in self.placement]
+
+        if ruletype not in RULETYPES:
+            raise InputError("unknown rule type '{}' of rule '{}'".format(
+                ruletype, name))
+
+        if ruletype == 'node-affinity':
+            nodes = frozenset(_split(rule.get('nodes')))
+            for vmid in vmids:
+                self.allowed[vmid] = self.allowed.get(vmid, nodes) & nodes
+            return
+
+        self.members[name] = vmids
+
+        for vmid in vmids:
+            if ruletype == 'affinity':
+                self.together[vmid] = name
+            else:
+                self.apart.setdefault(vmid, []).append(name)
+                key = (name, self.placement[vmid])
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def evacuate(self, nodeids):
+        """Mark the given nodes as being emptied, so VMs of an affinity
+        rule may follow the other VMs moved off these nodes.
+        """
+        self.evacuated.update(nodeids)
+
+    def allows(self, pvevm, target):
+        """Return if the VM may be moved to the target node."""
+        vmid = getattr(pvevm, 'id', pvevm)
+        nodeid = getattr(target, 'id', target)
+        allowed = self.allowed.get(vmid)
+
+        if allowed is not None and nodeid not in allowed:
+            return False
+
+        for name in self.apart.get(vmid, ()):
+            if self.counts.get((name, nodeid), 0) > 0:
+                return False
+
+        name = self.together.get(vmid)
+
+        if name is not None:
+            for other in self.members[name]:
+                node = self.placement[other]
+                if other != vmid and node != nodeid \
+                        and node not in self.evacuated:
+                    return False
+
+        return True
+
+    def move(self, pvevm, target):
+        """Record the move of the VM to the target node."""
+        vmid = getattr(pvevm, 'id', pvevm)
+        nodeid = getattr(target, 'id', target)
+        source = self.placement.get(vmid)
+
+        for name in self.apart.get(vmid, ()):
+            self.counts[(name, source)] -= 1
+            self.counts[(name, nodeid)] = \
+                self.counts.get((name, nodeid), 0) + 1
+
+        self.placement[vmid] = nodeid
+
+
+def buildindex(cluster, rulespath=RULESFILE):
+    """Return a ConstraintIndex of the cluster with the HA groups and
+    the rules from the given file.
+    """
+    return ConstraintIndex(
+        cluster, pvefiles.hagroupconf(), pvefiles.rulesconf(rulespath))
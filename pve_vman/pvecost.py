@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides a model estimating how long the migration of a
+VM takes. A live migration copies the used memory of the VM while the
+VM keeps dirtying pages, so the effective bandwidth is reduced by the
+dirty rate, which is approximated by the recent disk write and network
+rates of the VM. Disks on local storage are copied as well.
+"""
+
+from __future__ import division
+
+from pve_vman import pveresources
+
+
+BANDWIDTH = 1024 ** 3
+"""Default migration bandwidth in bytes per second."""
+
+DISKBANDWIDTH = 256 * 1024 ** 2
+"""Default bandwidth in bytes per second for copying local disks."""
+
+OVERHEAD = 5
+"""Default fixed number of seconds every migration takes."""
+
+DIRTYFACTOR = 1.0
+"""Default factor of the IO rate that is assumed as memory dirty rate."""
+
+MINCONVERGENCE = 0.1
+"""Minimal part of the bandwidth left for copying memory if the dirty
+rate comes close to or exceeds the bandwidth."""
+
+
+class MigrationCostModel(object):
+    """Estimates the migration duration of VMs in seconds."""
+    def __init__(self, bandwidth=BANDWIDTH, diskbandwidth=DISKBANDWIDTH,
+                 overhead=OVERHEAD, dirtyfactor=DIRTYFACTOR):
+        self.bandwidth = bandwidth
+        self.diskbandwidth = diskbandwidth
+        self.overhead = overhead
+        self.dirtyfactor = dirtyfactor
+
+    def dirtyrate(self, pvevm):
+        """Return the estimated memory dirty rate of the VM in bytes per
+        second, based on its disk write and network rates between two
+        snapshots if known, else since VM start (see pveresources.rate).
+        """
+        return pveresources.rate(
+            pvevm, 'diskwrite', 'netin', 'netout') * self.dirtyfactor
+
+    def estimate(self, pvevm):
+        """Return the estimated migration duration of the VM in seconds.
+        """
+        seconds = self.overhead
+        localdisksize = pvevm.attrs.get('localdisksize') or 0
+
+        if localdisksize:
+            seconds += localdisksize / self.diskbandwidth
+
+        if not pvevm.isonline:
+            return seconds
+
+        mem = pvevm.attrs.get('mem') or pvevm.attrs.get('maxmem') or 0
+        effective = max(self.bandwidth - self.dirtyrate(pvevm),
+                        self.bandwidth * MINCONVERGENCE)
+
+        return seconds + mem / effective
+
+    def total(self, migrations):
+        """Return the estimated duration in seconds of running the given
+        migrations one after another.
+        """
+        return sum([self.estimate(m.pvevm) for m in migrations])
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides a HTTP exporter for cluster, node and VM
+metrics in the Prometheus text exposition format. The metrics are
+rendered once per refresh in the background, so a scrape only returns
+the cached response.
+"""
+
+import logging
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from pve_vman import pverefresh, pvevmiostats
+
+
+LISTEN = ('', 9118)
+"""Default address and port the exporter listens on."""
+
+CONTENTTYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+NODEMETRICS = (
+    ('uptime', 'gauge', 'Node uptime in seconds.'),
+    ('load', 'gauge', 'Node load average.'),
+    ('maxcpu', 'gauge', 'Number of node CPUs.'),
+    ('cpu', 'gauge', 'Node CPU usage ratio.'),
+    ('iowait', 'gauge', 'Node IO wait ratio.'),
+    ('memtotal', 'gauge', 'Node total memory in bytes.'),
+    ('memused', 'gauge', 'Node used memory in bytes.'),
+    ('swaptotal', 'gauge', 'Node total swap in bytes.'),
+    ('swapused', 'gauge', 'Node used swap in bytes.'),
+    ('netin', 'counter', 'Node received network bytes.'),
+    ('netout', 'counter', 'Node sent network bytes.'))
+
+VMMETRICS = (
+    ('uptime', 'gauge', 'VM uptime in seconds.'),
+    ('maxcpu', 'gauge', 'Number of VM CPUs.'),
+    ('cpu', 'gauge', 'VM CPU usage ratio.'),
+    ('maxmem', 'gauge', 'VM provisioned memory in bytes.'),
+    ('mem', 'gauge', 'VM used memory in bytes.'),
+    ('maxdisk', 'gauge', 'VM disk size in bytes.'),
+    ('netin', 'counter', 'VM received network bytes.'),
+    ('netout', 'counter', 'VM sent network bytes.'),
+    ('diskread', 'counter', 'VM read disk bytes.'),
+    ('diskwrite', 'counter', 'VM written disk bytes.'))
+
+IOSTATMETRICS = (
+    ('rd_bytes', 'Bytes read by the VM block devices.'),
+    ('rd_operations', 'Read operations of the VM block devices.'),
+    ('wr_bytes', 'Bytes written by the VM block devices.'),
+    ('wr_operations', 'Write operations of the VM block devices.'))
+
+
+def _escape(value):
+    """Return the label value escaped for the exposition format."""
+    value = str(value)
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+def _labels(labels):
+    """Return the formatted label set for the given labels."""
+    if not labels:
+        return ''
+
+    pairs = ['{}="{}"'.format(k, _escape(labels[k])) for k in sorted(labels)]
+    return '{' + ','.join(pairs) + '}'
+
+def _value(value):
+    """Return the sample value formatted for the exposition format."""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsRenderer(object):
+    """Renders metrics for a cluster object. Metric families are
+    collected in order of creation and rendered with one HELP and TYPE
+    line each.
+    """
+    def __init__(self, prefix='pve_vman'):
+        self.prefix = prefix
+        self.families = []
+        self.samples = {}
+
+    def family(self, name, mtype, helptext):
+        """Register a metric family and return its full name."""
+        fullname = '{}_{}'.format(self.prefix, name)
+
+        if mtype == 'counter':
+            fullname += '_total'
+
+        if fullname not in self.samples:
+            self.families.append((fullname, mtype, helptext))
+            self.samples[fullname] = []
+
+        return fullname
+
+    def add(self, name, mtype, helptext, value, labels=None):
+        """Add a sample for the given metric family."""
+        fullname = self.family(name, mtype, helptext)
+        self.samples[fullname].append((_labels(labels), value))
+
+    def render(self):
+        """Return the exposition format as string."""
+        lines = []
+
+        for fullname, mtype, helptext in self.families:
+            lines.append('# HELP {} {}'.format(fullname, helptext))
+            lines.append('# TYPE {} {}'.format(fullname, mtype))
+
+            for labels, value in self.samples[fullname]:
+                lines.append('{}{} {}'.format(fullname, labels, _value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+def render_cluster(cluster, renderer):
+    """Add cluster, node and VM metrics to the given renderer."""
+    migrateable = lambda c: c.migrateable
+    havms = lambda c: c.ha
+
+    renderer.add('cluster_mem_total_bytes', 'gauge',
+                 'Total memory of all online nodes in bytes.',
+                 cluster.memtotal)
+    renderer.add('cluster_mem_used_bytes', 'gauge',
+                 'Used memory of all online nodes in bytes.',
+                 cluster.memused)
+    renderer.add('cluster_vm_mem_used_bytes', 'gauge',
+                 'Memory used by all VMs in bytes.',
+                 cluster.memvmused)
+    renderer.add('cluster_vm_mem_prov_bytes', 'gauge',
+                 'Memory provisioned by all VMs in bytes.',
+                 cluster.memvmprov)
+
+    for node in cluster:
+        nodelabels = {'node': node.id}
+
+        renderer.add('node_up', 'gauge', 'Node is online.',
+                     int(node.isonline), labels=nodelabels)
+
+        for attr, mtype, helptext in NODEMETRICS:
+            if attr in node:
+                renderer.add('node_' + attr, mtype, helptext,
+                             getattr(node, attr), labels=nodelabels)
+
+        renderer.add('node_vm_mem_used_bytes', 'gauge',
+                     'Memory used by the VMs of the node in bytes.',
+                     node.memvmused, labels=nodelabels)
+        renderer.add('node_vm_mem_prov_bytes', 'gauge',
+                     'Memory provisioned by the VMs of the node in bytes.',
+                     node.memvmprov, labels=nodelabels)
+        renderer.add('node_vms', 'gauge', 'Number of VMs on the node.',
+                     len(node.children), labels=nodelabels)
+        renderer.add('node_vms_migrateable', 'gauge',
+                     'Number of migrateable VMs on the node.',
+                     len(node.vms(migrateable)), labels=nodelabels)
+        renderer.add('node_vms_ha', 'gauge',
+                     'Number of HA managed VMs on the node.',
+                     len(node.vms(havms)), labels=nodelabels)
+
+        for pvevm in node:
+            labels = {
+                'vmid': pvevm.id,
+                'node': node.id,
+                'name': pvevm.attrs.get('name', ''),
+                'type': pvevm.attrs.get('type', '')}
+
+            renderer.add('vm_up', 'gauge', 'VM is running.',
+                         int(pvevm.isonline), labels=labels)
+
+            for attr, mtype, helptext in VMMETRICS:
+                if attr in pvevm:
+                    renderer.add('vm_' + attr, mtype, helptext,
+                                 getattr(pvevm, attr), labels=labels)
+
+def render_iostats(vmstats, vmids, renderer):
+    """Add the block device counters of the given VMIOStats object to
+    the renderer. Only VMs in vmids are considered.
+    """
+    for key, helptext in IOSTATMETRICS:
+        for vmid in sorted(vmids):
+            renderer.add('vm_block_' + key, 'counter', helptext,
+                         vmstats.vmstats[vmid][key], labels={'vmid': vmid})
+
+
+class PVEExporter(object):
+    """Holds the pre-rendered metrics response. It is updated by a
+    PVEStatRefresher and read by the HTTP handler.
+    """
+    def __init__(self, iostats=True):
+        self.response = b''
+        self.lock = threading.Lock()
+        self.vmstats = None
+
+        if iostats:
+            self.vmstats = pvevmiostats.VMIOStats(1)
+
+    def update(self, cluster, refresher=None):
+        """Render all metrics for the given cluster and replace the
+        cached response.
+        """
+        _logger = logging.getLogger(__name__)
+        renderer = MetricsRenderer()
+        start = time.time()
+
+        render_cluster(cluster, renderer)
+
+        if self.vmstats is not None:
+            try:
+                vmdiffs, _ = self.vmstats.fetch()
+            except Exception as exc:
+                _logger.warning('fetching iostats failed: %s', exc)
+            else:
+                render_iostats(self.vmstats, vmdiffs.keys(), renderer)
+
+        if refresher is not None:
+            renderer.add('refresh_timestamp_seconds', 'gauge',
+                         'Time of the last successful refresh.',
+                         refresher.timestamp)
+            renderer.add('refresh_duration_seconds', 'gauge',
+                         'Duration of the last cluster build.',
+                         refresher.duration)
+            renderer.add('refresh_errors', 'counter',
+                         'Number of failed refreshes.',
+                         refresher.errors)
+
+        renderer.add('render_duration_seconds', 'gauge',
+                     'Duration of the last metrics rendering.',
+                     time.time() - start)
+
+        response = renderer.render().encode('utf-8')
+
+        with self.lock:
+            self.response = response
+
+    def get(self):
+        """Return the current response."""
+        with self.lock:
+            return self.response
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _handler(exporter):
+    """Return a request handler class serving the given exporter."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                body = b'<a href="/metrics">Metrics</a>\n'
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+            else:
+                body = exporter.get()
+                self.send_response(200 if body else 503)
+                self.send_header('Content-Type', CONTENTTYPE)
+
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            logging.getLogger(__name__).debug(fmt, *args)
+
+    return MetricsHandler
+
+
+def serve(listen=LISTEN, interval=pverefresh.REFRESHINTERVAL, iostats=True):
+    """Start the refresh loop and serve the metrics on the given
+    address until interrupted.
+    """
+    exporter = PVEExporter(iostats)
+    refresher = pverefresh.PVEStatRefresher(interval)
+    refresher.addlistener(lambda c: exporter.update(c, refresher))
+    refresher.start()
+
+    server = _ThreadingHTTPServer(listen, _handler(exporter))
+
+    try:
+        server.serve_forever()
+    finally:
+        refresher.stop()
+        server.server_close()
+
+def parselisten(value):
+    """Return (address, port) tuple for strings like ':9118',
+    '9118' or '127.0.0.1:9118'.
+    """
+    address, _, port = value.rpartition(':')
+
+    try:
+        return (address.strip('[]'), int(port))
+    except ValueError:
+        raise ValueError("invalid listen address '{}'".format(value))
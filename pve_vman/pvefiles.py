@@ -61,10 +61,15 @@ def storageconf():
 
     return conf
 
-def vmconf():
-    """Return dictionary of the PVE cluster VM configurations."""
+def vmconf(cache=None):
+    """Return dictionary of the PVE cluster VM configurations. If a
+    cache dictionary is given, it keeps the parsed configs by file path
+    with their modification time and size, and only changed files are
+    read again.
+    """
     pattern = os.path.join(BASEPATH, 'nodes', '*', '*', '*.conf')
     conf = {}
+    seen = set()
 
     for filepath in glob.iglob(pattern):
         pathparts = filepath.split(os.path.sep)
@@ -76,11 +81,27 @@ def vmconf():
         vmid = pathparts[-1][:-5]
         vmnode = pathparts[-3]
 
+        if cache is not None:
+            try:
+                filestat = os.stat(filepath)
+            except OSError:
+                continue
+
+            version = (filestat.st_mtime, filestat.st_size)
+            seen.add(filepath)
+
+            if filepath in cache and cache[filepath][0] == version:
+                conf[vmid] = cache[filepath][1]
+                continue
+
         current = conf[vmid] = {
             'vmid': vmid,
             'type': vmtype,
             'node': vmnode}
 
+        if cache is not None:
+            cache[filepath] = (version, current)
+
         filecontent = _readfile(filepath)
 
         for line in filecontent:
@@ -104,11 +125,24 @@ def vmconf():
 
             current[key] = value
 
+    if cache is not None:
+        for filepath in set(cache) - seen:
+            del cache[filepath]
+
     return conf
 
+def nodes():
+    """Return sorted list of the names of the cluster nodes, i.e. of the
+    node directories.
+    """
+    pattern = os.path.join(BASEPATH, 'nodes', '*', '')
+
+    return sorted(p.split(os.path.sep)[-2] for p in glob.glob(pattern))
+
 def stats():
     keys_by_prefix = {
         'pve2-storage': (
+            ('node', str),
             ('storage', str),
             ('timestamp', int),
             ('total', int),
@@ -153,7 +187,8 @@ def stats():
         line_a = line.split(':')
         identifier = line_a[0].split('/')
         prefix = identifier[0]
-        line_a[0] = identifier[1]
+        # storage lines are identified by node and storage name
+        line_a[0:1] = identifier[1:]
         stattype = prefix.split('-')[-1]
         stat = {'type': stattype, 'prefix': prefix}
         keys = keys_by_prefix.get(prefix, [])
@@ -175,9 +210,12 @@ def stats():
 
     return dict(stats_d)
 
-def haconf():
-    filecontent = readpvefile('ha/resources.cfg')
+def _sections(filecontent):
+    """Return dictionary of the sections of a PVE section config, e.g.
+    the HA config files, by their names.
+    """
     conf = {}
+    current = None
 
     for line in filecontent:
         line_a = line.split()
@@ -194,3 +232,21 @@ def haconf():
             current[key] = value
 
     return conf
+
+def haconf():
+    """Return dictionary of the HA resources by VM id."""
+    return _sections(readpvefile('ha/resources.cfg'))
+
+def hagroupconf():
+    """Return dictionary of the HA groups by name."""
+    return _sections(readpvefile('ha/groups.cfg'))
+
+def rulesconf(rulespath):
+    """Return dictionary of the placement rules in the file given by
+    the absolute path, which uses the PVE section config format. Return
+    an empty dictionary if the file doesn't exist.
+    """
+    if not os.path.exists(rulespath):
+        return {}
+
+    return _sections(_readfile(rulespath))
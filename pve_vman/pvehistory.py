@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides a compact local history of cluster snapshots,
+so planners can use the usage of the nodes and VMs aggregated over a
+time window instead of a single reading that might be a short spike.
+Every snapshot appends one fixed width binary record per node and VM
+to the history file, which is memory mapped for reading. The records
+are in time order, so the start of a window is found by binary search.
+"""
+
+from __future__ import division
+
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import time
+
+from pve_vman.exceptions import InputError
+
+
+HISTORYFILE = '/var/lib/pve_vman/history.dat'
+"""Default path of the history file."""
+
+INTERVAL = 300
+"""Default minimum number of seconds between two recorded snapshots."""
+
+WINDOW = 3600
+"""Default number of seconds the usage is aggregated over."""
+
+RATEWINDOW = 2 * INTERVAL
+"""Default number of seconds of history the IO and network rates of the
+VMs are taken from if the usage is not aggregated over a window.
+"""
+
+KEEP = 7 * 86400
+"""Default number of seconds snapshots are kept."""
+
+COMPACTINTERVAL = 86400
+"""Number of seconds snapshots may be kept longer than requested, as
+removing them rewrites the file.
+"""
+
+MAGIC = b'VMANHIST'
+"""Identifier at the start of every history file."""
+
+HEADER = struct.Struct('<8sI')
+"""File header: the magic and the record size."""
+
+FORMAT = 'IB23sQfQQQQ'
+"""Record format: timestamp, kind, id, used memory, CPU usage and the
+disk read, disk write, network in and network out byte counters.
+"""
+
+RECORD = struct.Struct('<' + FORMAT)
+"""A single record."""
+
+KEYFORMAT = '4xB23s44x'
+"""Record format skipping all fields but the kind and the id."""
+
+VALUEFORMAT = '28xQf32x'
+"""Record format skipping all fields but the used memory and the CPU
+usage.
+"""
+
+RUNRECORDS = 262144
+"""Maximum number of records unpacked at once when reading."""
+
+TIMESTAMP = struct.Struct('<I')
+"""Leading timestamp of a record, used for searching."""
+
+NODE = 0
+"""Record kind of nodes."""
+
+VM = 1
+"""Record kind of VMs."""
+
+COUNTERS = ('diskread', 'diskwrite', 'netin', 'netout')
+"""Byte counters of the records, aggregated as rates per second."""
+
+FIELDS = ('timestamp', 'kind', 'id', 'mem', 'cpu') + COUNTERS
+"""Names of the record fields."""
+
+_STRUCTS = {}
+
+
+def statistic(name):
+    """Return the function aggregating a list of numbers for the given
+    statistic name: mean, min, max or pNN for the NNth percentile.
+    Raise InputError for unknown names.
+    """
+    if name == 'mean':
+        return lambda values: sum(values) / len(values)
+    if name in ('min', 'max'):
+        return {'min': min, 'max': max}[name]
+
+    match = re.match(r'^p(100|\d{1,2})$', name)
+
+    if not match:
+        raise InputError("unknown statistic '{}'".format(name))
+
+    perc = int(match.group(1))
+
+    def percentile(values):
+        values = sorted(values)
+        rank = int(math.ceil(perc / 100 * len(values)))
+        return values[max(rank - 1, 0)]
+
+    return percentile
+
+def _records(cluster, timestamp):
+    """Yield the packed records of the nodes and VMs of the cluster. The
+    VMs are ordered by id regardless of their node, so snapshots keep
+    the same layout while VMs are migrated.
+    """
+    for node in cluster.nodes():
+        yield RECORD.pack(
+            timestamp, NODE, node.id.encode('utf-8'),
+            node.attrs.get('memused') or 0, node.attrs.get('cpu') or 0,
+            0, 0, node.attrs.get('netin') or 0,
+            node.attrs.get('netout') or 0)
+
+    for pvevm in sorted(cluster.vms(), key=lambda v: int(v.id)):
+        yield RECORD.pack(
+            timestamp, VM, pvevm.id.encode('utf-8'),
+            pvevm.attrs.get('mem') or 0, pvevm.attrs.get('cpu') or 0,
+            *[pvevm.attrs.get(a) or 0 for a in COUNTERS])
+
+def _offset(index):
+    return HEADER.size + index * RECORD.size
+
+def _struct(fmt, count):
+    """Return the cached struct for count records of the given format."""
+    if (fmt, count) not in _STRUCTS:
+        if len(_STRUCTS) > 64:
+            _STRUCTS.clear()
+        _STRUCTS[(fmt, count)] = struct.Struct('<' + fmt * count)
+
+    return _STRUCTS[(fmt, count)]
+
+def _search(data, count, timestamp, low=0):
+    """Return the index of the first of the count records in data with
+    a timestamp not before the given one, starting at index low.
+    """
+    high = count
+
+    while low < high:
+        middle = (low + high) // 2
+
+        if TIMESTAMP.unpack_from(data, _offset(middle))[0] < timestamp:
+            low = middle + 1
+        else:
+            high = middle
+
+    return low
+
+def _runs(data, start, end):
+    """Yield (index, snapshots, keys) tuples for the runs of consecutive
+    snapshots in the records start to end of data that have the same
+    nodes and VMs in the same order, index being the first record of
+    the run and keys the flat tuple of the kinds and ids of a snapshot.
+    """
+    run = None
+    index = start
+
+    while index < end:
+        timestamp = TIMESTAMP.unpack_from(data, _offset(index))[0]
+        following = _search(data, end, timestamp + 1, index)
+        keys = _struct(KEYFORMAT, following - index).unpack_from(
+            data, _offset(index))
+
+        if run is not None and run[2] == keys \
+                and (run[1] + 1) * len(keys) // 2 <= RUNRECORDS:
+            run[1] += 1
+        else:
+            if run is not None:
+                yield tuple(run)
+            run = [index, 1, keys]
+
+        index = following
+
+    if run is not None:
+        yield tuple(run)
+
+def _unpack(data, start, end):
+    """Return the list of the unpacked records start to end of data."""
+    offset = _offset(start)
+
+    if not hasattr(RECORD, 'iter_unpack'):
+        return [RECORD.unpack_from(data, offset + i * RECORD.size)
+                for i in range(end - start)]
+
+    view = memoryview(data)[offset:_offset(end)]
+
+    try:
+        return list(RECORD.iter_unpack(view))
+    finally:
+        view.release()
+
+
+class History(object):
+    """Append-only file of cluster snapshots. Snapshots less than
+    interval seconds after the last one are skipped. If keep is set,
+    snapshots older than keep seconds are removed, at most once a day
+    as the whole file is rewritten.
+
+    Example:
+        history = History('/var/lib/pve_vman/history.dat')
+        history.append(cluster)
+        cluster = smooth(cluster, history.statistics(3600, 'p95'))
+    """
+    def __init__(self, path=HISTORYFILE, interval=INTERVAL, keep=KEEP):
+        self.path = path
+        self.interval = interval
+        self.keep = keep
+        self.first = self.last = None
+
+        records = self._read(0, None, ends=True)
+        if records:
+            self.first, self.last = records[0][0], records[-1][0]
+
+    def _map(self):
+        """Return the size of the history file and a read only memory
+        map of it, or None if it holds no records. Raise InputError if
+        it is not a history file.
+        """
+        try:
+            with open(self.path, 'rb') as fileh:
+                size = os.fstat(fileh.fileno()).st_size
+
+                if size < HEADER.size + RECORD.size:
+                    return size, None
+
+                data = mmap.mmap(fileh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError) as exc:
+            if not os.path.exists(self.path):
+                return 0, None
+            raise InputError("can't read history '{}': {}".format(
+                self.path, exc))
+
+        if HEADER.unpack_from(data) != (MAGIC, RECORD.size):
+            data.close()
+            raise InputError("'{}' is not a history file".format(self.path))
+
+        return size, data
+
+    def _read(self, since, until, ends=False):
+        """Return the unpacked records with a timestamp from since to
+        until, or only the first and the last record if ends is set.
+        """
+        size, data = self._map()
+
+        if data is None:
+            return []
+
+        try:
+            count = (size - HEADER.size) // RECORD.size
+
+            if ends:
+                return _unpack(data, 0, 1) + _unpack(data, count - 1, count)
+
+            start = _search(data, count, since)
+            end = count if until is None else _search(data, count, until + 1)
+
+            return _unpack(data, start, end)
+        finally:
+            data.close()
+
+    def append(self, cluster, timestamp=None):
+        """Append a snapshot of the cluster and remove expired ones.
+        Return if it was appended.
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+
+        if self.last is not None and timestamp - self.last < self.interval:
+            return False
+
+        directory = os.path.dirname(self.path)
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+        with open(self.path, 'r+b' if size else 'wb') as fileh:
+            if not size:
+                fileh.write(HEADER.pack(MAGIC, RECORD.size))
+                size = HEADER.size
+            elif fileh.read(HEADER.size) != HEADER.pack(MAGIC, RECORD.size):
+                raise InputError("'{}' is not a history file".format(
+                    self.path))
+
+            # drop a partial record left by an interrupted write
+            size -= (size - HEADER.size) % RECORD.size
+            fileh.seek(size)
+            fileh.truncate()
+            fileh.write(b''.join(_records(cluster, timestamp)))
+
+        self.last = timestamp
+
+        if self.first is None:
+            self.first = timestamp
+        elif self.keep and timestamp - self.first >= \
+                self.keep + COMPACTINTERVAL:
+            self.compact(timestamp - self.keep)
+
+        return True
+
+    def compact(self, before):
+        """Remove the snapshots older than the before timestamp by
+        rewriting the file. Return the number of removed records.
+        """
+        size, data = self._map()
+
+        if data is None:
+            return 0
+
+        try:
+            count = (size - HEADER.size) // RECORD.size
+            start = _search(data, count, before)
+
+            if not start:
+                return 0
+
+            self.first = None
+            if start < count:
+                self.first = TIMESTAMP.unpack_from(data, _offset(start))[0]
+
+            tmppath = '{}.tmp'.format(self.path)
+            offset = _offset(start)
+            with open(tmppath, 'wb') as fileh:
+                fileh.write(data[:HEADER.size])
+                for chunk in range(offset, size, 1024 ** 2):
+                    fileh.write(data[chunk:min(chunk + 1024 ** 2, size)])
+            os.rename(tmppath, self.path)
+        finally:
+            data.close()
+
+        logging.getLogger(__name__).info(
+            'removed %d history records before %d', start, before)
+
+        return start
+
+    def records(self, since=0, until=None):
+        """Return list of tuples of the FIELDS of the records with a
+        timestamp from since to until.
+        """
+        return [r[:2] + (r[2].rstrip(b'\0').decode('utf-8'),) + r[3:]
+                for r in self._read(since, until)]
+
+    def statistics(self, window=WINDOW, stat='mean', now=None):
+        """Return dictionary of (kind, id) keys and dictionaries of the
+        used memory and the CPU usage aggregated with the given
+        statistic over the snapshots of the last window seconds before
+        now, and of the rates per second of the byte counters (see
+        COUNTERS) between the first and the last of these snapshots.
+        Rates are None if there is only one snapshot or a counter went
+        backwards, e.g. after a restart.
+        """
+        func = statistic(stat)
+
+        if now is None:
+            now = time.time()
+
+        size, data = self._map()
+
+        if data is None:
+            return {}
+
+        series = {}
+        previous = aligned = None
+
+        try:
+            count = (size - HEADER.size) // RECORD.size
+            start = _search(data, count, now - window)
+            end = _search(data, count, now + 1, start)
+
+            for index, snapshots, keys in _runs(data, start, end):
+                step = len(keys)
+                values = _struct(VALUEFORMAT, snapshots * step // 2) \
+                    .unpack_from(data, _offset(index))
+                last = index + (snapshots - 1) * step // 2
+
+                # runs split by RUNRECORDS share their layout
+                if keys != previous:
+                    aligned = []
+                    for number in range(0, step, 2):
+                        key = keys[number:number + 2]
+                        if key not in series:
+                            series[key] = [[], [], index + number // 2, None]
+                        aligned.append(series[key])
+                    previous = keys
+
+                for number, current in enumerate(aligned):
+                    current[0].extend(values[2 * number::step])
+                    current[1].extend(values[2 * number + 1::step])
+                    current[3] = last + number
+
+            # the counters only of the first and last records are needed
+            for current in series.values():
+                current[2:] = [RECORD.unpack_from(data, _offset(i))
+                               for i in current[2:]]
+        finally:
+            data.close()
+
+        stats = {}
+
+        for (kind, rawid), (mem, cpu, first, last) in series.items():
+            values = {'mem': func(mem), 'cpu': func(cpu)}
+            seconds = last[0] - first[0]
+
+            for index, counter in enumerate(COUNTERS, 5):
+                values[counter] = None
+                if seconds > 0 and last[index] >= first[index]:
+                    values[counter] = (last[index] - first[index]) / seconds
+
+            stats[(kind, rawid.rstrip(b'\0').decode('utf-8'))] = values
+
+        return stats
+
+
+def smooth(cluster, stats):
+    """Return a frozen clone of the cluster with the usage of the nodes
+    and VMs replaced by the given statistics (see History.statistics).
+    Nodes and VMs without history keep their current values.
+    """
+    newcluster = cluster.clone()
+
+    for node in newcluster.nodes():
+        values = stats.get((NODE, node.id))
+
+        if values:
+            node.attrs['memused'] = int(values['mem'])
+            node.attrs['cpu'] = values['cpu']
+
+        for pvevm in node.vms():
+            values = stats.get((VM, pvevm.id))
+
+            if not values:
+                continue
+
+            pvevm.attrs['mem'] = int(values['mem'])
+            pvevm.attrs['cpu'] = values['cpu']
+
+    setrates(newcluster, stats)
+    newcluster.freeze()
+
+    return newcluster
+
+def setrates(cluster, stats):
+    """Set the rates of the byte counters (see COUNTERS) of the given
+    statistics on the VMs of the cluster as attributes with 'rate'
+    appended, e.g. diskwriterate, which are used instead of the average
+    rates since VM start (see pveresources.rate). Return the cluster.
+    """
+    for pvevm in cluster.vms():
+        values = stats.get((VM, pvevm.id)) or {}
+
+        for counter in COUNTERS:
+            if values.get(counter) is not None:
+                pvevm.attrs[counter + 'rate'] = values[counter]
+
+    return cluster
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""Effective memory of VMs for planning. The used memory PVE reports
+for a VM differs from what it needs after a migration: a ballooned
+guest gets its current balloon size back on the target and the memory
+KSM saves by merging its pages with the ones of other guests on the
+node is lost. annotate reads the balloon sizes over QMP and the KSM
+savings from sysfs, which is only possible for the node vman runs on,
+and effective returns a cluster with the memory of the VMs replaced by
+the one of a model.
+"""
+
+import os
+import socket
+
+from pve_vman import pveqemumonitor
+from pve_vman.exceptions import InputError
+
+
+KSMDIR = '/sys/kernel/mm/ksm'
+"""Directory of the KSM counters of the kernel."""
+
+MODELS = ('used', 'balloon', 'ksm', 'effective')
+"""Memory models: the used memory, at least the balloon size, the used
+memory plus the share of the KSM savings of the node, or both.
+"""
+
+KSMLOSS = 100
+"""Default percentage of its share of the KSM savings that a VM is
+assumed to lose by a migration.
+"""
+
+
+def _ksmmerging(pvevm):
+    """Return if the pages of the VM are merged by KSM, which is done
+    for running QEMU VMs only.
+    """
+    return pvevm.type == 'qemu' and pvevm.status == 'running'
+
+def localnode():
+    """Return the name of the node vman runs on."""
+    return socket.gethostname().split('.')[0]
+
+def ksmsaved(ksmdir=KSMDIR):
+    """Return the memory in bytes saved by KSM on this node, i.e. the
+    number of pages sharing merged pages times the page size, or None if
+    KSM is not available.
+    """
+    try:
+        with open(os.path.join(ksmdir, 'pages_sharing')) as ksmfile:
+            sharing = int(ksmfile.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+    return sharing * os.sysconf('SC_PAGE_SIZE')
+
+def annotate(cluster, nodename=None, ksmdir=KSMDIR):
+    """Set the balloon size in bytes of the running QEMU VMs of the node
+    with the given name, by default the one vman runs on, as optional
+    attribute balloon, and the memory saved by KSM as ksmsaved on the
+    node. Does nothing if the node is not part of the cluster.
+    """
+    if nodename is None:
+        nodename = localnode()
+
+    if nodename not in cluster:
+        return
+
+    node = cluster[nodename]
+    saved = ksmsaved(ksmdir)
+
+    if saved is not None:
+        node.attrs['ksmsaved'] = saved
+
+    vms = node.vms(_ksmmerging)
+    balloons = pveqemumonitor.query_balloons([v.vmid for v in vms])
+
+    for pvevm in vms:
+        if pvevm.vmid in balloons:
+            pvevm.attrs['balloon'] = balloons[pvevm.vmid]
+
+def effective(cluster, model, ksmloss=KSMLOSS):
+    """Return a frozen clone of the cluster with the used memory of the
+    VMs replaced by the effective memory of the model (see MODELS). The
+    KSM savings of a node are split among its running QEMU VMs by their
+    used memory and ksmloss percent of the share is added. The original
+    used memory is kept as attribute usedmem.
+    """
+    if model not in MODELS:
+        raise InputError('unknown memory model {}'.format(model))
+
+    newcluster = cluster.clone()
+
+    for node in newcluster.nodes():
+        saved = node.attrs.get('ksmsaved') or 0
+        merging = node.vms(_ksmmerging)
+        total = sum([v.mem for v in merging])
+
+        for pvevm in node.vms():
+            mem = pvevm.mem
+            pvevm.attrs['usedmem'] = mem
+
+            if model in ('balloon', 'effective'):
+                mem = max(mem, pvevm.attrs.get('balloon') or 0)
+
+            if model in ('ksm', 'effective') and total \
+                    and pvevm in merging:
+                mem += saved * ksmloss * pvevm.usedmem // total // 100
+
+            pvevm.attrs['mem'] = int(mem)
+
+    newcluster.freeze()
+
+    return newcluster
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides a search for balancing plans that reach the
+target memory imbalance with as few migrations or as little migrated
+memory as possible. Plans are built by a randomized greedy construction
+that is pruned as soon as it can't beat the best plan found so far and
+improved by a local search that tries to drop or shrink migrations. The
+search runs until the time budget is used up and returns the best plan.
+"""
+
+from __future__ import division
+
+import random
+import time
+
+
+TIMEBUDGET = 5
+"""Default number of seconds the search may take."""
+
+OBJECTIVES = ('count', 'memory', 'time')
+"""Objectives that can be minimized: the number of migrations, the
+amount of migrated memory or the estimated migration time."""
+
+CANDIDATES = 3
+"""Number of best VMs a randomized construction step chooses from."""
+
+
+class BalanceProblem(object):
+    """Plain representation of the nodes and VMs considered for
+    balancing. Nodes and VMs are referred to by their list index.
+    """
+    def __init__(self, nodes, vmfilter=None, costmodel=None):
+        self.nodeids = [n.id for n in nodes]
+        self.memtotal = [n.memtotal for n in nodes]
+        self.baseload = [0] * len(nodes)
+        self.vmids = []
+        self.vmmem = []
+        self.vmcost = []
+        self.origin = []
+
+        for index, node in enumerate(nodes):
+            for pvevm in node:
+                mem = pvevm.attrs.get('mem') or 0
+
+                if pvevm.migrateable and (vmfilter is None
+                                          or vmfilter(pvevm)):
+                    self.vmids.append(pvevm.id)
+                    self.vmmem.append(mem)
+                    self.vmcost.append(costmodel.estimate(pvevm)
+                                       if costmodel is not None else 0)
+                    self.origin.append(index)
+                else:
+                    self.baseload[index] += mem
+
+    def loads(self, assign):
+        """Return the list of node loads for the given assignment."""
+        loads = list(self.baseload)
+
+        for vm, node in enumerate(assign):
+            loads[node] += self.vmmem[vm]
+
+        return loads
+
+    def imbalance(self, loads):
+        """Return the difference between the highest and the lowest
+        memory usage percentage of the nodes.
+        """
+        percs = [l * 100 / t for l, t in zip(loads, self.memtotal)]
+        return max(percs) - min(percs)
+
+    def cost(self, assign, objective):
+        """Return the sort key of the assignment for the objective."""
+        moved = [vm for vm, node in enumerate(assign)
+                 if node != self.origin[vm]]
+        count = len(moved)
+        memory = sum([self.vmmem[vm] for vm in moved])
+
+        if objective == 'memory':
+            return (memory, count)
+
+        if objective == 'time':
+            return (sum([self.vmcost[vm] for vm in moved]), count)
+
+        return (count, memory)
+
+
+class BalanceSearch(object):
+    """Search for the cheapest assignment of VMs to nodes that has an
+    imbalance below diffperc with at most maxmoves steps.
+    """
+    def __init__(self, problem, diffperc, maxmoves, objective='count',
+                 seed=None):
+        if objective not in OBJECTIVES:
+            raise ValueError("unknown objective '{}'".format(objective))
+
+        self.problem = problem
+        self.diffperc = diffperc
+        self.maxmoves = maxmoves
+        self.objective = objective
+        self.random = random.Random(seed)
+
+        self.best = None
+        self.bestcost = None
+        self.constructions = 0
+
+    def feasible(self, assign):
+        """Return if the assignment reaches the target imbalance."""
+        loads = self.problem.loads(assign)
+        return self.problem.imbalance(loads) < self.diffperc
+
+    def consider(self, assign):
+        """Keep the assignment if it is feasible and better than the
+        best one so far. Return if it was kept.
+        """
+        if not self.feasible(assign):
+            return False
+
+        cost = self.problem.cost(assign, self.objective)
+
+        if self.bestcost is None or cost < self.bestcost:
+            self.best = list(assign)
+            self.bestcost = cost
+            return True
+
+        return False
+
+    def _stepcost(self, assign, vm, node):
+        """Return the objective cost change of moving vm to node."""
+        problem = self.problem
+        wasmoved = problem.origin[vm] != assign[vm]
+        ismoved = problem.origin[vm] != node
+        count = int(ismoved) - int(wasmoved)
+
+        if self.objective == 'memory':
+            return count * problem.vmmem[vm]
+
+        if self.objective == 'time':
+            return count * problem.vmcost[vm]
+
+        return count
+
+    def construct(self, candidates=1):
+        """Build an assignment greedily by moving VMs from the node with
+        the highest to the node with the lowest usage. In every step the
+        VM whose memory is closest to the amount that evens both nodes
+        is chosen, preferring VMs that return to their origin node. With
+        candidates > 1, the VM is chosen randomly among that many best
+        ones. Return the assignment or None if it was pruned.
+        """
+        problem = self.problem
+        assign = list(problem.origin)
+        loads = list(problem.loads(assign))
+        onnode = [[] for _ in problem.nodeids]
+        spent = 0
+
+        for vm, node in enumerate(assign):
+            onnode[node].append(vm)
+
+        self.constructions += 1
+
+        for _ in range(self.maxmoves):
+            percs = [l * 100 / t for l, t in zip(loads, problem.memtotal)]
+            high = percs.index(max(percs))
+            low = percs.index(min(percs))
+
+            if percs[high] - percs[low] < self.diffperc:
+                return assign
+
+            if not onnode[high]:
+                return None
+
+            thigh = problem.memtotal[high]
+            tlow = problem.memtotal[low]
+            ideal = (loads[high] * tlow - loads[low] * thigh) / (thigh + tlow)
+
+            ranked = sorted(
+                onnode[high],
+                key=lambda vm: (problem.origin[vm] != low,
+                                abs(problem.vmmem[vm] - ideal),
+                                problem.vmids[vm]))
+            vm = self.random.choice(ranked[:candidates])
+
+            spent += self._stepcost(assign, vm, low)
+
+            # Prune: even a single further step can't beat the best
+            # plan if the cost spent so far is already as high.
+            if self.bestcost is not None and spent >= self.bestcost[0]:
+                return None
+
+            onnode[high].remove(vm)
+            onnode[low].append(vm)
+            loads[high] -= problem.vmmem[vm]
+            loads[low] += problem.vmmem[vm]
+            assign[vm] = low
+
+        if self.feasible(assign):
+            return assign
+
+        return None
+
+    def improve(self, assign):
+        """Local search on a feasible assignment: move migrated VMs back
+        to their origin if the result stays feasible, and replace
+        migrated VMs by smaller VMs from the same origin node going to
+        the same target. Return the improved assignment.
+        """
+        problem = self.problem
+        loads = problem.loads(assign)
+        bysize = sorted(range(len(assign)), key=lambda vm: problem.vmmem[vm])
+
+        def shift(vm, target):
+            loads[assign[vm]] -= problem.vmmem[vm]
+            loads[target] += problem.vmmem[vm]
+            assign[vm] = target
+
+            return problem.imbalance(loads) < self.diffperc
+
+        improved = True
+
+        while improved:
+            improved = False
+            moved = [vm for vm in reversed(bysize)
+                     if assign[vm] != problem.origin[vm]]
+
+            for vm in moved:
+                target = assign[vm]
+                origin = problem.origin[vm]
+
+                if shift(vm, origin):
+                    improved = True
+                    break
+
+                for other in bysize:
+                    if problem.vmmem[other] >= problem.vmmem[vm]:
+                        break
+
+                    if assign[other] != origin \
+                            or problem.origin[other] != origin:
+                        continue
+
+                    if shift(other, target):
+                        improved = True
+                        break
+
+                    shift(other, origin)
+
+                if improved:
+                    break
+
+                shift(vm, target)
+
+        return assign
+
+    def run(self, timebudget=TIMEBUDGET):
+        """Search until the time budget in seconds is used up or the
+        best possible plan was found. The first construction is
+        deterministic and always completed. Return the best assignment
+        or None if no feasible one was found.
+        """
+        deadline = time.time() + timebudget
+        candidates = 1
+
+        while True:
+            assign = self.construct(candidates)
+
+            if assign is not None and self.consider(assign):
+                self.consider(self.improve(list(assign)))
+
+            if self.bestcost is not None and self.bestcost[0] == 0:
+                break
+
+            if time.time() >= deadline:
+                break
+
+            candidates = CANDIDATES
+
+        return self.best
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides bin packing of VMs onto nodes with memory and
+CPU capacity limits. It works on plain tuples and dictionaries instead
+of the cluster objects so it stays fast for thousands of VMs.
+"""
+
+from __future__ import division
+
+import bisect
+
+from pve_vman import pveresources
+
+
+MEMLIMIT = 90
+"""Default percentage of node memory that may be used by VMs."""
+
+CPULIMIT = 100
+"""Default percentage of node CPUs that may be used by VMs."""
+
+FITS = ('best', 'first', 'worst')
+"""Strategies for choosing the node among the ones a VM fits on."""
+
+
+def vmitem(pvevm, memattr='mem'):
+    """Return (vmid, memory, cpu) tuple of the VM as used for packing.
+    The CPU value is the number of CPUs used by the VM.
+    """
+    return (
+        pvevm.id,
+        pvevm.attrs.get(memattr) or 0,
+        pveresources.vmload(pvevm)['cpu'])
+
+def itemkey(item):
+    """Return the sort key of the item (see vmitem) for packing, the
+    biggest items first.
+    """
+    return (-item[1], -item[2], item[0])
+
+def nodebin(node, memlimit=MEMLIMIT, cpulimit=CPULIMIT, memattr='mem'):
+    """Return (nodeid, free memory, free cpu) tuple of the node with
+    regard to the given limits in percent and the VMs on it.
+    """
+    items = [vmitem(v, memattr) for v in node]
+    memfree = node.memtotal * memlimit / 100 - sum([i[1] for i in items])
+    cpufree = node.maxcpu * cpulimit / 100 - sum([i[2] for i in items])
+
+    return (node.id, memfree, cpufree)
+
+def pack(items, bins, fit='best', constraints=None):
+    """Place the items (see vmitem) onto the bins (see nodebin) in
+    order of decreasing memory. Return a tuple of the placements dict
+    mapping vmids to nodeids, the unplaced items and the remaining bins.
+
+    With fit 'best', an item goes to the node with the least memory
+    left that it fits on, with 'worst' to the one with the most memory
+    left and with 'first' to the first node in the given bins order.
+    With constraints (see pveconstraints), items only go to the nodes
+    the index allows.
+    """
+    if fit not in FITS:
+        raise ValueError("unknown fit '{}'".format(fit))
+
+    order = dict((b[0], i) for i, b in enumerate(bins))
+    cpufree = dict((b[0], b[2]) for b in bins)
+    # Bins sorted by free memory, kept sorted with bisect on every
+    # placement, so finding a node is logarithmic for best and worst
+    # fit as long as the CPU limit is no concern.
+    bymem = sorted((b[1], order[b[0]], b[0]) for b in bins)
+    placements = {}
+    unplaced = []
+
+    for item in sorted(items, key=itemkey):
+        vmid, mem, cpu = item
+        start = bisect.bisect_left(bymem, (mem, -1, ''))
+        candidates = range(start, len(bymem))
+
+        if fit == 'worst':
+            candidates = reversed(candidates)
+        elif fit == 'first':
+            candidates = sorted(candidates, key=lambda i: bymem[i][1])
+
+        for index in candidates:
+            nodeid = bymem[index][2]
+            if cpufree[nodeid] >= cpu and (
+                    constraints is None or constraints.allows(vmid, nodeid)):
+                break
+        else:
+            unplaced.append(item)
+            continue
+
+        memfree, position, nodeid = bymem.pop(index)
+        bisect.insort(bymem, (memfree - mem, position, nodeid))
+        cpufree[nodeid] -= cpu
+        placements[vmid] = nodeid
+
+        if constraints is not None:
+            constraints.move(vmid, nodeid)
+
+    remaining = sorted(
+        ((b[2], b[0], cpufree[b[2]]) for b in bymem),
+        key=lambda b: order[b[0]])
+
+    return (placements, unplaced, remaining)
+
+def _gib(value):
+    return '{:.1f}G'.format(value / 1024 ** 3)
+
+def report(unplaced, remaining, maxlines=10):
+    """Return a human readable description of the VMs that could not be
+    placed and the remaining capacity of the nodes. At most maxlines
+    VMs are listed.
+    """
+    lines = ['{} VMs do not fit ({} memory, {:.1f} CPUs):'.format(
+        len(unplaced),
+        _gib(sum([i[1] for i in unplaced])),
+        sum([i[2] for i in unplaced]))]
+
+    for vmid, mem, cpu in unplaced[:maxlines]:
+        lines.append('  VM {}: {} memory, {:.1f} CPUs'.format(
+            vmid, _gib(mem), cpu))
+
+    if len(unplaced) > maxlines:
+        lines.append('  ... and {} more'.format(len(unplaced) - maxlines))
+
+    lines.append('free capacity:')
+
+    for nodeid, memfree, cpufree in remaining:
+        lines.append('  Node {}: {} memory, {:.1f} CPUs'.format(
+            nodeid, _gib(memfree), cpufree))
+
+    return '\n'.join(lines)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides saving migration plans to compact JSON files
+and loading them again, so a reviewed plan can be executed later
+without replanning. A plan holds the fingerprint of the VM placement
+of the cluster it was computed against, which is checked against the
+placement of the cluster it is applied to.
+"""
+
+import hashlib
+import json
+import time
+
+from pve_vman.exceptions import InputError, PlanningError
+
+
+VERSION = 1
+"""Version of the plan file format."""
+
+
+def vmnodes(cluster):
+    """Return dictionary mapping the VM ids of the cluster to the node
+    the VM was on when the cluster was built, i.e. before any planned
+    move.
+    """
+    return dict((pvevm.id, pvevm.node) for pvevm in cluster.vms())
+
+def fingerprint(vmnodes):
+    """Return the fingerprint of the given mapping of VM ids to nodes.
+    """
+    placement = ';'.join(['{}:{}'.format(vmid, vmnodes[vmid])
+                          for vmid in sorted(vmnodes)])
+
+    return hashlib.sha1(placement.encode('utf-8')).hexdigest()
+
+def dump(command, newcluster):
+    """Return the plan of the migrations necessary to reach the state
+    of the newcluster object as dictionary. The fingerprint is the one
+    of the VM placement the newcluster was planned from.
+    """
+    return {
+        'version': VERSION,
+        'command': command,
+        'created': int(time.time()),
+        'fingerprint': fingerprint(vmnodes(newcluster)),
+        'migrations': [[m.pvevm.id, m.pvevm.node, m.target]
+                       for m in newcluster.migrations()],
+    }
+
+def save(planpath, command, newcluster):
+    """Write the plan for the newcluster object to the given file."""
+    with open(planpath, 'w') as planfile:
+        json.dump(dump(command, newcluster), planfile,
+                  separators=(',', ':'))
+
+def load(planpath):
+    """Return the plan read from the given file. Raise InputError if the
+    file is not a valid plan.
+    """
+    try:
+        with open(planpath) as planfile:
+            plan = json.load(planfile)
+    except (IOError, OSError, ValueError) as exc:
+        raise InputError("can't read plan '{}': {}".format(planpath, exc))
+
+    if not isinstance(plan, dict) or plan.get('version') != VERSION \
+            or not isinstance(plan.get('migrations'), list):
+        raise InputError("'{}' is not a valid plan".format(planpath))
+
+    return plan
+
+def validate(plan, cluster, force=False):
+    """Raise PlanningError if the VM placement of the cluster differs
+    from the one the plan was computed from, unless force is set.
+    Return if it is unchanged.
+    """
+    unchanged = plan.get('fingerprint') == fingerprint(vmnodes(cluster))
+
+    if not unchanged and not force:
+        raise PlanningError('VM placement changed since the plan was '
+                            'computed')
+
+    return unchanged
+
+def apply(cluster, plan):
+    """Return a clone of the cluster with the migrations of the plan
+    applied. Raise PlanningError if a VM of the plan is gone, not on
+    its source node anymore or the target node is not online.
+    """
+    newcluster = cluster.clone()
+    pvevms = dict((v.id, v) for v in newcluster.vms())
+
+    for vmid, source, target in plan['migrations']:
+        vmid, source, target = str(vmid), str(source), str(target)
+        pvevm = pvevms.get(vmid)
+
+        if pvevm is None or pvevm.node != source:
+            raise PlanningError('VM {} is not on node {} anymore'.format(
+                vmid, source))
+
+        if target not in newcluster or not newcluster[target].isonline:
+            raise PlanningError('target node {} of VM {} is not '
+                                'online'.format(target, vmid))
+
+        newcluster[source].remove(pvevm)
+        newcluster[target].add(pvevm)
+
+    return newcluster
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides timing the phases of a vman run, i.e. reading
+and parsing the PVE files, building and cloning the cluster, planning,
+QMP and pvesh calls. The timed functions are only wrapped while a
+Profiler is enabled, so there is no cost otherwise. Optionally, the
+whole run is recorded with cProfile.
+"""
+
+import cProfile
+import functools
+import importlib
+import time
+
+
+TARGETS = (
+    ('pvefiles', '_readfile'),
+    ('pvefiles', 'vmconf'),
+    ('pvefiles', 'storageconf'),
+    ('pvefiles', 'stats'),
+    ('pvefiles', 'haconf'),
+    ('pvefiles', 'hagroupconf'),
+    ('pvestats', 'buildcluster'),
+    ('pvestats', 'PVEStatCluster.clone'),
+    ('pvestats', 'PVEStatCluster.migrations'),
+    ('pvecluster', 'planbalance'),
+    ('pvecluster', 'planmultibalance'),
+    ('pvecluster', 'planoptimizedbalance'),
+    ('pvecluster', 'planflush'),
+    ('pvecluster', 'planflushpacked'),
+    ('pveschedule', 'schedule'),
+    ('pveqemumonitor', 'query_blockstats'),
+    ('pveqemumonitor', 'query_balloons'),
+    ('pvesh', 'PVESH.run'),
+)
+"""Functions timed by the profiler as (module, attribute path)."""
+
+
+class Profiler(object):
+    """Timers and call counters of the functions in TARGETS."""
+    def __init__(self, targets=TARGETS):
+        self.targets = targets
+        self.timers = {}
+        self.patched = []
+        self.started = None
+        self.duration = None
+        self.cprofile = None
+
+    def _wrap(self, name, func):
+        timers = self.timers
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer = timers.setdefault(name, [0, 0.0])
+                timer[0] += 1
+                timer[1] += time.time() - start
+
+        return wrapper
+
+    def enable(self, cprofile=False):
+        """Wrap the target functions and start the timing, with cprofile
+        also start recording with cProfile.
+        """
+        for modulename, path in self.targets:
+            owner = importlib.import_module('pve_vman.' + modulename)
+            parts = path.split('.')
+
+            for part in parts[:-1]:
+                owner = getattr(owner, part)
+
+            if isinstance(owner, type):
+                original = owner.__dict__[parts[-1]]
+            else:
+                original = getattr(owner, parts[-1])
+
+            setattr(owner, parts[-1], self._wrap(
+                '{}.{}'.format(modulename, path), original))
+            self.patched.append((owner, parts[-1], original))
+
+        if cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+        self.started = time.time()
+
+    def disable(self):
+        """Restore the target functions and stop the timing."""
+        self.duration = time.time() - self.started
+
+        if self.cprofile is not None:
+            self.cprofile.disable()
+
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+
+        self.patched = []
+
+    def report(self):
+        """Return the calls and times of the phases, slowest first, as
+        text. Times include the ones of the phases called by a phase.
+        """
+        lines = ['{:36s} {:>7s} {:>10s}'.format('Phase', 'Calls', 'Time')]
+
+        for name, (calls, duration) in sorted(
+                self.timers.items(), key=lambda t: (-t[1][1], t[0])):
+            lines.append('{:36s} {:7d} {:8.1f}ms'.format(
+                name, calls, duration * 1000))
+
+        if self.duration is not None:
+            lines.append('{:36s} {:7s} {:8.1f}ms'.format(
+                'total', '', self.duration * 1000))
+
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Write the cProfile statistics to the given file."""
+        self.cprofile.dump_stats(path)
@@ -23,9 +23,21 @@
 """This module provides functions for interacting with the QEMU monitor
 via its unix socket."""
 
+import json
+import logging
 import os
+import select
 import socket
-import json
+import time
+
+
+BALLOONTIMEOUT = 1.0
+"""Seconds to wait for the answers of the monitors in query_balloons."""
+
+BALLOONBATCH = 256
+"""Maximum number of monitors query_balloons has open at once, which
+keeps the sockets below the limits of select and of the process.
+"""
 
 
 class PVEQEMUMonitor(object):
@@ -109,3 +121,79 @@ def query_blockstats(vmid):
     pqm.send(execute='query-blockstats')
 
     return pqm.receive()
+
+def _balloonbatch(vmids, balloons, timeout):
+    """Query the balloon sizes of the VMs with the given IDs into the
+    balloons dictionary, see query_balloons.
+    """
+    _logger = logging.getLogger(__name__)
+    # the capabilities negotiation and the query are sent without
+    # waiting for the greeting, QEMU answers them in order
+    request = (json.dumps({'execute': 'qmp_capabilities'})
+               + json.dumps({'execute': 'query-balloon', 'id': 'balloon'}))
+    pending = {}
+
+    for vmid in vmids:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(PVEQEMUMonitor.socketpath_fmt.format(vmid))
+            sock.sendall(request.encode())
+        except socket.error as exc:
+            _logger.debug('skipping balloon of VM %s: %s', vmid, exc)
+            sock.close()
+            continue
+        pending[sock] = [vmid, b'']
+
+    deadline = time.time() + timeout
+
+    try:
+        while pending and time.time() < deadline:
+            readable, _, _ = select.select(
+                list(pending), [], [], max(deadline - time.time(), 0))
+
+            for sock in readable:
+                vmid, data = pending[sock]
+                answer = None
+                try:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        raise socket.error('connection closed')
+                    lines = (data + chunk).split(b'\n')
+                    pending[sock][1] = lines.pop()
+                    # skip the greeting, the capabilities answer and
+                    # events
+                    for line in lines:
+                        message = json.loads(line.decode()) \
+                            if line.strip() else {}
+                        if message.get('id') == 'balloon':
+                            answer = message
+                    if answer is None:
+                        continue
+                    if 'error' in answer:
+                        raise ValueError(answer['error'])
+                    balloons[vmid] = answer['return']['actual']
+                except (socket.error, ValueError, KeyError) as exc:
+                    _logger.debug('skipping balloon of VM %s: %s', vmid, exc)
+                del pending[sock]
+                sock.close()
+    finally:
+        for sock, (vmid, _) in pending.items():
+            _logger.debug('skipping balloon of VM %s: no answer', vmid)
+            sock.close()
+
+def query_balloons(vmids, timeout=BALLOONTIMEOUT):
+    """Return dictionary of the current balloon size in bytes of the VMs
+    with the given IDs, read from their QEMU monitors in one pass: all
+    monitors are connected and sent the capabilities negotiation and
+    the query before any answer is read, then the answers are read as
+    they arrive until timeout seconds have passed. VMs that are not
+    running, have no balloon device or don't answer in time are left
+    out and logged at debug level.
+    """
+    vmids = list(vmids)
+    balloons = {}
+
+    for start in range(0, len(vmids), BALLOONBATCH):
+        _balloonbatch(vmids[start:start + BALLOONBATCH], balloons, timeout)
+
+    return balloons
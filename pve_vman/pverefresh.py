@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides a background thread that keeps a recent
+PVEStatCluster object in memory for long running vman processes.
+"""
+
+import logging
+import threading
+import time
+
+from pve_vman import pvestats
+
+
+REFRESHINTERVAL = 30
+"""Default number of seconds between two cluster refreshes."""
+
+
+class PVEStatRefresher(threading.Thread):
+    """Thread that rebuilds the cluster object every interval seconds.
+    The last successfully built cluster is frozen and available as the
+    cluster attribute. Callables registered with addlistener are called
+    with the new cluster object after every refresh.
+
+    Example:
+        r = PVEStatRefresher(10)
+        r.start()
+        r.wait()                # blocks until the first refresh is done
+        print(r.cluster.memused_perc)
+    """
+    def __init__(self, interval=REFRESHINTERVAL, builder=None):
+        super(PVEStatRefresher, self).__init__()
+        self.daemon = True
+
+        if builder is None:
+            builder = pvestats.buildcluster
+
+        self.interval = interval
+        self.builder = builder
+        self.cluster = None
+        self.timestamp = None
+        self.duration = None
+        self.errors = 0
+        self.listeners = []
+
+        self._ready = threading.Event()
+        self._stopevent = threading.Event()
+
+    def addlistener(self, listener):
+        """Register a callable that is called with the new cluster
+        object after every successful refresh.
+        """
+        self.listeners.append(listener)
+
+    def refresh(self):
+        """Build a new cluster object and notify all listeners. Errors
+        are logged and counted, the last cluster object is kept then.
+        """
+        _logger = logging.getLogger(__name__)
+        start = time.time()
+
+        try:
+            cluster = self.builder()
+            cluster.freeze()
+        except Exception as exc:
+            self.errors += 1
+            _logger.warning('cluster refresh failed: %s', exc)
+            return False
+
+        self.cluster = cluster
+        self.timestamp = time.time()
+        self.duration = self.timestamp - start
+
+        for listener in self.listeners:
+            try:
+                listener(cluster)
+            except Exception as exc:
+                self.errors += 1
+                _logger.warning('refresh listener failed: %s', exc)
+
+        self._ready.set()
+
+        return True
+
+    def run(self):
+        while not self._stopevent.is_set():
+            self.refresh()
+            self._stopevent.wait(self.interval)
+
+    def stop(self):
+        """Stop the refresh loop after the current iteration."""
+        self._stopevent.set()
+
+    def wait(self, timeout=None):
+        """Block until the first cluster object is available. Return
+        if a cluster object is available.
+        """
+        self._ready.wait(timeout)
+        return self._ready.is_set()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides reconciling the remaining part of a migration
+plan with a freshly built cluster object, so a long running execution
+can replan between migration waves instead of following a stale plan.
+"""
+
+import logging
+
+
+def planned(migrations):
+    """Return dictionary mapping the vmids of the migrations to their
+    target nodes.
+    """
+    return dict((m.pvevm.id, m.target) for m in migrations)
+
+def reconcile(cluster, remaining, ignorevmids=()):
+    """Return a tuple of a clone of the given fresh cluster with the
+    remaining planned moves (dict of vmid to target node) applied, the
+    list of vmids that already reached their target and the list of
+    vmids whose moves were dropped, because the VM is gone, not
+    migrateable anymore, ignored or the target node is not online.
+    """
+    _logger = logging.getLogger(__name__)
+    newcluster = cluster.clone()
+    pvevms = dict((v.id, v) for v in newcluster.vms())
+    done = []
+    dropped = []
+
+    for vmid, target in sorted(remaining.items()):
+        pvevm = pvevms.get(vmid)
+
+        if pvevm is None or vmid in ignorevmids or not (
+                pvevm.migrateable or pvevm.attrs.get('localmigrateable')):
+            dropped.append(vmid)
+        elif pvevm.node == target:
+            done.append(vmid)
+        elif target not in newcluster or not newcluster[target].isonline:
+            dropped.append(vmid)
+        else:
+            newcluster[pvevm.node].remove(pvevm)
+            newcluster[target].add(pvevm)
+
+    _logger.info('reconciled plan: %d moves kept, %d done, %d dropped',
+                 len(remaining) - len(done) - len(dropped), len(done),
+                 len(dropped))
+
+    return (newcluster, done, dropped)
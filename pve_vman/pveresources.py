@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides a model of the resource usage of the nodes
+across several dimensions (memory, CPU, disk IO and network) that is
+used to score the balance of the cluster. The score is updated
+incrementally on every move, so evaluating a migration only touches
+the source and the target node.
+"""
+
+from __future__ import division
+
+from pve_vman.exceptions import InputError
+
+
+RESOURCES = ('mem', 'cpu', 'io', 'net')
+"""Resource dimensions known to the model."""
+
+WEIGHTS = {'mem': 1.0, 'cpu': 1.0, 'io': 0.5, 'net': 0.5}
+"""Default weights of the resource dimensions."""
+
+
+def rate(pvevm, *attrs):
+    """Return the rate per second of the sum of the given counter
+    attributes of the VM. The rates measured between two snapshots (see
+    pvehistory.setrates) are used if known for all counters, else the
+    average since VM start.
+    """
+    rates = [pvevm.attrs.get(a + 'rate') for a in attrs]
+
+    if None not in rates:
+        return sum(rates)
+
+    uptime = pvevm.attrs.get('uptime') or 0
+
+    if uptime < 1:
+        return 0
+
+    return sum([pvevm.attrs.get(a) or 0 for a in attrs]) / uptime
+
+def vmload(pvevm):
+    """Return dictionary of the load the VM puts on a node for all
+    resource dimensions.
+    """
+    return {
+        'mem': pvevm.attrs.get('mem') or 0,
+        'cpu': ((pvevm.attrs.get('cpu') or 0)
+                * (pvevm.attrs.get('maxcpu') or 0)),
+        'io': rate(pvevm, 'diskread', 'diskwrite'),
+        'net': rate(pvevm, 'netin', 'netout')}
+
+def nodecapacity(node):
+    """Return dictionary of the capacity of the node for all resource
+    dimensions. Disk IO and network are considered to be equal on all
+    nodes.
+    """
+    return {
+        'mem': node.attrs.get('memtotal') or 0,
+        'cpu': node.attrs.get('maxcpu') or 0,
+        'io': 1,
+        'net': 1}
+
+def parseweights(value):
+    """Return weights dictionary for strings like 'mem=1,cpu=0.5'.
+    Dimensions not given get a weight of 0.
+    """
+    weights = dict((r, 0.0) for r in RESOURCES)
+
+    for item in value.split(','):
+        key, _, weight = item.partition('=')
+        key = key.strip()
+
+        if key not in RESOURCES:
+            raise InputError("unknown resource '{}'".format(key))
+
+        try:
+            weights[key] = float(weight) if weight else 1.0
+        except ValueError:
+            raise InputError("invalid weight '{}'".format(weight))
+
+    return weights
+
+
+class ResourceModel(object):
+    """Usage model of the given nodes. The utilization of a node in a
+    dimension is its load to capacity ratio relative to the one of all
+    nodes, so 1.0 is the cluster average. The score is the weighted sum
+    of the squared deviations from the average over all nodes and
+    dimensions. As moving VMs between the modelled nodes doesn't change
+    the averages, a move only changes the terms of two nodes.
+    """
+    def __init__(self, nodes, weights=None):
+        if weights is None:
+            weights = WEIGHTS
+
+        self.weights = dict((r, weights.get(r, 0)) for r in RESOURCES)
+        self.resources = [r for r in RESOURCES if self.weights[r] > 0]
+        self.loads = {}
+        self.capacities = {}
+        self.vmloads = {}
+        self.scale = {}
+
+        for node in nodes:
+            self.capacities[node.id] = nodecapacity(node)
+            self.loads[node.id] = dict((r, 0) for r in RESOURCES)
+
+            for pvevm in node:
+                load = self.vmloads[pvevm.id] = vmload(pvevm)
+
+                for resource in RESOURCES:
+                    self.loads[node.id][resource] += load[resource]
+
+        # Dimensions without any load or capacity are balanced by
+        # definition and therefore ignored.
+        for resource in list(self.resources):
+            totalload = sum([l[resource] for l in self.loads.values()])
+            totalcap = sum([c[resource] for c in self.capacities.values()])
+
+            if totalload <= 0 or totalcap <= 0:
+                self.resources.remove(resource)
+            else:
+                self.scale[resource] = totalcap / totalload
+
+        # Precompute the factor turning a load into a utilization per
+        # node and dimension to keep the evaluation of moves cheap.
+        self.factors = {}
+
+        for nodeid, capacity in self.capacities.items():
+            self.factors[nodeid] = dict(
+                (r, self.scale[r] / capacity[r] if capacity[r] > 0 else 0)
+                for r in self.resources)
+
+        self.nodescores = dict(
+            (n, self._nodescore(self.loads[n], n)) for n in self.loads)
+        self.score = sum(self.nodescores.values())
+
+    def utilization(self, nodeid, resource, load=None):
+        """Return the relative utilization of the node in the given
+        dimension. If load is given, it is used instead of the current
+        load of the node.
+        """
+        if load is None:
+            load = self.loads[nodeid][resource]
+
+        return load * self.factors[nodeid][resource]
+
+    def _nodescore(self, loads, nodeid):
+        factors = self.factors[nodeid]
+
+        return sum([
+            self.weights[r] * (loads[r] * factors[r] - 1) ** 2
+            for r in self.resources])
+
+    def overload(self, nodeid):
+        """Return the weighted sum of the utilization above average of
+        the node. Nodes with a high value are sources for migrations.
+        """
+        return sum([
+            self.weights[r] * max(0, self.utilization(nodeid, r) - 1)
+            for r in self.resources])
+
+    def deviation(self):
+        """Return the highest utilization deviation from the average in
+        percent of any node in any weighted dimension.
+        """
+        deviations = [
+            abs(self.utilization(n, r) - 1) * 100
+            for n in self.loads for r in self.resources]
+
+        return max(deviations) if deviations else 0
+
+    def _moved(self, vmid, nodeid, sign):
+        load = self.vmloads[vmid]
+        return dict(
+            (r, self.loads[nodeid][r] + sign * load[r]) for r in RESOURCES)
+
+    def delta(self, vmid, source, target):
+        """Return the change of the score if the VM is moved from the
+        source to the target node.
+        """
+        load = self.vmloads[vmid]
+        sourceloads = self.loads[source]
+        targetloads = self.loads[target]
+        sourcefactors = self.factors[source]
+        targetfactors = self.factors[target]
+        score = -self.nodescores[source] - self.nodescores[target]
+
+        for resource in self.resources:
+            weight = self.weights[resource]
+            score += weight * ((sourceloads[resource] - load[resource])
+                               * sourcefactors[resource] - 1) ** 2
+            score += weight * ((targetloads[resource] + load[resource])
+                               * targetfactors[resource] - 1) ** 2
+
+        return score
+
+    def move(self, vmid, source, target):
+        """Update the model for the VM moved from source to target."""
+        self.loads[source] = self._moved(vmid, source, -1)
+        self.loads[target] = self._moved(vmid, target, 1)
+
+        for nodeid in (source, target):
+            newscore = self._nodescore(self.loads[nodeid], nodeid)
+            self.score += newscore - self.nodescores[nodeid]
+            self.nodescores[nodeid] = newscore
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides planning of rolling maintenance, i.e. emptying
+a list of nodes one after another, e.g. for kernel updates. The VMs of
+a node are preferably moved to nodes that are already done, so no VM
+has to be moved twice, and the progress is kept in a state file to
+resume after every node.
+"""
+
+from __future__ import division
+
+import json
+import logging
+import os
+
+from pve_vman import pvecluster, pvepacking
+from pve_vman.exceptions import InputError, PlanningError
+
+
+STATEFILE = '/var/lib/pve_vman/rolling.json'
+"""Default path of the file holding the rolling maintenance progress."""
+
+
+def settle(cluster):
+    """Return a clone of the cluster with all planned moves treated as
+    done, so the migrations of the clone are relative to the given
+    cluster's target state.
+    """
+    newcluster = cluster.clone()
+
+    for node in newcluster.nodes():
+        for pvevm in node.vms():
+            pvevm.attrs['node'] = node.id
+
+    return newcluster
+
+def _fits(node, pvevm, memlimit):
+    return node.memvmused + (pvevm.mem or 0) \
+        <= node.memtotal * memlimit / 100
+
+def _target(cluster, pvevm, tiers, memlimit, constraints=None,
+            storage=None):
+    """Return the node with the lowest memory usage of the first tier
+    of nodes the VM fits on within the memory limit and, if given, the
+    constraints and the storage index allow.
+    """
+    for tier in tiers:
+        node = cluster.lowestnode(
+            'memvmnodeused_perc',
+            lambda n: n.id in tier and n.isonline
+            and _fits(n, pvevm, memlimit)
+            and (constraints is None or constraints.allows(pvevm, n))
+            and (storage is None or storage.allows(pvevm, n)))
+
+        if node is not None:
+            return node
+
+    return None
+
+def remaining(cluster, nodename, onlyha=False, localdisks=False):
+    """Return the list of VMs on the node that emptying it would
+    migrate, i.e. that are left on it after it has been emptied, e.g.
+    because their migration failed.
+    """
+    if nodename not in cluster.keys():
+        return []
+
+    return [v for v in cluster[nodename].migrateable_vms(localdisks)
+            if not onlyha or v.ha]
+
+def planrolling(cluster, nodenames, donenames=(), onlyha=False,
+                ignorenodenames=None, ignorevmids=None,
+                memlimit=pvepacking.MEMLIMIT, rebalance=0,
+                constraints=None, storage=None):
+    """Return a list of (nodename, cluster) steps emptying the given
+    nodes in order, skipping the ones in donenames. The migrations of
+    every step's cluster are relative to the previous step. The VMs go
+    to the nodes that are done first, then to nodes not in the list and
+    only if they do not fit anywhere else to nodes that are emptied
+    later, each time to the node with the lowest memory usage that
+    stays within memlimit percent. If rebalance is given, a last step
+    named None balances the cluster with at most that many migrations.
+    With constraints (see pveconstraints), VMs are only moved to nodes
+    the index allows. With a storage index (see pvestorage), VMs with
+    local disks are moved too, to nodes with enough space left on their
+    storages. The given cluster is not changed.
+    """
+    _logger = logging.getLogger(__name__)
+
+    if ignorenodenames is None:
+        ignorenodenames = []
+
+    if ignorevmids is None:
+        ignorevmids = []
+
+    for node in list(nodenames) + list(ignorenodenames):
+        if node not in cluster.keys():
+            raise InputError("node '{}' doesn't exist".format(node))
+
+    done = [n for n in nodenames if n in donenames]
+    pending = [n for n in nodenames if n not in donenames]
+    others = [n for n in cluster.keys()
+              if n not in nodenames and n not in ignorenodenames]
+    current = settle(cluster)
+    steps = []
+
+    for index, name in enumerate(pending):
+        later = [n for n in pending[index + 1:] if n not in ignorenodenames]
+        tiers = ([n for n in done if n not in ignorenodenames], others,
+                 later)
+        step = current.clone()
+        emptynode = step[name]
+
+        if constraints is not None:
+            constraints.evacuate([name])
+
+        for pvevm in emptynode.migrateable_vms(storage is not None):
+            if onlyha and not pvevm.ha or pvevm.id in ignorevmids:
+                continue
+
+            emptynode.remove(pvevm)
+            target = _target(step, pvevm, tiers, memlimit, constraints,
+                             storage)
+
+            if target is None:
+                raise PlanningError(
+                    "no target node found for {} of node '{}'".format(
+                        pvevm, name))
+
+            if target.id in later:
+                _logger.info('%s of %s has to be moved again from %s',
+                             pvevm, name, target.id)
+
+            target.add(pvevm)
+
+            if constraints is not None:
+                constraints.move(pvevm, target)
+
+            if storage is not None:
+                storage.move(pvevm, target)
+
+        steps.append((name, step))
+        current = settle(step)
+        done.append(name)
+
+    if rebalance:
+        try:
+            steps.append((None, pvecluster.planbalance(
+                current.clone(), iterations=rebalance,
+                ignorenodenames=ignorenodenames, ignorevmids=ignorevmids,
+                constraints=constraints, storage=storage)))
+        except PlanningError as exc:
+            _logger.info('no rebalancing: %s', exc)
+
+    return steps
+
+def moves(steps):
+    """Return a tuple of the total number of migrations of the steps
+    and the number of VMs that are migrated more than once.
+    """
+    counts = {}
+
+    for _, step in steps:
+        for migration in step.migrations():
+            vmid = migration.pvevm.id
+            counts[vmid] = counts.get(vmid, 0) + 1
+
+    return (sum(counts.values()), len([c for c in counts.values() if c > 1]))
+
+
+class RollingState(object):
+    """Progress of a rolling maintenance kept in a JSON file: the list
+    of nodes, the ones that are done and the one that is currently
+    emptied and waiting for its maintenance.
+    """
+    def __init__(self, path=STATEFILE):
+        self.path = path
+        self.nodes = []
+        self.done = []
+        self.current = None
+
+    def load(self):
+        """Load the state from the file. Return False if there is none."""
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as statefile:
+            state = json.load(statefile)
+
+        self.nodes = [str(n) for n in state['nodes']]
+        self.done = [str(n) for n in state['done']]
+        self.current = state.get('current')
+
+        if self.current is not None:
+            self.current = str(self.current)
+
+        return True
+
+    def save(self):
+        """Write the state to the file, replacing it atomically."""
+        directory = os.path.dirname(self.path)
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tmppath = '{}.tmp'.format(self.path)
+        with open(tmppath, 'w') as statefile:
+            json.dump({'nodes': self.nodes, 'done': self.done,
+                       'current': self.current}, statefile)
+        os.rename(tmppath, self.path)
+
+    def remove(self):
+        """Remove the state file once all nodes are done."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @property
+    def pending(self):
+        """Return the list of nodes that are not done yet."""
+        return [n for n in self.nodes if n not in self.done]
+
+    def start(self, node):
+        """Mark the node as emptied and waiting for maintenance."""
+        self.current = node
+        self.save()
+
+    def finish(self):
+        """Mark the current node as done."""
+        if self.current is not None and self.current not in self.done:
+            self.done.append(self.current)
+
+        self.current = None
+        self.save()
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides reading the RRD files PVE keeps per node and VM
+in /var/lib/rrdcached/db, so planners can use the usage averaged over
+an hour or a day. rrdcached is asked to write the pending updates of
+the files first. The files are memory mapped and the rows of a window
+are unpacked at once. Only files written on 64 bit little endian hosts,
+i.e. every PVE host, are supported.
+"""
+
+from __future__ import division
+
+import logging
+import math
+import mmap
+import os
+import socket
+import struct
+import time
+
+from pve_vman import pvehistory
+from pve_vman.exceptions import InputError
+
+
+RRDDIR = '/var/lib/rrdcached/db'
+"""Default directory of the PVE RRD files."""
+
+NODEDIRS = ('pve2-node', 'pve-node-9.0')
+"""Subdirectories of the node RRD files, by PVE version."""
+
+VMDIRS = ('pve2-vm', 'pve-vm-9.0')
+"""Subdirectories of the VM RRD files, by PVE version."""
+
+RRDCACHED = '/var/run/rrdcached.sock'
+"""Default socket of rrdcached, which PVE runs to cache the updates of
+the RRD files for up to an hour.
+"""
+
+FLUSHTIMEOUT = 10
+"""Seconds to wait for rrdcached flushing a file."""
+
+STALE = 300
+"""Seconds after the last update of an RRD file it is reported as not
+up to date.
+"""
+
+FLOATCOOKIE = 8.642135e130
+"""Double every RRD file holds to check the float format."""
+
+HEADER = struct.Struct('<4s5s7xdQQQ80x')
+"""Static header: cookie, version, float cookie, number of data sources,
+number of archives and the step in seconds.
+"""
+
+DSDEF = struct.Struct('<20s20s80x')
+"""Data source definition: name and type."""
+
+RRADEF = struct.Struct('<20s4xQQ80x')
+"""Archive definition: consolidation function, number of rows and number
+of steps per row.
+"""
+
+LASTUPDATE = struct.Struct('<q')
+"""Time of the last update, followed by microseconds from version 3."""
+
+PDPPREPSIZE = 112
+"""Size of the per data source state."""
+
+CDPPREPSIZE = 80
+"""Size of the per archive and data source state."""
+
+NODEATTRS = (('mem', 'memused'), ('cpu', 'cpu'), ('netin', 'netin'),
+             ('netout', 'netout'))
+"""Statistics keys and data source names of the node RRD files."""
+
+VMATTRS = (('mem', 'mem'), ('cpu', 'cpu'), ('diskread', 'diskread'),
+           ('diskwrite', 'diskwrite'), ('netin', 'netin'),
+           ('netout', 'netout'))
+"""Statistics keys and data source names of the VM RRD files."""
+
+
+class RRD(object):
+    """Memory mapped RRD file. Raises InputError if the file can't be
+    read or is not a supported RRD file.
+
+    Example:
+        rrd = RRD('/var/lib/rrdcached/db/pve2-vm/100')
+        print(rrd.average(3600)['cpu'])
+        rrd.close()
+    """
+    def __init__(self, path):
+        self.path = path
+
+        try:
+            with open(path, 'rb') as fileh:
+                self.data = mmap.mmap(fileh.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as exc:
+            raise InputError("can't read RRD '{}': {}".format(path, exc))
+
+        try:
+            self._parse()
+        except (struct.error, ValueError):
+            self.close()
+            raise InputError("'{}' is not a supported RRD file".format(path))
+
+    def _parse(self):
+        cookie, version, floatcookie, dscount, rracount, self.step = \
+            HEADER.unpack_from(self.data)
+
+        if cookie != b'RRD\0' or floatcookie != FLOATCOOKIE:
+            raise ValueError('bad cookie')
+
+        offset = HEADER.size
+        self.names = []
+
+        for _ in range(dscount):
+            name = DSDEF.unpack_from(self.data, offset)[0]
+            self.names.append(name.split(b'\0')[0].decode('ascii'))
+            offset += DSDEF.size
+
+        definitions = []
+
+        for _ in range(rracount):
+            definitions.append(RRADEF.unpack_from(self.data, offset))
+            offset += RRADEF.size
+
+        self.lastupdate = LASTUPDATE.unpack_from(self.data, offset)[0]
+        offset += LASTUPDATE.size * (2 if version[:4] >= b'0003' else 1)
+        offset += dscount * PDPPREPSIZE + rracount * dscount * CDPPREPSIZE
+        pointers = struct.unpack_from('<{}Q'.format(rracount),
+                                      self.data, offset)
+        offset += rracount * 8
+
+        # (consolidation function, seconds per row, rows, current row,
+        # offset of the first row)
+        self.archives = []
+
+        for (cfname, rows, steps), current in zip(definitions, pointers):
+            if current >= rows:
+                raise ValueError('bad row pointer')
+            self.archives.append((cfname.split(b'\0')[0].decode('ascii'),
+                                  self.step * steps, rows, current, offset))
+            offset += rows * dscount * 8
+
+        if offset > len(self.data):
+            raise ValueError('truncated')
+
+    def close(self):
+        """Unmap the file."""
+        self.data.close()
+
+    def archive(self, window, cf='AVERAGE'):
+        """Return the archive of the consolidation function with the
+        finest resolution that covers the window, or with the longest
+        coverage if none does.
+        """
+        archives = [a for a in self.archives if a[0] == cf]
+
+        if not archives:
+            raise InputError("'{}' has no {} archive".format(self.path, cf))
+
+        covering = [a for a in archives if a[1] * a[2] >= window]
+
+        if covering:
+            return min(covering, key=lambda a: a[1])
+
+        return max(archives, key=lambda a: a[1] * a[2])
+
+    def fetch(self, window, cf='AVERAGE', now=None):
+        """Return the tuple of the rows of the last window seconds
+        before now, oldest first, each a tuple of the values of the data
+        sources (see names) that are NaN if unknown.
+        """
+        _, seconds, rows, current, offset = self.archive(window, cf)
+
+        if now is None:
+            now = self.lastupdate
+
+        # the current row ends at the last update rounded down to the
+        # archive's resolution, every row before it a row earlier
+        lastrow = self.lastupdate - self.lastupdate % seconds
+        count = int(math.ceil((lastrow - now + window) / seconds))
+        count = max(0, min(count, rows))
+
+        width = len(self.names)
+        first = current - count + 1
+        chunks = [(first, count)] if first >= 0 else \
+            [(rows + first, -first), (0, current + 1)]
+        values = ()
+
+        for row, length in chunks:
+            values += struct.unpack_from(
+                '<{}d'.format(length * width), self.data,
+                offset + row * width * 8)
+
+        return tuple(values[i:i + width]
+                     for i in range(0, len(values), width))
+
+    def average(self, window, cf='AVERAGE', now=None):
+        """Return dictionary of the data source names and the averages
+        of their known values over the last window seconds before now,
+        None if no value is known.
+        """
+        rows = self.fetch(window, cf, now)
+        averages = {}
+
+        for index, name in enumerate(self.names):
+            known = [r[index] for r in rows if not math.isnan(r[index])]
+            averages[name] = sum(known) / len(known) if known else None
+
+        return averages
+
+
+def _path(rrddir, subdirs, name):
+    """Return the path of the RRD file of the node or VM of the given
+    name, or None if there is none.
+    """
+    for subdir in subdirs:
+        path = os.path.join(rrddir, subdir, name)
+
+        if os.path.exists(path):
+            return path
+
+    return None
+
+def flush(paths, socketpath=RRDCACHED):
+    """Make rrdcached write the pending updates of the RRD files at the
+    given paths, like rrdtool flushcached. All FLUSH commands are sent
+    before the answers are read. Return False if rrdcached is not
+    running.
+    """
+    _logger = logging.getLogger(__name__)
+
+    if not paths or not os.path.exists(socketpath):
+        return False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(FLUSHTIMEOUT)
+
+    try:
+        sock.connect(socketpath)
+        sock.sendall(''.join(['FLUSH {}\n'.format(p)
+                              for p in paths]).encode())
+        answers = sock.makefile('rb')
+        for path in paths:
+            answer = answers.readline().decode().strip()
+            if not answer.startswith('0 '):
+                _logger.debug("flushing '%s' failed: %s", path, answer)
+        answers.close()
+    except socket.error as exc:
+        _logger.warning('flushing the RRD files failed: %s', exc)
+        return False
+    finally:
+        sock.close()
+
+    return True
+
+def _averages(path, window, now):
+    """Return the averages of the RRD file at path over the last window
+    seconds before now, or before its last update if that is earlier,
+    and the number of seconds the last update is before now.
+    """
+    rrd = RRD(path)
+    try:
+        return (rrd.average(window, now=min(now, rrd.lastupdate)),
+                now - rrd.lastupdate)
+    finally:
+        rrd.close()
+
+def nodeaverages(nodename, window, now=None, rrddir=RRDDIR,
+                 rrdcached=RRDCACHED):
+    """Return dictionary of the data source names of the RRD file of
+    the node and their averages over the last window seconds before now,
+    or None if there is no RRD file for the node.
+    """
+    if now is None:
+        now = time.time()
+
+    path = _path(rrddir, NODEDIRS, nodename)
+
+    if path is None:
+        return None
+
+    flush([path], rrdcached)
+
+    return _averages(path, window, now)[0]
+
+def statistics(cluster, window, now=None, rrddir=RRDDIR,
+               rrdcached=RRDCACHED):
+    """Return the usage of the nodes and VMs of the cluster averaged
+    over the last window seconds before now, in the format of
+    pvehistory.History.statistics. The pending updates of the files are
+    flushed by rrdcached first. Files without update in the last STALE
+    seconds are averaged up to their last update and reported. Nodes
+    and VMs without RRD file or without known memory and CPU usage in
+    the window are left out.
+    """
+    _logger = logging.getLogger(__name__)
+
+    if now is None:
+        now = time.time()
+
+    stats = {}
+    items = [(pvehistory.NODE, n.id, _path(rrddir, NODEDIRS, n.id),
+              NODEATTRS) for n in cluster.nodes()]
+    items += [(pvehistory.VM, v.id, _path(rrddir, VMDIRS, v.id), VMATTRS)
+              for v in cluster.vms()]
+    items = [i for i in items if i[2] is not None]
+    stale = []
+
+    flush([i[2] for i in items], rrdcached)
+
+    for kind, name, path, attrs in items:
+        averages, age = _averages(path, window, now)
+
+        if age > STALE:
+            stale.append(name)
+
+        values = dict((k, averages.get(source)) for k, source in attrs)
+
+        if values['mem'] is None or values['cpu'] is None:
+            continue
+
+        for counter in pvehistory.COUNTERS:
+            values.setdefault(counter, None)
+
+        stats[(kind, name)] = values
+
+    if stale:
+        _logger.warning(
+            'RRD files of %d nodes and VMs have not been updated for more '
+            'than %d seconds, e.g. %s', len(stale), STALE,
+            ', '.join(stale[:5]))
+
+    return stats
+
+def annotate(cluster, window, now=None, rrddir=RRDDIR,
+             rrdcached=RRDCACHED):
+    """Set the averages (see statistics) on the nodes and VMs of the
+    cluster as optional attributes prefixed with avg, e.g. avgcpu and
+    avgmem, and the window as avgwindow. Return the statistics.
+    """
+    stats = statistics(cluster, window, now, rrddir, rrdcached)
+    items = [(pvehistory.NODE, n) for n in cluster.nodes()]
+    items += [(pvehistory.VM, v) for v in cluster.vms()]
+
+    for kind, item in items:
+        values = stats.get((kind, item.id))
+
+        if values:
+            item.attrs['avgwindow'] = window
+            item.attrs.update(('avg' + key, value)
+                              for key, value in values.items())
+
+    return stats
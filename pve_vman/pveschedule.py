@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides ordering planned migrations into waves. The
+migrations of a wave can run at the same time: no node is source or
+target of more than the allowed number of migrations of a wave and the
+memory of a target node is never exceeded, counting the memory of VMs
+still on their source node until the wave is finished. Long migrations
+are scheduled first, so the waves end up with similar durations.
+"""
+
+from __future__ import division
+
+from pve_vman.exceptions import PlanningError
+
+
+CONCURRENCY = 1
+"""Default number of migrations per node in a wave."""
+
+MAXNODEMEM = 100
+"""Default percentage of node memory that may be used at any time."""
+
+
+class Wave(list):
+    """List of migrations that can run at the same time."""
+    def __init__(self, *args):
+        super(Wave, self).__init__(*args)
+        self.duration = 0
+
+
+def nodeslots(wave):
+    """Return dictionary of the number of migrations per node in the
+    wave, counting source and target nodes.
+    """
+    slots = {}
+
+    for migration in wave:
+        for node in (migration.source, migration.target):
+            slots[node] = slots.get(node, 0) + 1
+
+    return slots
+
+def waveduration(wave, costmodel):
+    """Return the estimated duration of the wave. Migrations on the same
+    node share its bandwidth, so their estimate is multiplied by the
+    number of migrations on the busier one of both nodes.
+    """
+    slots = nodeslots(wave)
+
+    return max([0] + [
+        costmodel.estimate(m.pvevm) * max(slots[m.source], slots[m.target])
+        for m in wave])
+
+def schedule(cluster, migrations, costmodel, concurrency=CONCURRENCY,
+             maxnodemem=MAXNODEMEM, maxwave=0):
+    """Return list of waves for the migrations starting from the state of
+    the given cluster. At most concurrency migrations per node and
+    maxwave migrations in total (0 = unlimited) are put into a wave.
+    The used memory of a node never exceeds maxnodemem percent of its
+    total memory. Raise PlanningError if some migrations can't be
+    scheduled without exceeding the memory of their target.
+    """
+    used = dict((n.id, n.memused) for n in cluster)
+    limit = dict((n.id, n.memtotal * maxnodemem / 100) for n in cluster)
+    pending = sorted(
+        migrations,
+        key=lambda m: (-costmodel.estimate(m.pvevm), m.pvevm.id))
+    waves = []
+
+    while pending:
+        wave = Wave()
+        slots = {}
+        incoming = {}
+
+        for migration in pending:
+            if maxwave and len(wave) >= maxwave:
+                break
+
+            source, target = migration.source, migration.target
+            mem = migration.pvevm.attrs.get('mem') or 0
+
+            if slots.get(source, 0) >= concurrency \
+                    or slots.get(target, 0) >= concurrency:
+                continue
+
+            if used[target] + incoming.get(target, 0) + mem > limit[target]:
+                continue
+
+            wave.append(migration)
+            slots[source] = slots.get(source, 0) + 1
+            slots[target] = slots.get(target, 0) + 1
+            incoming[target] = incoming.get(target, 0) + mem
+
+        if not wave:
+            raise PlanningError(
+                'migrations would exceed target memory: {}'.format(
+                    ', '.join([str(m) for m in pending])))
+
+        for migration in wave:
+            mem = migration.pvevm.attrs.get('mem') or 0
+            used[migration.source] -= mem
+            used[migration.target] += mem
+            pending.remove(migration)
+
+        wave.duration = waveduration(wave, costmodel)
+        waves.append(wave)
+
+    return waves
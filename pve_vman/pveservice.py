@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides a long running service that keeps a refreshed
+cluster object in memory and answers status and plan queries over a
+local unix socket, and the client functions to query it. Requests and
+responses are single lines of JSON.
+"""
+
+import json
+import logging
+import os
+import socket
+import time
+
+try:
+    from SocketServer import StreamRequestHandler, ThreadingUnixStreamServer
+except ImportError:
+    from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+
+from pve_vman import exceptions, pvecluster, pveconstraints, pverefresh, \
+    pvestats
+
+
+SOCKETPATH = '/run/pve_vman/vman.sock'
+"""Default path of the service socket."""
+
+REFRESHINTERVAL = 10
+"""Default number of seconds between two cluster refreshes."""
+
+MAXAGE = 60
+"""Default maximum age in seconds of a snapshot the client accepts."""
+
+TIMEOUT = 2
+"""Default number of seconds the client waits for an answer."""
+
+PLANNERS = {
+    'balance': lambda cluster, nodes, **options:
+               pvecluster.planbalance(cluster, **options),
+    'flush': lambda cluster, nodes, **options:
+             pvecluster.planflush(nodes, cluster, **options)}
+
+
+class PVEService(object):
+    """Answers the requests with the last cluster object of the given
+    refresher.
+    """
+    def __init__(self, refresher):
+        self.refresher = refresher
+
+    def handle(self, request):
+        """Return the response dict for the given request dict."""
+        command = request.get('command')
+        cluster = self.refresher.cluster
+        response = {
+            'timestamp': self.refresher.timestamp,
+            'interval': self.refresher.interval}
+
+        if cluster is None:
+            raise exceptions.Error('no cluster snapshot available yet')
+
+        if command == 'status':
+            response['cluster'] = cluster.dump()
+        elif command in PLANNERS:
+            planner = PLANNERS[command]
+            options = dict((str(k), v) for k, v
+                           in request.get('options', {}).items())
+            if request.get('rules') is not None:
+                options['constraints'] = pveconstraints.buildindex(
+                    cluster, request['rules'])
+            newcluster = planner(
+                cluster.clone(), request.get('nodes', []), **options)
+            response['cluster'] = cluster.dump()
+            response['newcluster'] = newcluster.dump()
+        else:
+            raise exceptions.InputError(
+                "unknown command '{}'".format(command))
+
+        return response
+
+
+def _handler(service):
+    """Return a request handler class answering with the service."""
+    class ServiceHandler(StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline().decode())
+                response = service.handle(request)
+            except exceptions.Error as exc:
+                response = {
+                    'error': exc.__class__.__name__,
+                    'message': str(exc)}
+            except Exception as exc:
+                response = {'error': 'Error', 'message': str(exc)}
+
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+    return ServiceHandler
+
+
+def serve(socketpath=SOCKETPATH, interval=REFRESHINTERVAL, history=None):
+    """Start the refresh loop and answer requests on the unix socket
+    at socketpath until interrupted. Every refreshed cluster is appended
+    to the given pvehistory.History object, if any.
+    """
+    refresher = pverefresh.PVEStatRefresher(interval)
+
+    if history is not None:
+        refresher.addlistener(history.append)
+
+    refresher.start()
+
+    socketdir = os.path.dirname(socketpath)
+
+    if socketdir and not os.path.isdir(socketdir):
+        os.makedirs(socketdir)
+
+    if os.path.exists(socketpath):
+        os.unlink(socketpath)
+
+    # the socket is created with the permissions of the umask, so it is
+    # never accessible by other users, not even until a chmod
+    umask = os.umask(0o077)
+    try:
+        server = ThreadingUnixStreamServer(
+            socketpath, _handler(PVEService(refresher)))
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+
+    try:
+        server.serve_forever()
+    finally:
+        refresher.stop()
+        server.server_close()
+        os.unlink(socketpath)
+
+def query(request, socketpath=SOCKETPATH, timeout=TIMEOUT):
+    """Send the request dict to the service and return the response
+    dict. Errors reported by the service are raised as the exception of
+    the same name from the exceptions module.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+
+    try:
+        sock.connect(socketpath)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        fileh = sock.makefile('rb')
+        response = json.loads(fileh.readline().decode())
+        fileh.close()
+    finally:
+        sock.close()
+
+    if 'error' in response:
+        exc = getattr(exceptions, response['error'], exceptions.Error)
+        raise exc(response['message'])
+
+    return response
+
+def _fresh(response, maxage):
+    """Return if the snapshot of the response is at most maxage seconds
+    old.
+    """
+    return time.time() - response['timestamp'] <= maxage
+
+def getcluster(socketpath=SOCKETPATH, maxage=MAXAGE):
+    """Return the cluster snapshot of the service. If the service is
+    not running or the snapshot is too old, the cluster is built from
+    the PVE files directly. The returned cluster is frozen.
+    """
+    _logger = logging.getLogger(__name__)
+    cluster = None
+
+    if os.path.exists(socketpath):
+        try:
+            response = query({'command': 'status'}, socketpath)
+        except (socket.error, ValueError, exceptions.Error) as exc:
+            _logger.debug('service not available: %s', exc)
+        else:
+            if _fresh(response, maxage):
+                cluster = pvestats.PVEStatCluster.load(response['cluster'])
+            else:
+                _logger.debug('service snapshot too old')
+
+    if cluster is None:
+        cluster = pvestats.buildcluster()
+
+    cluster.freeze()
+
+    return cluster
+
+def plan(command, nodes=None, rules=None, socketpath=SOCKETPATH,
+         maxage=MAXAGE, **options):
+    """Return (cluster, newcluster) tuple as planned by the service for
+    the given command ('balance' or 'flush') and planner options. If a
+    rules file is given, the plan keeps to the HA groups and its rules
+    (see pveconstraints). Raise socket.error if the service is not
+    available and Error if the snapshot is older than maxage.
+    """
+    response = query({
+        'command': command,
+        'nodes': nodes or [],
+        'rules': rules,
+        'options': options}, socketpath)
+
+    if not _fresh(response, maxage):
+        raise exceptions.Error('service snapshot too old')
+
+    cluster = pvestats.PVEStatCluster.load(response['cluster'])
+    cluster.freeze()
+    newcluster = pvestats.PVEStatCluster.load(response['newcluster'])
+
+    return (cluster, newcluster)
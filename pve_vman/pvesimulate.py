@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides a stand-in for pvesh that simulates VM
+migrations on a PVE config tree (see pvesynth), so whole balance and
+flush runs can be replayed and timed without a cluster. Migrations take
+the time estimated by the cost model (see pvecost) divided by a speed
+factor, fail at random with a given rate and move the VM config file
+to the target node when done. Like the HA manager, migrations of HA
+managed VMs are only requested and complete after a delay. Run a
+simulation with:
+
+    python -m pve_vman.pvesimulate --nodes 20 --guests 1000 balance -c 50
+"""
+
+from __future__ import print_function, division
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from pve_vman import cli, pvecost, pvefiles, pvehistory, pverolling, \
+    pvesh, pveservice, pvestats, pvesynth
+
+
+SPEED = 100
+"""Default factor the simulated migrations are faster than real ones."""
+
+HADELAY = 10
+"""Default seconds until the HA manager starts a requested migration."""
+
+JITTER = 0.2
+"""Maximum relative deviation of a duration from the estimation."""
+
+MEMUSEDFIELD = 9
+"""Index of the used memory in the colon separated node lines of the
+.rrd file.
+"""
+
+
+class SimulatedPVESH(pvesh.PVESH):
+    """PVESH that runs its command in the installed Simulator instead of
+    calling pvesh. Only VM migrations are simulated.
+    """
+    simulator = None
+
+    def run(self):
+        """Run the command in the simulator, set the attributes stdout,
+        stderr and returncode.
+        """
+        if not self.hasrun:
+            self.returncode, self.stdout, self.stderr = \
+                self.simulator.run(self.method, self.path, self.options)
+
+        return self
+
+
+class Simulator(object):
+    """Simulated cluster state on the PVE config tree at basepath, by
+    default the current pvefiles.BASEPATH.
+    """
+    def __init__(self, basepath=None, bandwidth=pvecost.BANDWIDTH,
+                 failrate=0.0, hadelay=HADELAY, speed=SPEED, seed=None):
+        self.basepath = basepath or pvefiles.BASEPATH
+        self.costmodel = pvecost.MigrationCostModel(bandwidth)
+        self.failrate = failrate
+        self.hadelay = hadelay
+        self.speed = speed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.timers = []
+        self.pvevms = {}
+        self.rrd = []
+        self.nodelines = {}
+        self.saved = None
+
+        self.migrations = 0
+        self.failures = 0
+        self.duration = 0.0
+
+    def _confpath(self, node, vmtype, vmid):
+        return os.path.join(self.basepath, 'nodes', node,
+                            'lxc' if vmtype == 'lxc' else 'qemu-server',
+                            '{}.conf'.format(vmid))
+
+    def _move(self, source, vmtype, vmid, target):
+        """Move the VM config and its used memory in the .rrd file."""
+        mem = self.pvevms[vmid].attrs.get('mem') or 0
+
+        with self.lock:
+            confpath = self._confpath(target, vmtype, vmid)
+            if not os.path.isdir(os.path.dirname(confpath)):
+                os.makedirs(os.path.dirname(confpath))
+            os.rename(self._confpath(source, vmtype, vmid), confpath)
+
+            for node, change in ((source, -mem), (target, mem)):
+                if node in self.nodelines:
+                    fields = self.rrd[self.nodelines[node]].split(':')
+                    fields[MEMUSEDFIELD] = str(
+                        max(int(fields[MEMUSEDFIELD] or 0) + change, 0))
+                    self.rrd[self.nodelines[node]] = ':'.join(fields)
+
+            rrdpath = os.path.join(self.basepath, '.rrd')
+            with open(rrdpath + '.tmp', 'w') as rrdfile:
+                rrdfile.write('\n'.join(self.rrd) + '\n')
+            os.rename(rrdpath + '.tmp', rrdpath)
+
+    def run(self, method, path, options):
+        """Return tuple of returncode, stdout and stderr of the given
+        pvesh call.
+        """
+        parts = path.strip('/').split('/')
+
+        if method != 'create' or len(parts) != 5 or parts[0] != 'nodes' \
+                or parts[4] != 'migrate':
+            return (1, '', 'not simulated: {} {}'.format(method, path))
+
+        return self.migrate(parts[1], parts[2], parts[3],
+                            str(options.get('target')))
+
+    def migrate(self, source, vmtype, vmid, target):
+        """Simulate the migration of the VM, return tuple of returncode,
+        stdout and stderr like pvesh would.
+        """
+        pvevm = self.pvevms.get(vmid)
+
+        if pvevm is None or \
+                not os.path.exists(self._confpath(source, vmtype, vmid)):
+            return (2, '', "VM {} not found on node '{}'".format(
+                vmid, source))
+
+        if not os.path.isdir(os.path.join(self.basepath, 'nodes', target)):
+            return (2, '', "no such cluster node '{}'".format(target))
+
+        with self.lock:
+            duration = self.costmodel.estimate(pvevm) \
+                * self.random.uniform(1 - JITTER, 1 + JITTER)
+            failed = self.random.random() < self.failrate
+            self.migrations += 1
+            self.failures += failed
+            self.duration += duration
+
+        if pvevm.ha:
+            if not failed:
+                timer = threading.Timer(
+                    (self.hadelay + duration) / self.speed, self._move,
+                    (source, vmtype, vmid, target))
+                timer.start()
+                self.timers.append(timer)
+
+            return (0, 'Requesting HA migration for VM {} to node {}\n'
+                    .format(vmid, target), '')
+
+        time.sleep(duration / self.speed)
+
+        if failed:
+            return (255, '', 'migration aborted\n')
+
+        self._move(source, vmtype, vmid, target)
+
+        return (0, '', 'migration finished successfully (duration '
+                '{:.0f}s)\n'.format(duration))
+
+    def wait(self):
+        """Wait until the requested HA migrations are done."""
+        for timer in self.timers:
+            timer.join()
+
+    def install(self):
+        """Use the simulator for all pvesh calls and build the cluster
+        from the simulated tree instead of asking the vman service.
+        """
+        oldbasepath = pvefiles.BASEPATH
+        pvefiles.BASEPATH = self.basepath
+        try:
+            cluster = pvestats.buildcluster()
+            self.pvevms = dict((v.id, v) for v in cluster.vms())
+            self.rrd = [l.rstrip('\n') for l in pvefiles.readpvefile('.rrd')]
+        finally:
+            pvefiles.BASEPATH = oldbasepath
+
+        for index, line in enumerate(self.rrd):
+            if line.startswith('pve2-node/'):
+                self.nodelines[line.split(':')[0].split('/')[1]] = index
+
+        SimulatedPVESH.simulator = self
+        self.saved = (pvesh.PVESH, pveservice.getcluster)
+        pvesh.PVESH = SimulatedPVESH
+        pveservice.getcluster = _buildcluster
+
+    def uninstall(self):
+        """Restore the real pvesh calls."""
+        if self.saved is not None:
+            pvesh.PVESH, pveservice.getcluster = self.saved
+            self.saved = None
+
+
+def _buildcluster(*_):
+    cluster = pvestats.buildcluster()
+    cluster.freeze()
+    return cluster
+
+def main(argv=None):
+    """Run a vman command against a simulated cluster as command line
+    program and print the number of migrations and the durations. The
+    rolling state and the history are kept in the temporary tree too.
+    """
+    parser = argparse.ArgumentParser(prog='python -m pve_vman.pvesimulate')
+    parser.add_argument(
+        '--basepath',
+        help='PVE config tree to simulate, it is copied and not changed '
+             '(default a generated one)')
+    parser.add_argument(
+        '--nodes',
+        type=int,
+        default=10,
+        help='nodes of the generated cluster (default %(default)s)')
+    parser.add_argument(
+        '--guests',
+        type=int,
+        default=500,
+        help='guests of the generated cluster (default %(default)s)')
+    parser.add_argument(
+        '--bandwidth',
+        type=int,
+        default=pvecost.BANDWIDTH // 1024 ** 2,
+        help='simulated migration bandwidth in MiB/s '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--failrate',
+        type=float,
+        default=0.0,
+        help='share of failing migrations (default %(default)s)')
+    parser.add_argument(
+        '--hadelay',
+        type=int,
+        default=HADELAY,
+        help='seconds until a requested HA migration starts '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--speed',
+        type=float,
+        default=SPEED,
+        help='factor the simulation runs faster than a real cluster '
+             '(default %(default)s)')
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=1,
+        help='seed of the generated cluster and the failures '
+             '(default %(default)s)')
+    parser.add_argument(
+        'vmanargs',
+        nargs=argparse.REMAINDER,
+        help='vman command and arguments to run')
+
+    args = parser.parse_args(argv)
+    basepath = os.path.join(tempfile.mkdtemp(prefix='pvesimulate-'), 'pve')
+
+    if args.basepath:
+        shutil.copytree(args.basepath, basepath)
+    else:
+        pvesynth.generate(basepath, args.nodes, args.guests, args.seed)
+
+    simulator = Simulator(basepath, args.bandwidth * 1024 ** 2,
+                          args.failrate, args.hadelay, args.speed, args.seed)
+    oldbasepath = pvefiles.BASEPATH
+    oldstatefile = pverolling.STATEFILE
+    oldhistoryfile = pvehistory.HISTORYFILE
+    oldargv = sys.argv
+    start = time.time()
+
+    try:
+        pvefiles.BASEPATH = basepath
+        pverolling.STATEFILE = os.path.join(
+            os.path.dirname(basepath), 'rolling.json')
+        pvehistory.HISTORYFILE = os.path.join(
+            os.path.dirname(basepath), 'history.dat')
+        simulator.install()
+        sys.argv = ['vman'] + args.vmanargs
+        try:
+            cli.vman()
+        except SystemExit:
+            pass
+        simulator.wait()
+    finally:
+        simulator.uninstall()
+        pvefiles.BASEPATH = oldbasepath
+        pverolling.STATEFILE = oldstatefile
+        pvehistory.HISTORYFILE = oldhistoryfile
+        sys.argv = oldargv
+        shutil.rmtree(os.path.dirname(basepath))
+
+    elapsed = time.time() - start
+    print('Simulated {} migrations, {} failed, migration time {:.0f}s, '
+          'wall time {:.0f}s (took {:.1f}s)'.format(
+              simulator.migrations, simulator.failures, simulator.duration,
+              elapsed * args.speed, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -30,6 +30,19 @@ import logging
 
 from pve_vman import pvesh, pvefiles
 
+SIZEUNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+"""Factors of the size units used in PVE disk options."""
+
+SHAREDTYPES = ('rbd', 'nfs', 'iscsi')
+"""Storage types reachable from all nodes. VMs with disks on other
+storages are only migrateable together with their disks.
+"""
+
+LOCALDISKTYPES = ('dir', 'lvm', 'lvmthin', 'zfspool')
+"""Local storage types whose disks can be migrated together with a
+running VM.
+"""
+
 # python 2 and 3.4 compat
 try:
     basestring
@@ -232,7 +245,8 @@ class PVEStatContainer(object):
 class PVEMigration(object):
     """Represents a VM migration. After initializing, it can be run.
     That calls pvesh to initiate the migration and waits for completion
-    of the migration if it is not a HA managed VM.
+    of the migration if it is not a HA managed VM. VMs with disks on
+    local storages are migrated together with their disks.
     """
     def __init__(self, pvevm, target):
         self.pvevm = pvevm
@@ -241,12 +255,16 @@ class PVEMigration(object):
         else:
             self.target = target
 
+        options = {'online': 1}
+        if pvevm.attrs.get('localmigrateable'):
+            options['with-local-disks'] = 1
+
         self.pvesh = pvesh.migratevm(
             self.source,
             pvevm.type,
             pvevm.id,
             self.target,
-            online=1)
+            **options)
 
     def __repr__(self):
         fmt = 'Migration: {} from {} to {}'
@@ -267,6 +285,10 @@ class PVEMigration(object):
         """
         return self.pvesh.cmd
 
+    def setbwlimit(self, bwlimit):
+        """Limit the bandwidth of the migration to bwlimit KiB/s."""
+        self.pvesh.options['bwlimit'] = bwlimit
+
     def run(self):
         """Run the migration using pvesh."""
         return self.pvesh.run()
@@ -336,6 +358,28 @@ class PVEStatCluster(PVEStatContainer):
 
         return cluster
 
+    def dump(self):
+        """Return the cluster as list of (node attrs, list of VM attrs)
+        tuples that can be serialized, e.g. as JSON, and turned into a
+        cluster object again with PVEStatCluster.load.
+        """
+        return [(n.attrs, [v.attrs for v in n.children])
+                for n in self.children]
+
+    @classmethod
+    def load(cls, data):
+        """Return a new PVEStatCluster object built from the data
+        returned by PVEStatCluster.dump.
+        """
+        cluster = cls()
+
+        for nodeattrs, vmattrs in data:
+            node = PVEStatNode(**nodeattrs)
+            node.children = [PVEStatVM(**v) for v in vmattrs]
+            cluster.add(node)
+
+        return cluster
+
     def nodes(self, filtermethod=None):
         """Return a list of all Nodes of the Cluster. If filtermethod is
         given, only Nodes that the filtermethod returns True for are
@@ -449,9 +493,13 @@ class PVEStatNode(PVEStatObject, PVEStatContainer):
         ordered = [vm for vm in self.vms() if vm.needsmove(self)]
         return sorted(ordered, key=hash)
 
-    def migrateable_vms(self):
-        """Return list of VMs that are migrateable."""
-        ordered = self.vms(lambda c: c.migrateable)
+    def migrateable_vms(self, localdisks=False):
+        """Return list of VMs that are migrateable, if localdisks is set
+        including the ones that are only migrateable together with their
+        disks on local storages.
+        """
+        ordered = self.vms(lambda c: c.migrateable or localdisks
+                           and c.attrs.get('localmigrateable'))
         return sorted(ordered, key=hash)
 
     def lowestvm(self, attr, filtermethod=None):
@@ -498,11 +546,16 @@ class PVEStatVM(PVEStatObject):
         return PVEMigration(self, target)
 
 
-def buildcluster():
-    """Return a PVEStatCluster object."""
-    vmconf = pvefiles.vmconf()
+def buildcluster(vmconfcache=None):
+    """Return a PVEStatCluster object. A vmconfcache dictionary kept
+    between calls avoids reading unchanged VM configs again (see
+    pvefiles.vmconf).
+    """
+    vmconf = pvefiles.vmconf(vmconfcache)
     storageconf = pvefiles.storageconf()
+    haresources = pvefiles.haconf()
     diskpattern = re.compile(r'^(?:rootfs|(?:scsi|sata|virtio|ide|mount)\d+)$')
+    sizepattern = re.compile(r'(?:^|,)size=(\d+(?:\.\d+)?)([KMGT]?)(?:,|$)')
 
     def ismigrateable(vmid):
         """Return if the VM with the given ID is migrateable. A VM is
@@ -512,15 +565,65 @@ def buildcluster():
         for name, opts in vmconf[str(vmid)].items():
             if diskpattern.match(name) and ':' in opts:
                 storage = opts.split(':')[0]
-                if storageconf[storage]['type'] not in ['rbd', 'nfs', 'iscsi']:
+                if storageconf[storage]['type'] not in SHAREDTYPES:
+                    return False
+        return True
+
+    def localdisks(vmid):
+        """Return dictionary of the storages other than rbd, nfs or
+        iscsi the VM has disks on and the sum of the sizes in bytes of
+        its disks on them.
+        """
+        sizes = {}
+        for name, opts in vmconf[str(vmid)].items():
+            if diskpattern.match(name) and ':' in opts:
+                storage = opts.split(':')[0]
+                if storageconf[storage]['type'] in SHAREDTYPES:
+                    continue
+                match = sizepattern.search(opts)
+                sizes[storage] = sizes.get(storage, 0)
+                if match:
+                    sizes[storage] += int(float(match.group(1))
+                                          * SIZEUNITS[match.group(2)])
+        return sizes
+
+    def islocalmigrateable(vmid):
+        """Return if the VM with the given ID is a qemu VM that can be
+        migrated online together with its disks on local storages, i.e.
+        none of them is a CD-ROM image and all storages are of a type
+        that supports it. HA managed VMs are never, as the HA manager
+        doesn't migrate local disks.
+        """
+        if vmconf[str(vmid)]['type'] != 'qemu-server' \
+                or str(vmid) in haresources:
+            return False
+        for name, opts in vmconf[str(vmid)].items():
+            if diskpattern.match(name) and ':' in opts:
+                storage = storageconf[opts.split(':')[0]]
+                if storage['type'] in SHAREDTYPES:
+                    continue
+                if storage['type'] not in LOCALDISKTYPES \
+                        or 'media=cdrom' in opts:
                     return False
         return True
 
     resources = pvefiles.stats()
-    haresources = pvefiles.haconf()
     cluster = PVEStatCluster()
 
+    storages = {}
+
+    for storage in resources.get('storage', []):
+        conf = storageconf.get(storage['storage'])
+        if conf is None:
+            continue
+        storages.setdefault(storage['node'], {})[storage['storage']] = {
+            'type': conf['type'],
+            'shared': conf['type'] in SHAREDTYPES,
+            'total': storage['total'],
+            'used': storage['used']}
+
     for node in resources.get('node', []):
+        node['storages'] = storages.get(node['node'], {})
         cluster.add(PVEStatNode(**node))
 
     for res in resources.get('vm', []):
@@ -538,6 +641,11 @@ def buildcluster():
         res['haenabled'] = haresource.get('state', '') == 'enabled'
         res['hagroup'] = haresource.get('group', None)
         res['migrateable'] = ismigrateable(vmid)
+        res['localdisks'] = localdisks(vmid)
+        res['localdisksize'] = sum(res['localdisks'].values())
+        res['localmigrateable'] = (not res['migrateable']
+                                   and islocalmigrateable(vmid))
+        res['lock'] = vmconf[vmid].get('lock')
 
         node = cluster[res['node']]
         node.add(PVEStatVM(**res))
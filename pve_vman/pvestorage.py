@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides tracking the free space of the local storages
+of the nodes while planning, so VMs are only migrated together with
+their local disks to nodes that have storages of the same names with
+enough space left.
+"""
+
+from __future__ import division
+
+
+STORAGELIMIT = 90
+"""Default percentage of a local storage that may be used."""
+
+
+class StorageIndex(object):
+    """Free bytes per node and local storage within the limit in percent
+    of the storage size, updated with every planned move.
+
+    Example:
+        index = StorageIndex(cluster)
+        if index.allows(pvevm, target):
+            index.move(pvevm, target)
+    """
+    def __init__(self, cluster, limit=STORAGELIMIT):
+        self.free = {}
+        self.placement = {}
+        self.limit = limit
+
+        for node in cluster.nodes():
+            for name, storage in (node.attrs.get('storages') or {}).items():
+                if not storage['shared']:
+                    self.free[(node.id, name)] = \
+                        storage['total'] * limit / 100 - storage['used']
+
+            for pvevm in node.vms():
+                self.placement[pvevm.id] = node.id
+
+    def allows(self, pvevm, target):
+        """Return if the local disks of the VM fit onto the storages of
+        the same names on the target node.
+        """
+        nodeid = getattr(target, 'id', target)
+
+        if self.placement.get(pvevm.id) == nodeid:
+            return True
+
+        for name, size in (pvevm.attrs.get('localdisks') or {}).items():
+            if (nodeid, name) not in self.free \
+                    or self.free[(nodeid, name)] < size:
+                return False
+
+        return True
+
+    def move(self, pvevm, target):
+        """Record the move of the VM to the target node."""
+        nodeid = getattr(target, 'id', target)
+        source = self.placement.get(pvevm.id)
+
+        for name, size in (pvevm.attrs.get('localdisks') or {}).items():
+            if (source, name) in self.free:
+                self.free[(source, name)] += size
+            if (nodeid, name) in self.free:
+                self.free[(nodeid, name)] -= size
+
+        self.placement[pvevm.id] = nodeid
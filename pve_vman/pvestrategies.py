@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+"""This module provides running several planning strategies, possibly
+with different random seeds, in parallel worker processes and choosing
+the best resulting plan. Workers get the cluster as compact JSON string
+and return the planned moves, so no object graphs are pickled. The
+placement constraints and storage indexes are rebuilt in the workers
+from the HA groups, the rules and the storage limit.
+"""
+
+from __future__ import division
+
+import json
+import logging
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
+from pve_vman import pvecluster, pveconstraints, pvecost, pvestats
+from pve_vman import pvestorage
+from pve_vman.exceptions import Error, InputError, PlanningError
+
+
+def _balance_greedy(cluster, nodes, seed, options, costmodel):
+    return pvecluster.planbalance(cluster, **options)
+
+def _balance_mincost(cluster, nodes, seed, options, costmodel):
+    return pvecluster.planbalance(cluster, costmodel=costmodel, **options)
+
+def _balance_multi(cluster, nodes, seed, options, costmodel):
+    return pvecluster.planmultibalance(cluster, **options)
+
+def _balance_optimize(cluster, nodes, seed, options, costmodel):
+    return pvecluster.planoptimizedbalance(
+        cluster, seed=seed, costmodel=costmodel, **options)
+
+def _balance_optimizetime(cluster, nodes, seed, options, costmodel):
+    return pvecluster.planoptimizedbalance(
+        cluster, seed=seed, costmodel=costmodel, objective='time', **options)
+
+def _flush_lowest(cluster, nodes, seed, options, costmodel):
+    return pvecluster.planflush(nodes, cluster, **options)
+
+def _flush_mincost(cluster, nodes, seed, options, costmodel):
+    return pvecluster.planflush(nodes, cluster, costmodel=costmodel,
+                                **options)
+
+def _flush_binpack(fit):
+    def planner(cluster, nodes, seed, options, costmodel):
+        return pvecluster.planflushpacked(nodes, cluster, fit=fit, **options)
+    return planner
+
+
+STRATEGIES = {
+    'balance': {
+        'greedy': (_balance_greedy, ('iterations', 'diffperc',
+                                     'ignorenodenames', 'constraints',
+                                     'storage')),
+        'mincost': (_balance_mincost, ('iterations', 'diffperc',
+                                       'ignorenodenames', 'constraints',
+                                       'storage')),
+        'multi': (_balance_multi, ('iterations', 'diffperc',
+                                   'ignorenodenames', 'weights',
+                                   'constraints')),
+        'optimize': (_balance_optimize, ('iterations', 'diffperc',
+                                         'ignorenodenames', 'timebudget',
+                                         'objective', 'constraints')),
+        'optimize-time': (_balance_optimizetime, ('iterations', 'diffperc',
+                                                  'ignorenodenames',
+                                                  'timebudget',
+                                                  'constraints'))},
+    'flush': {
+        'lowest': (_flush_lowest, ('onlyha', 'maxmigrations',
+                                   'ignorenodenames', 'constraints',
+                                   'storage')),
+        'mincost': (_flush_mincost, ('onlyha', 'maxmigrations',
+                                     'ignorenodenames', 'constraints',
+                                     'storage')),
+        'binpack-best': (_flush_binpack('best'), (
+            'onlyha', 'maxmigrations', 'ignorenodenames', 'memlimit',
+            'cpulimit', 'constraints')),
+        'binpack-first': (_flush_binpack('first'), (
+            'onlyha', 'maxmigrations', 'ignorenodenames', 'memlimit',
+            'cpulimit', 'constraints')),
+        'binpack-worst': (_flush_binpack('worst'), (
+            'onlyha', 'maxmigrations', 'ignorenodenames', 'memlimit',
+            'cpulimit', 'constraints'))}}
+"""Strategies per command with the planner and the names of the options
+it accepts."""
+
+SEEDED = ('optimize', 'optimize-time')
+"""Strategies that use a random seed."""
+
+
+def parsestrategies(command, value):
+    """Return list of strategy names for strings like 'greedy,multi' or
+    'all'.
+    """
+    if value == 'all':
+        return sorted(STRATEGIES[command])
+
+    names = [n.strip() for n in value.split(',') if n.strip()]
+
+    for name in names:
+        if name not in STRATEGIES[command]:
+            raise InputError("unknown strategy '{}'".format(name))
+
+    return names
+
+def imbalance(cluster, attr='memvmnodeused_perc', emptynodes=()):
+    """Return the difference of the given attribute between the highest
+    and the lowest online node that is not about to be emptied.
+    """
+    values = [getattr(n, attr) for n in cluster
+              if n.isonline and n.id not in emptynodes]
+
+    return max(values) - min(values) if values else 0
+
+def runtask(task):
+    """Run a single planning task in a worker. The task is a tuple of
+    command, strategy name, seed, JSON cluster dump, nodes to flush,
+    options and migration bandwidth. The constraints option holds the
+    HA groups and rules, the storage option the storage limit, the
+    indexes are built for the loaded cluster. Return a tuple of the task
+    identification, the list of (vmid, target node) moves, the residual
+    imbalance and the estimated duration, or an error message instead
+    of the moves.
+    """
+    command, name, seed, data, nodes, options, bandwidth = task
+    planner, accepted = STRATEGIES[command][name]
+    options = dict((k, v) for k, v in options.items()
+                   if k in accepted and v is not None)
+    costmodel = pvecost.MigrationCostModel(bandwidth)
+    cluster = pvestats.PVEStatCluster.load(json.loads(data))
+
+    if 'constraints' in options:
+        options['constraints'] = pveconstraints.ConstraintIndex(
+            cluster, *options['constraints'])
+
+    if 'storage' in options:
+        options['storage'] = pvestorage.StorageIndex(
+            cluster, options['storage'])
+
+    try:
+        newcluster = planner(cluster, nodes, seed, options, costmodel)
+    except Error as exc:
+        return ((name, seed), '{}: {}'.format(exc.__class__.__name__, exc),
+                None, None)
+
+    migrations = newcluster.migrations()
+    moves = [(m.pvevm.id, m.target) for m in migrations]
+
+    return ((name, seed), moves, imbalance(newcluster, emptynodes=nodes),
+            costmodel.total(migrations))
+
+def score(result, diffperc=pvecluster.BALDIFFPERC):
+    """Return the sort key of a result. Plans reaching the target
+    imbalance are compared by their estimated duration only.
+    """
+    _, _, residual, duration = result
+    return (max(residual, diffperc), duration, len(result[1]))
+
+def plan(command, cluster, strategies, nodes=None, options=None, seeds=1,
+         workers=None, bandwidth=pvecost.BANDWIDTH):
+    """Run the given strategies for the command ('balance' or 'flush')
+    on the cluster, seeded strategies once per seed, in up to workers
+    processes. Return a tuple of a clone of the cluster with the moves
+    of the best plan applied and the list of all results (see runtask).
+    Without concurrent.futures, the tasks are run one after another.
+    Constraint and storage indexes in the options (see pveconstraints
+    and pvestorage) are applied by the strategies that support them,
+    the optimizing ones fail if the constraints restrict any VM.
+    """
+    _logger = logging.getLogger(__name__)
+
+    if nodes is None:
+        nodes = []
+
+    options = dict(options or {})
+
+    if options.get('constraints') is not None:
+        constraints = options['constraints']
+        options['constraints'] = (constraints.groups, constraints.rules)
+
+    if options.get('storage') is not None:
+        options['storage'] = options['storage'].limit
+
+    data = json.dumps(cluster.dump(), separators=(',', ':'))
+    tasks = []
+
+    for name in strategies:
+        for seed in (range(seeds) if name in SEEDED else [None]):
+            tasks.append(
+                (command, name, seed, data, nodes, options, bandwidth))
+
+    if ProcessPoolExecutor is None or workers == 1:
+        if workers != 1:
+            _logger.warning('concurrent.futures not available, '
+                            'running strategies sequentially')
+        results = [runtask(t) for t in tasks]
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            results = list(executor.map(runtask, tasks))
+        finally:
+            executor.shutdown()
+
+    valid = [r for r in results if r[2] is not None]
+
+    for result in results:
+        if result[2] is None:
+            _logger.info('%s (seed %s): %s', result[0][0], result[0][1],
+                         result[1])
+        else:
+            _logger.info('%s (seed %s): %d migrations, %.1f%% imbalance, '
+                         '%ds', result[0][0], result[0][1], len(result[1]),
+                         result[2], result[3])
+
+    if not valid:
+        raise PlanningError('no strategy found a plan')
+
+    best = min(valid, key=lambda r: score(r, options.get('diffperc')
+                                          or pvecluster.BALDIFFPERC))
+    _logger.info('chose %s (seed %s)', best[0][0], best[0][1])
+
+    newcluster = cluster.clone()
+    pvevms = dict((v.id, v) for v in newcluster.vms())
+
+    for vmid, target in best[1]:
+        pvevm = pvevms[vmid]
+        newcluster[pvevm.node].remove(pvevm)
+        newcluster[target].add(pvevm)
+
+    return (newcluster, results)
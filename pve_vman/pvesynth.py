@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""This module provides generating synthetic PVE cluster config trees,
+i.e. guest configs, storage.cfg, the HA config and the .rrd status
+file, of configurable size. Point pvefiles.BASEPATH to the generated
+tree to use it instead of /etc/pve, e.g. for benchmarks.
+"""
+
+from __future__ import division
+
+import os
+import random
+
+
+GIB = 1024 ** 3
+
+VMMEMORY = (1, 2, 4, 4, 8, 8, 16, 32, 64)
+"""Memory sizes in GiB the guests are chosen from."""
+
+VMCORES = (1, 2, 2, 4, 4, 8)
+"""Numbers of cores the guests are chosen from."""
+
+OVERCOMMIT = 1.3
+"""Ratio of provisioned guest memory to node memory."""
+
+GROUPSIZE = 3
+"""Number of nodes per generated HA group."""
+
+STORAGECFG = """dir: local
+\tpath /var/lib/vz
+\tcontent iso,vztmpl,backup
+
+zfspool: local-zfs
+\tpool rpool/data
+\tcontent images,rootdir
+
+rbd: ceph
+\tpool rbd
+\tcontent images,rootdir
+"""
+
+
+def _write(basepath, relpath, content):
+    path = os.path.join(basepath, relpath)
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path, 'w') as fileh:
+        fileh.write(content)
+
+def generate(basepath, nodes=10, guests=100, seed=1, hashare=0.3,
+             localshare=0.1, ctshare=0.1, timestamp=1500000000):
+    """Write a cluster config tree with the given number of nodes and
+    guests to basepath. hashare, localshare and ctshare are the shares
+    of the guests that are HA managed, use local storage and are
+    containers. The same seed gives the same tree. Return the list of
+    node names.
+    """
+    rand = random.Random(seed)
+    nodenames = ['node{:03d}'.format(i) for i in range(1, nodes + 1)]
+    guestmem = dict((n, 0) for n in nodenames)
+    usedmem = dict((n, 0) for n in nodenames)
+    rrd = []
+    haresources = []
+
+    for index in range(guests):
+        vmid = str(100 + index)
+        node = rand.choice(nodenames)
+        maxmem = rand.choice(VMMEMORY) * GIB
+        cores = rand.choice(VMCORES)
+        storage = 'local-zfs' if rand.random() < localshare else 'ceph'
+        running = rand.random() < 0.9
+        guestmem[node] += maxmem
+
+        if rand.random() < ctshare:
+            vmtype, prefix = 'lxc', 'rootfs'
+        else:
+            vmtype, prefix = 'qemu-server', 'scsi0'
+
+        _write(basepath, os.path.join(
+            'nodes', node, vmtype, '{}.conf'.format(vmid)),
+               'cores: {}\nmemory: {}\n{}: {}:vm-{}-disk-0,size={}G\n'
+               .format(cores, maxmem // 1024 ** 2, prefix, storage, vmid,
+                       rand.choice((8, 16, 32, 64, 128))))
+
+        mem = int(maxmem * rand.uniform(0.2, 0.95)) if running else 0
+        usedmem[node] += mem
+        rrd.append(':'.join([
+            'pve2.3-vm/{}'.format(vmid),
+            str(rand.randint(60, 10 ** 7) if running else 0),
+            'guest{}'.format(vmid),
+            'running' if running else 'stopped',
+            '0',
+            str(timestamp),
+            str(cores),
+            # the CPU usage of a VM is a ratio of its cores, most VMs
+            # are mostly idle
+            '{:.6f}'.format(rand.betavariate(1.2, 4) if running else 0),
+            str(maxmem),
+            str(mem),
+            str(64 * GIB),
+            '0',
+        ] + [str(rand.randint(0, 10 ** 11)) for _ in range(4)]))
+
+        if rand.random() < hashare:
+            group = 'group{}'.format(
+                nodenames.index(node) // GROUPSIZE + 1)
+            haresources.append('vm: {}\n\tstate started\n\tgroup {}\n'
+                               .format(vmid, group))
+
+    # all nodes have the same size that fits the average provisioned
+    # memory, rounded up to 64 GiB
+    memtotal = sum(guestmem.values()) / nodes / OVERCOMMIT
+    memtotal = max(int(-(-memtotal // (64 * GIB))), 1) * 64 * GIB
+
+    for node in nodenames:
+        rrd.append(':'.join([
+            'pve2-node/{}'.format(node),
+            str(rand.randint(10 ** 5, 10 ** 7)),
+            '',
+            str(timestamp),
+            '{:.2f}'.format(rand.uniform(0.5, 20)),
+            str(rand.choice((32, 48, 64, 96, 128))),
+            '{:.6f}'.format(rand.uniform(0.05, 0.8)),
+            '{:.6f}'.format(rand.uniform(0, 0.05)),
+            str(memtotal),
+            str(min(memtotal, usedmem[node] + rand.randint(4, 16) * GIB)),
+            str(8 * GIB),
+            '0',
+            str(100 * GIB),
+            str(20 * GIB),
+        ] + [str(rand.randint(0, 10 ** 12)) for _ in range(2)]))
+        rrd.append('pve2-storage/{}/local-zfs:{}:{}:{}'.format(
+            node, timestamp, 4 * 1024 * GIB, rand.randint(1, 3) * 1024 * GIB))
+
+    groups = []
+    for start in range(0, nodes, GROUPSIZE):
+        members = nodenames[start:start + GROUPSIZE]
+        groups.append('group: group{}\n\tnodes {}\n\tnofailback 1\n'.format(
+            start // GROUPSIZE + 1,
+            ','.join('{}:{}'.format(n, len(members) - i)
+                     for i, n in enumerate(members))))
+
+    _write(basepath, 'storage.cfg', STORAGECFG)
+    _write(basepath, 'ha/resources.cfg', '\n'.join(haresources))
+    _write(basepath, 'ha/groups.cfg', '\n'.join(groups))
+    _write(basepath, '.rrd', '\n'.join(rrd) + '\n')
+
+    return nodenames
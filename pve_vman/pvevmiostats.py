@@ -20,15 +20,46 @@
 #  USA
 
 
-"""VMIOStats"""
+"""VMIOStats of the VMs of the local node. An agent per node streams
+them as compact samples over TCP, ClusterIOStats follows the agents of
+all nodes concurrently and merges their samples into a cluster wide
+view.
+"""
 
 
 import glob
+import json
+import logging
 import os
+import socket
+import threading
+import time
+
+try:
+    from SocketServer import StreamRequestHandler, ThreadingTCPServer
+except ImportError:
+    from socketserver import StreamRequestHandler, ThreadingTCPServer
 
 from pve_vman import pveqemumonitor
 
 
+AGENTPORT = 9119
+"""Default port the agents listen on."""
+
+STALE = 3
+"""Number of intervals after which the last sample of an agent is not
+used anymore.
+"""
+
+RECONNECT = 5
+"""Seconds to wait before an agent is connected again."""
+
+TIMEOUT = 30
+"""Seconds to wait for the connection and the first sample of an agent,
+later samples are waited for STALE intervals of the agent.
+"""
+
+
 class VMIOStats(object):
 
     keys = ('rd_bytes', 'rd_operations', 'wr_bytes', 'wr_operations')
@@ -74,3 +105,204 @@ class VMIOStats(object):
             vmdiffs[vmid] = diffs
 
         return (vmdiffs, vmsums)
+
+
+class VMIOStatsAgent(object):
+    """Fetches the VMIOStats of the local VMs every interval seconds and
+    keeps the last one as compact sample: a JSON line with the node
+    name, the time, the interval and a list of the rates in the order of
+    VMIOStats.keys per VM ID.
+    """
+    def __init__(self, interval, nodename=None):
+        if nodename is None:
+            nodename = socket.gethostname().split('.')[0]
+
+        self.interval = interval
+        self.nodename = nodename
+        self.vmstats = VMIOStats(interval)
+        self.sample = None
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+    def update(self):
+        """Fetch the VMIOStats and replace the sample."""
+        vmdiffs, _ = self.vmstats.fetch()
+        sample = {
+            'node': self.nodename,
+            'time': time.time(),
+            'interval': self.interval,
+            'vms': dict((vmid, [int(diffs[k]) for k in VMIOStats.keys])
+                        for vmid, diffs in vmdiffs.items())}
+        line = (json.dumps(sample, separators=(',', ':')) + '\n').encode()
+
+        with self.condition:
+            self.sample = line
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def run(self):
+        """Update the sample every interval seconds. The first fetch only
+        sets the counters, the rates are known from the second one on.
+        """
+        self.vmstats.fetch()
+
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.update()
+            except Exception as exc:
+                logging.getLogger(__name__).warning(
+                    'fetching iostats failed: %s', exc)
+
+    def wait(self, sequence):
+        """Return the sequence number and the sample following the given
+        sequence number, blocking until it is there.
+        """
+        with self.condition:
+            while self.sequence == sequence:
+                self.condition.wait()
+            return self.sequence, self.sample
+
+
+class _AgentServer(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _handler(agent):
+    """Return a request handler class streaming the samples of the given
+    agent until the client disconnects, starting with the current one.
+    """
+    class SampleHandler(StreamRequestHandler):
+        def handle(self):
+            with agent.condition:
+                sequence, sample = agent.sequence, agent.sample
+            while True:
+                if sample is not None:
+                    try:
+                        self.wfile.write(sample)
+                        self.wfile.flush()
+                    except socket.error:
+                        return
+                sequence, sample = agent.wait(sequence)
+
+    return SampleHandler
+
+
+def localaddress():
+    """Return the address the name of the local node resolves to, which
+    the front ends connect to, or the loopback address if it does not
+    resolve.
+    """
+    try:
+        return socket.gethostbyname(socket.gethostname())
+    except socket.error:
+        return '127.0.0.1'
+
+
+def serve(listen=None, interval=1):
+    """Stream the VMIOStats of the local VMs to every client connecting
+    to the given address, by default the one of localaddress, until
+    interrupted.
+    """
+    if listen is None:
+        listen = (localaddress(), AGENTPORT)
+
+    agent = VMIOStatsAgent(interval)
+    sampler = threading.Thread(target=agent.run)
+    sampler.daemon = True
+    sampler.start()
+
+    server = _AgentServer(listen, _handler(agent))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class ClusterIOStats(object):
+    """Follows the agents of the given (host, port) tuples, each in its
+    own thread, and merges their last samples. fetch returns the same as
+    VMIOStats.fetch, but with (node, VM ID) tuples as keys of the rates.
+    Agents that can't be reached are connected again every RECONNECT
+    seconds. Samples are stale after STALE intervals of their agent, the
+    given interval of the front end is only used for agents that did
+    not send one.
+    """
+    def __init__(self, interval, agents):
+        self.interval = interval
+        self.agents = agents
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+        for agent in agents:
+            follower = threading.Thread(target=self.follow, args=(agent,))
+            follower.daemon = True
+            follower.start()
+
+    def follow(self, agent):
+        """Read the samples of the agent until the connection fails, then
+        connect again.
+        """
+        while True:
+            sock = None
+            try:
+                sock = socket.create_connection(agent, TIMEOUT)
+                samples = sock.makefile('rb')
+                for line in iter(samples.readline, b''):
+                    sample = json.loads(line.decode())
+                    sock.settimeout(STALE * self.agentinterval(sample))
+                    with self.lock:
+                        self.samples[agent] = (time.time(), sample)
+                        self.errors.pop(agent, None)
+                raise socket.error('connection closed')
+            except (socket.error, ValueError) as exc:
+                with self.lock:
+                    self.errors[agent] = exc
+            finally:
+                if sock is not None:
+                    sock.close()
+
+            time.sleep(RECONNECT)
+
+    def agentinterval(self, sample):
+        """Return the interval of the agent that sent the sample."""
+        return sample.get('interval') or self.interval
+
+    def recent(self):
+        """Return the samples that are not stale."""
+        now = time.time()
+
+        with self.lock:
+            return dict(
+                (a, s) for a, (t, s) in self.samples.items()
+                if t >= now - STALE * self.agentinterval(s))
+
+    def missing(self):
+        """Return dictionary of the agents without recent sample and the
+        last error of their connection, if any.
+        """
+        recent = self.recent()
+
+        with self.lock:
+            return dict((a, self.errors.get(a)) for a in self.agents
+                        if a not in recent)
+
+    def fetch(self):
+        """Return the merged rates of the recent samples of all agents
+        and their sums.
+        """
+        vmdiffs = {}
+        vmsums = VMIOStats.new_statdict()
+
+        for sample in self.recent().values():
+            for vmid, rates in sample['vms'].items():
+                diffs = dict(zip(VMIOStats.keys, rates))
+                vmdiffs[(sample['node'], vmid)] = diffs
+
+                for key in VMIOStats.keys:
+                    vmsums[key] += diffs[key]
+
+        return (vmdiffs, vmsums)
@@ -43,6 +43,9 @@ setup(
         Topic :: Utilities
         """).strip().splitlines(),
     packages=find_packages(),
+    extras_require={
+        'parallel': ['futures'],
+        },
     entry_points={
         'console_scripts': [
             'vman = pve_vman.cli:vman',
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+
+"""Tests for aggregating the snapshots of the history file."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pve_vman import pvehistory
+
+
+class FakeItem(object):
+    """Stands in for the nodes and VMs of a cluster."""
+    def __init__(self, itemid, **attrs):
+        self.id = itemid
+        self.attrs = attrs
+
+
+class FakeCluster(object):
+    """Stands in for PVEStatCluster, holds fixed nodes and VMs."""
+    def __init__(self, nodes, vms):
+        self._nodes = nodes
+        self._vms = vms
+
+    def nodes(self):
+        return self._nodes
+
+    def vms(self):
+        return self._vms
+
+
+def snapshot(nodemem, vms):
+    """Return a cluster of one node and the VMs given as dictionary of
+    ids and (mem, cpu, diskread) tuples.
+    """
+    return FakeCluster(
+        [FakeItem('node01', memused=nodemem, cpu=0.5, netin=0, netout=0)],
+        [FakeItem(vmid, mem=mem, cpu=cpu, diskread=diskread, diskwrite=0,
+                  netin=0, netout=0)
+         for vmid, (mem, cpu, diskread) in sorted(vms.items())])
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'history.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def vmstats(self, stats, vmid):
+        values = stats[(pvehistory.VM, vmid)]
+        return values['mem'], values['cpu'], values['diskread']
+
+    def test_changing_vms(self):
+        history = pvehistory.History(self.path, interval=300)
+        history.append(snapshot(1000, {
+            '100': (100, 0.25, 0), '101': (200, 0.5, 1000)}), 1000)
+        history.append(snapshot(2000, {
+            '100': (300, 0.75, 3000), '101': (400, 0.5, 4000),
+            '102': (500, 1.0, 0)}), 1300)
+        history.append(snapshot(3000, {
+            '100': (500, 0.5, 6000), '102': (700, 1.0, 6000)}), 1600)
+
+        stats = history.statistics(600, now=1600)
+
+        self.assertEqual(sorted(stats), [
+            (pvehistory.NODE, 'node01'), (pvehistory.VM, '100'),
+            (pvehistory.VM, '101'), (pvehistory.VM, '102')])
+        self.assertEqual(stats[(pvehistory.NODE, 'node01')]['mem'], 2000)
+        self.assertEqual(self.vmstats(stats, '100'), (300, 0.5, 10))
+        self.assertEqual(self.vmstats(stats, '101'), (300, 0.5, 10))
+        self.assertEqual(self.vmstats(stats, '102'), (600, 1.0, 20))
+
+        stats = history.statistics(300, 'max', now=1600)
+
+        self.assertEqual(self.vmstats(stats, '100'), (500, 0.75, 10))
+        self.assertEqual(self.vmstats(stats, '101'), (400, 0.5, None))
+        self.assertEqual(self.vmstats(stats, '102'), (700, 1.0, 20))
+
+    def test_interrupted_append(self):
+        history = pvehistory.History(self.path, interval=300)
+        history.append(snapshot(1000, {
+            '100': (100, 0.25, 0), '101': (200, 0.5, 0)}), 1000)
+
+        # a snapshot interrupted after the node and half of the first VM
+        records = list(pvehistory._records(snapshot(2000, {
+            '100': (300, 0.75, 3000), '101': (400, 0.5, 3000)}), 1300))
+        with open(self.path, 'ab') as fileh:
+            fileh.write(records[0] + records[1][:20])
+
+        history = pvehistory.History(self.path, interval=300)
+        stats = history.statistics(600, now=1300)
+
+        self.assertEqual(history.last, 1300)
+        self.assertEqual(stats[(pvehistory.NODE, 'node01')]['mem'], 1500)
+        self.assertEqual(self.vmstats(stats, '100'), (100, 0.25, None))
+
+        history.append(snapshot(3000, {
+            '100': (500, 0.75, 6000), '101': (600, 0.5, 600)}), 1600)
+
+        self.assertEqual(os.path.getsize(self.path), pvehistory._offset(7))
+
+        stats = history.statistics(600, now=1600)
+
+        self.assertEqual(stats[(pvehistory.NODE, 'node01')]['mem'], 2000)
+        self.assertEqual(self.vmstats(stats, '100'), (300, 0.5, 10))
+        self.assertEqual(self.vmstats(stats, '101'), (400, 0.5, 1))
+        self.assertEqual([r[:3] for r in history.records(1300)], [
+            (1300, pvehistory.NODE, 'node01'),
+            (1600, pvehistory.NODE, 'node01'),
+            (1600, pvehistory.VM, '100'), (1600, pvehistory.VM, '101')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+
+"""Tests for reading the rows of the RRD files PVE keeps."""
+
+import math
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from pve_vman import pverrd
+from pve_vman.exceptions import InputError
+
+
+NAN = float('nan')
+
+
+def rrdfile(path, names, archives, lastupdate, step=60, version=b'0003'):
+    """Write an RRD file like rrdtool does on 64 bit little endian hosts.
+    The archives are (consolidation function, steps per row, current
+    row, rows) tuples, the rows are tuples of the data source values in
+    the order they are stored in the file.
+    """
+    data = pverrd.HEADER.pack(b'RRD\0', version + b'\0', pverrd.FLOATCOOKIE,
+                              len(names), len(archives), step)
+    for name in names:
+        data += pverrd.DSDEF.pack(name.encode(), b'GAUGE')
+    for cf, steps, _, rows in archives:
+        data += pverrd.RRADEF.pack(cf.encode(), len(rows), steps)
+    data += pverrd.LASTUPDATE.pack(lastupdate)
+    if version >= b'0003':
+        data += pverrd.LASTUPDATE.pack(0)
+    data += b'\0' * (len(names) * pverrd.PDPPREPSIZE
+                     + len(archives) * len(names) * pverrd.CDPPREPSIZE)
+    data += struct.pack('<{}Q'.format(len(archives)),
+                        *[a[2] for a in archives])
+    for _, _, _, rows in archives:
+        for row in rows:
+            data += struct.pack('<{}d'.format(len(names)), *row)
+
+    with open(path, 'wb') as fileh:
+        fileh.write(data)
+
+
+def same(rows, expected):
+    """Return if the rows equal the expected ones, NaN equal to NaN."""
+    return len(rows) == len(expected) and all(
+        len(r) == len(e) and all(
+            a == b or math.isnan(a) and math.isnan(b) for a, b in zip(r, e))
+        for r, e in zip(rows, expected))
+
+
+class RRDTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, '100')
+        # ten minute rows, stored rows 3 to 9 before 0 to 2, i.e. the
+        # current row 2 wrapped around the end of the archive
+        self.rows = [(float(p), 100.0 + p) for p in range(10)]
+        self.lastupdate = 1500000000 - 1500000000 % 60 + 30
+        rrdfile(self.path, ['cpu', 'mem'],
+                [('AVERAGE', 1, 2, self.rows),
+                 ('MAX', 1, 5, [(NAN, NAN)] * 10),
+                 ('AVERAGE', 10, 0, [(7.0, 7.0)] * 10)],
+                self.lastupdate)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self, window, cf='AVERAGE', now=None):
+        rrd = pverrd.RRD(self.path)
+        try:
+            return rrd.fetch(window, cf, now)
+        finally:
+            rrd.close()
+
+    def test_header(self):
+        rrd = pverrd.RRD(self.path)
+        try:
+            self.assertEqual(rrd.names, ['cpu', 'mem'])
+            self.assertEqual(rrd.step, 60)
+            self.assertEqual(rrd.lastupdate, self.lastupdate)
+            self.assertEqual([a[:4] for a in rrd.archives], [
+                ('AVERAGE', 60, 10, 2), ('MAX', 60, 10, 5),
+                ('AVERAGE', 600, 10, 0)])
+        finally:
+            rrd.close()
+
+    def test_fetch_wrapped_rows(self):
+        self.assertEqual(self.fetch(600),
+                         tuple(self.rows[3:] + self.rows[:3]))
+        self.assertEqual(self.fetch(300),
+                         tuple(self.rows[8:] + self.rows[:3]))
+
+    def test_fetch_unwrapped_rows(self):
+        self.assertEqual(self.fetch(120), tuple(self.rows[1:3]))
+        self.assertEqual(self.fetch(60), tuple(self.rows[2:3]))
+
+    def test_fetch_after_lastupdate(self):
+        self.assertEqual(self.fetch(300, now=self.lastupdate + 120),
+                         tuple(self.rows[:3]))
+        self.assertEqual(self.fetch(60, now=self.lastupdate + 600), ())
+
+    def test_fetch_coarser_archive(self):
+        self.assertEqual(self.fetch(3600), ((7.0, 7.0),) * 6)
+        self.assertEqual(self.fetch(86400), ((7.0, 7.0),) * 10)
+
+    def test_fetch_other_cf(self):
+        self.assertTrue(same(self.fetch(180, 'MAX'), [(NAN, NAN)] * 3))
+        self.assertRaises(InputError, self.fetch, 60, 'MIN')
+
+    def test_average_skips_unknown(self):
+        rows = list(self.rows)
+        rows[1] = (NAN, 50.0)
+        rrdfile(self.path, ['cpu', 'mem'], [('AVERAGE', 1, 2, rows)],
+                self.lastupdate)
+        rrd = pverrd.RRD(self.path)
+        try:
+            self.assertEqual(rrd.average(180),
+                             {'cpu': 1.0, 'mem': (100.0 + 50 + 102) / 3})
+            self.assertEqual(rrd.average(120, now=self.lastupdate + 6000),
+                             {'cpu': None, 'mem': None})
+        finally:
+            rrd.close()
+
+    def test_version_1_without_microseconds(self):
+        rrdfile(self.path, ['cpu', 'mem'], [('AVERAGE', 1, 2, self.rows)],
+                self.lastupdate, version=b'0001')
+        self.assertEqual(self.fetch(180), tuple(self.rows[:3]))
+
+    def test_unsupported_files(self):
+        with open(self.path, 'rb') as fileh:
+            data = fileh.read()
+
+        for broken in (data[:-8], b'XRD' + data[3:], b''):
+            with open(self.path, 'wb') as fileh:
+                fileh.write(broken)
+            self.assertRaises(InputError, pverrd.RRD, self.path)
+
+        self.assertRaises(InputError, pverrd.RRD,
+                          os.path.join(self.tmpdir, 'missing'))
+
+    def test_bad_row_pointer(self):
+        rrdfile(self.path, ['cpu', 'mem'], [('AVERAGE', 1, 10, self.rows)],
+                self.lastupdate)
+        self.assertRaises(InputError, pverrd.RRD, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright (c) 2017 RobHost GmbH <support@robhost.de>
+#
+#  Author: Tobias Böhm <tb@robhost.de>
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License as
+#  published by the Free Software Foundation; either version 2 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+#  USA
+
+
+
+
+"""Tests for streaming the VMIOStats of the agents to ClusterIOStats."""
+
+import threading
+import time
+import unittest
+
+from pve_vman import pvevmiostats
+
+
+class FakeVMIOStats(object):
+    """Stands in for VMIOStats, returns fixed rates for the given VMs."""
+    def __init__(self, vmdiffs):
+        self.vmdiffs = vmdiffs
+
+    def fetch(self):
+        return (self.vmdiffs, pvevmiostats.VMIOStats.new_statdict())
+
+
+def rates(rd_bytes, rd_operations, wr_bytes, wr_operations):
+    return dict(zip(pvevmiostats.VMIOStats.keys, (
+        rd_bytes, rd_operations, wr_bytes, wr_operations)))
+
+
+class ClusterIOStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+        self.agents = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def start_agent(self, nodename, vmdiffs, interval=1):
+        agent = pvevmiostats.VMIOStatsAgent(interval, nodename)
+        agent.vmstats = FakeVMIOStats(vmdiffs)
+        agent.update()
+
+        server = pvevmiostats._AgentServer(
+            ('127.0.0.1', 0), pvevmiostats._handler(agent))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.servers.append(server)
+        self.agents.append(server.server_address)
+
+    def wait(self, cluster, timeout=5):
+        deadline = time.time() + timeout
+        while cluster.missing() and time.time() < deadline:
+            time.sleep(0.05)
+        return cluster.fetch()
+
+    def test_fetch_merges_agents(self):
+        self.start_agent('node01', {
+            '100': rates(1000, 10, 2000, 20),
+            '101': rates(0, 0, 500, 5)})
+        self.start_agent('node02', {
+            '100': rates(3000, 30, 0, 0)})
+
+        cluster = pvevmiostats.ClusterIOStats(1, self.agents)
+        vmdiffs, vmsums = self.wait(cluster)
+
+        self.assertEqual(cluster.missing(), {})
+        self.assertEqual(vmdiffs, {
+            ('node01', '100'): rates(1000, 10, 2000, 20),
+            ('node01', '101'): rates(0, 0, 500, 5),
+            ('node02', '100'): rates(3000, 30, 0, 0)})
+        self.assertEqual(vmsums, rates(4000, 40, 2500, 25))
+
+    def test_agent_interval_decides_staleness(self):
+        self.start_agent('node01', {'100': rates(1, 1, 1, 1)}, interval=5)
+
+        cluster = pvevmiostats.ClusterIOStats(1, self.agents)
+        self.wait(cluster)
+
+        with cluster.lock:
+            received, sample = cluster.samples[self.agents[0]]
+            cluster.samples[self.agents[0]] = (
+                received - 2 * pvevmiostats.STALE, sample)
+
+        vmdiffs, _ = cluster.fetch()
+
+        self.assertEqual(list(vmdiffs), [('node01', '100')])
+
+
+if __name__ == '__main__':
+    unittest.main()